@@ -46,6 +46,7 @@ from hamster.preferences import PreferencesEditor
 from hamster.lib import default_logger, stuff
 from hamster.lib import datetime as dt
 from hamster.lib.fact import Fact
+from hamster.lib.factframe import FactFrame
 
 
 logger = default_logger(__file__)
@@ -227,8 +228,8 @@ class Hamster(gtk.Application):
 class HamsterCli(object):
     """Command line interface."""
 
-    def __init__(self):
-        self.storage = client.Storage()
+    def __init__(self, storage=None):
+        self.storage = storage or client.Storage()
 
 
     def assist(self, *args):
@@ -339,6 +340,30 @@ class HamsterCli(object):
         self._list(start_time, end_time, search)
 
 
+    def totals(self, *args):
+        """print the time spent per activity, category, tag or day within a date range"""
+        group_by = "category"
+        if args and args[0] in ("activity", "category", "tag", "day"):
+            group_by, args = args[0], args[1:]
+        (start_time, end_time), __ = dt.Range.parse(" ".join(args))
+
+        start_time = start_time or dt.datetime.combine(dt.date.today(), dt.time())
+        end_time = end_time or start_time.replace(hour=23, minute=59, second=59)
+        totals = self.storage.get_totals(start_time, end_time, group_by=group_by)
+        if group_by == "day":
+            totals.sort()
+
+        names = [str(key) or _("Unsorted") for key, __ in totals]
+        width = max([len(name) for name in names] + [len(_("Total"))])
+        for name, (__, duration) in zip(names, totals):
+            print("{: <{width}}  {}".format(name, duration.format(), width=width))
+        if group_by != "tag":
+            # facts can have several tags
+            total_duration = sum((duration for __, duration in totals), dt.timedelta())
+            print("-" * min(width + 10, 80))
+            print("{: <{width}}  {}".format(_("Total"), total_duration.format(), width=width))
+
+
     def _list(self, start_time, end_time, search=""):
         """Print a listing of activities"""
         facts = self.storage.get_facts(start_time, end_time, search)
@@ -374,12 +399,7 @@ class HamsterCli(object):
         print(fact_line.format(**headers))
         print("-" * min(row_width, 80))
 
-        by_cat = {}
         for fact in facts:
-            cat = fact.category or _("Unsorted")
-            by_cat.setdefault(cat, dt.timedelta(0))
-            by_cat[cat] += fact.delta
-
             pretty_fact = fact_dict(fact, print_with_date)
             print(fact_line.format(**pretty_fact))
 
@@ -395,8 +415,8 @@ class HamsterCli(object):
 
         cats = []
         total_duration = dt.timedelta()
-        for cat, duration in sorted(by_cat.items(), key=lambda x: x[1], reverse=True):
-            cats.append("{}: {}".format(cat, duration.format()))
+        for cat, duration in FactFrame.from_facts(facts).totals("category"):
+            cats.append("{}: {}".format(cat or _("Unsorted"), duration.format()))
             total_duration += duration
 
         for line in word_wrap(", ".join(cats), 80):
@@ -406,6 +426,17 @@ class HamsterCli(object):
         print()
 
 
+    def optimize(self, *args):
+        """optimize the search index, rebuild it from scratch with 'rebuild'"""
+        self.storage.optimize_index(rebuild="rebuild" in args)
+
+
+    def rollup(self, *args):
+        """check the daily totals against the facts, rebuild them with 'rebuild'"""
+        wrong = self.storage.check_daily_totals(rebuild="rebuild" in args)
+        print("{} wrong or missing daily totals".format(wrong))
+
+
     def version(self):
         print(hamster.__version__)
 
@@ -424,9 +455,15 @@ Actions:
       term
     * export [html|tsv|ical|xml] [start-date [end-date]]: Export activities with
       the specified format
+    * totals [activity|category|tag|day] [start-date [end-date]]: Print the
+      time spent per category (default), activity, tag or day
     * current: Print current activity
     * activities: List all the activities names, one per line.
     * categories: List all the categories names, one per line.
+    * optimize [rebuild]: Optimize the search index, or rebuild it from
+      scratch
+    * rollup [rebuild]: Check the daily totals (used for long range totals)
+      against the activities, or rebuild them from scratch
 
     * overview / preferences / add / about: launch specific window
 
@@ -450,7 +487,6 @@ Example usage:
         August 2012. Will check against activity, category, description and tags
 """)
 
-    hamster_client = HamsterCli()
     app = Hamster()
     logger.debug("app instanciated")
 
@@ -467,6 +503,10 @@ Example usage:
                         choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
                         default='WARNING',
                         help="Set the logging level (default: %(default)s)")
+    parser.add_argument("--direct", action="store_true",
+                        help="Read the database directly instead of asking the "
+                             "hamster service (faster for listings; "
+                             "changes still go through the service)")
     parser.add_argument("action", nargs="?", default="overview")
     parser.add_argument('action_args', nargs=argparse.REMAINDER, default=[])
 
@@ -480,6 +520,8 @@ Example usage:
     if not hamster.installed:
         logger.info("Running in devel mode")
 
+    hamster_client = HamsterCli(client.open_storage("direct" if args.direct else "dbus"))
+
     if args.action in ("start", "track"):
         action = "add"  # alias
     elif args.action == "prefs":
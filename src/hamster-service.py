@@ -4,6 +4,9 @@
 import dbus
 import dbus.service
 
+from collections import defaultdict, deque
+from json import dumps, loads
+
 from gi.repository import GLib as glib
 from gi.repository import Gio as gio
 
@@ -18,12 +21,15 @@ from hamster.lib import default_logger
 from hamster.lib.dbus import (
     DBusMainLoop,
     fact_signature,
+    facts_batch_signature,
     from_dbus_date,
     from_dbus_fact,
     from_dbus_fact_json,
     from_dbus_range,
+    to_dbus_date,
     to_dbus_fact,
-    to_dbus_fact_json
+    to_dbus_fact_json,
+    to_dbus_facts_batch
 )
 from hamster.lib.fact import Fact, FactError
 
@@ -41,6 +47,29 @@ if "org.gnome.Hamster" in dbus.SessionBus().list_names():
 class Storage(db.Storage, dbus.service.Object):
     __dbus_object_path__ = "/org/gnome/Hamster"
 
+    # methods answered from worker threads (cf. _call_async):
+    # name: (maximum number of calls running at once, timeout in seconds)
+    async_limits = {
+        "GetFacts": (2, 120),
+        "GetFactsJSON": (2, 120),
+        "GetFactsBatch": (2, 120),
+        "GetTotals": (2, 120),
+        "SearchFactsJSON": (2, 120),
+        "FetchFacts": (2, 120),
+        "GetChangesSince": (2, 120),
+        "GetActivities": (2, 10),
+        "GetTags": (2, 10),
+        "Batch": (2, 120),
+    }
+
+    # read-only methods that can be called through Batch
+    batch_methods = {"Version",
+                     "GetFact", "GetFactJSON", "GetFacts", "GetFactsJSON",
+                     "GetFactsBatch", "GetTotals", "SearchFactsJSON",
+                     "GetTodaysFacts", "GetTodaysFactsJSON", "GetChangesSince",
+                     "GetCategories", "GetCategoryId",
+                     "GetActivities", "GetCategoryActivities", "GetTags"}
+
     def __init__(self, loop):
         self.bus = dbus.SessionBus()
         bus_name = dbus.service.BusName("org.gnome.Hamster", bus=self.bus)
@@ -51,6 +80,10 @@ class Storage(db.Storage, dbus.service.Object):
 
         self.mainloop = loop
 
+        # per method: number of calls running, calls waiting for their turn
+        self.__running = defaultdict(int)
+        self.__waiting = defaultdict(deque)
+
         self.__file = gio.File.new_for_path(__file__)
         self.__monitor = self.__file.monitor_file(gio.FileMonitorFlags.WATCH_MOUNTS | \
                                                   gio.FileMonitorFlags.SEND_MOVED,
@@ -93,7 +126,26 @@ class Storage(db.Storage, dbus.service.Object):
 
     @dbus.service.signal("org.gnome.Hamster")
     def FactsChanged(self): pass
-    def facts_changed(self):
+
+    @dbus.service.signal("org.gnome.Hamster", signature='auiix')
+    def FactsChangedV2(self, ids, min_day, max_day, revision):
+        """Facts were added, changed or removed.
+
+        Emitted right before FactsChanged, with details.
+
+        Args:
+            ids (list of int): the facts concerned.
+            min_day, max_day (int): the hamster days whose facts changed,
+                                    in seconds since epoch (cf. to_dbus_date),
+                                    0 for no bound.
+            revision (int): increases with each change, 0 if unknown.
+        """
+        pass
+
+    def facts_changed(self, ids=(), min_day=None, max_day=None, revision=0):
+        self.FactsChangedV2(dbus.Array(ids, signature='u'),
+                            to_dbus_date(min_day), to_dbus_date(max_day),
+                            revision)
         self.FactsChanged()
 
     @dbus.service.signal("org.gnome.Hamster")
@@ -108,9 +160,77 @@ class Storage(db.Storage, dbus.service.Object):
 
     def dispatch_overwrite(self):
         self.TagsChanged()
-        self.FactsChanged()
+        self.facts_changed()
         self.ActivitiesChanged()
 
+    def _call_async(self, name, read, reply_handler, error_handler):
+        """Answer the D-Bus call name with read(), run on a worker thread.
+
+        read must only call read-only methods (cf. db.Storage.read_async).
+        The main loop stays free for the other calls meanwhile.
+        At most async_limits[name] calls run at once,
+        the next ones wait for their turn.
+        The call fails with org.gnome.Hamster.Timeout
+        if it is not done in time.
+        """
+        if self.in_reader():
+            # already on a worker thread (cf. Batch), answer right away
+            try:
+                result = read()
+            except Exception as error:
+                error_handler(error)
+            else:
+                reply_handler(result)
+            return
+
+        limit, timeout = self.async_limits[name]
+        call = {"future": None, "answered": False, "timeout_id": None}
+
+        def answer(handler, value):
+            if call["answered"]:
+                return
+            call["answered"] = True
+            if call["timeout_id"]:
+                glib.source_remove(call["timeout_id"])
+            handler(value)
+
+        def done():
+            self.__running[name] -= 1
+            if self.__waiting[name]:
+                self.__waiting[name].popleft()()
+
+        def on_result(result):
+            done()
+            answer(reply_handler, result)
+
+        def on_error(error):
+            done()
+            answer(error_handler, error)
+
+        def start():
+            self.__running[name] += 1
+            call["future"] = self.read_async(read, callback=on_result,
+                                             error_callback=on_error)
+
+        def on_timeout():
+            call["timeout_id"] = None
+            if call["future"] is None:
+                self.__waiting[name].remove(start)
+            elif call["future"].cancel():
+                # was still queued for a worker thread
+                done()
+            logger.warning("{} timed out after {}s".format(name, timeout))
+            answer(error_handler,
+                   dbus.exceptions.DBusException("{} timed out".format(name),
+                                                 name="org.gnome.Hamster.Timeout"))
+            return False  # once
+
+        call["timeout_id"] = glib.timeout_add_seconds(timeout, on_timeout)
+        if self.__running[name] < limit:
+            start()
+        else:
+            self.__waiting[name].append(start)
+
     @dbus.service.method("org.gnome.Hamster")
     def Quit(self):
         """
@@ -125,6 +245,58 @@ class Storage(db.Storage, dbus.service.Object):
         self.mainloop.quit()
 
 
+    @dbus.service.method("org.gnome.Hamster",
+                         in_signature='s',
+                         out_signature='s',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def Batch(self, requests, reply_handler, error_handler):
+        """Make several read-only calls in a single round trip.
+
+        Args:
+            requests (str): JSON array of [method, [args]],
+                            e.g. [["GetCategories", []], ["GetFactJSON", [12]]]
+                            (cf. batch_methods).
+        Return:
+            JSON array of the replies, in the same order.
+            Each is either {"result": value}, value being what the
+            method returns, or {"error": message, "name": D-Bus error name}.
+        """
+        requests = loads(requests)
+        for method, __ in requests:
+            if method not in self.batch_methods:
+                raise dbus.exceptions.DBusException(
+                    "{} cannot be batched".format(method),
+                    name="org.freedesktop.DBus.Error.InvalidArgs")
+
+        def read():
+            return dumps([self._batch_call(method, args) for method, args in requests])
+        self._call_async("Batch", read, reply_handler, error_handler)
+
+    def _batch_call(self, method, args):
+        """Answer a Batch request, on the current thread."""
+        reply = {}
+
+        def on_result(result):
+            reply["result"] = result
+
+        def on_error(error):
+            logger.warning("batched {} failed: {}".format(method, error))
+            reply["error"] = str(error)
+            reply["name"] = "org.gnome.Hamster.Error"
+            if isinstance(error, dbus.exceptions.DBusException):
+                reply["name"] = error.get_dbus_name() or reply["name"]
+
+        func = getattr(self, method)
+        try:
+            if func._dbus_async_callbacks:
+                func(*args, reply_handler=on_result, error_handler=on_error)
+            else:
+                on_result(func(*args))
+        except Exception as error:
+            on_error(error)
+        return reply
+
+
     @dbus.service.method("org.gnome.Hamster")
     def Toggle(self):
         """Toggle visibility of the main application window.
@@ -195,6 +367,24 @@ class Storage(db.Storage, dbus.service.Object):
         return self.add_fact(fact)
 
 
+    @dbus.service.method("org.gnome.Hamster", in_signature='as', out_signature='ai')
+    def AddFactsJSON(self, dbus_facts):
+        """Add several facts given in JSON format, in a single transaction.
+
+        Much faster than repeated AddFactJSON calls,
+        and FactsChanged is emitted only once.
+        If any fact is invalid, nothing is added.
+
+        Args:
+            dbus_facts (list of str): facts in JSON format (cf. AddFactJSON).
+
+        Returns:
+            list of fact ids (int), in the same order. 0 means failure.
+        """
+        facts = [from_dbus_fact_json(dbus_fact) for dbus_fact in dbus_facts]
+        return self.add_facts(facts)
+
+
     @dbus.service.method("org.gnome.Hamster",
                          in_signature="si",
                          out_signature='bs')
@@ -245,6 +435,31 @@ class Storage(db.Storage, dbus.service.Object):
         return to_dbus_fact_json(fact)
 
 
+    @dbus.service.method("org.gnome.Hamster",
+                         in_signature='x',
+                         out_signature='(xasau)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def GetChangesSince(self, revision, reply_handler, error_handler):
+        """Get the changes made to the facts after revision.
+
+        Mirrors keep up to date by asking for the changes since the last
+        revision they got (cf. FactsChangedV2), starting from 0.
+
+        Args:
+            revision (int): the last revision known, 0 for everything.
+        Return:
+            (revision, facts, removed_ids): the revision to ask from next time,
+            the facts added or changed, in JSON format (cf. to_dbus_fact_json),
+            and the ids of the facts removed.
+        """
+        def read():
+            revision_, facts, removed_ids = self.get_changes_since(revision)
+            return (revision_,
+                    dbus.Array([to_dbus_fact_json(fact) for fact in facts], signature='s'),
+                    dbus.Array(removed_ids, signature='u'))
+        self._call_async("GetChangesSince", read, reply_handler, error_handler)
+
+
     @dbus.service.method("org.gnome.Hamster", in_signature='isiib', out_signature='i')
     def UpdateFact(self, fact_id, fact, start_time, end_time, temporary):
         start_time = start_time or None
@@ -296,8 +511,9 @@ class Storage(db.Storage, dbus.service.Object):
 
     @dbus.service.method("org.gnome.Hamster",
                          in_signature='uus',
-                         out_signature='a{}'.format(fact_signature))
-    def GetFacts(self, start_date, end_date, search_terms):
+                         out_signature='a{}'.format(fact_signature),
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def GetFacts(self, start_date, end_date, search_terms, reply_handler, error_handler):
         """Gets facts between the day of start_date and the day of end_date.
         Parameters:
         i start_date: Seconds since epoch (timestamp). Use 0 for today
@@ -316,13 +532,16 @@ class Storage(db.Storage, dbus.service.Object):
         if end_date:
             end = dt.datetime.utcfromtimestamp(end_date).date()
 
-        return [to_dbus_fact(fact) for fact in self.get_facts(start, end, search_terms)]
+        def read():
+            return [to_dbus_fact(fact) for fact in self.get_facts(start, end, search_terms)]
+        self._call_async("GetFacts", read, reply_handler, error_handler)
 
 
     @dbus.service.method("org.gnome.Hamster",
                          in_signature='ss',
-                         out_signature='as')
-    def GetFactsJSON(self, dbus_range, search_terms):
+                         out_signature='as',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def GetFactsJSON(self, dbus_range, search_terms, reply_handler, error_handler):
         """Gets facts between the day of start and the day of end.
 
         Args:
@@ -337,8 +556,120 @@ class Storage(db.Storage, dbus.service.Object):
         This will be the preferred way to get facts.
         """
         range = from_dbus_range(dbus_range)
-        return [to_dbus_fact_json(fact)
-                for fact in self.get_facts(range, search_terms=search_terms)]
+
+        def read():
+            return [to_dbus_fact_json(fact)
+                    for fact in self.get_facts(range, search_terms=search_terms)]
+        self._call_async("GetFactsJSON", read, reply_handler, error_handler)
+
+
+    @dbus.service.method("org.gnome.Hamster",
+                         in_signature='ss',
+                         out_signature=facts_batch_signature,
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def GetFactsBatch(self, dbus_range, search_terms, reply_handler, error_handler):
+        """Gets facts between the day of start and the day of end.
+
+        Same as GetFactsJSON, but all the facts come in a single
+        columnar structure, much faster to decode.
+        (cf. to_dbus_facts_batch)
+        """
+        range = from_dbus_range(dbus_range)
+
+        def read():
+            return to_dbus_facts_batch(self.get_facts(range, search_terms=search_terms))
+        self._call_async("GetFactsBatch", read, reply_handler, error_handler)
+
+
+    @dbus.service.method("org.gnome.Hamster",
+                         in_signature='sss',
+                         out_signature='a(sx)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def GetTotals(self, dbus_range, group_by, search_terms, reply_handler, error_handler):
+        """Gets the time spent on the facts of GetFactsBatch, summed up.
+
+        Args:
+            group_by (str): "activity", "category", "tag" or "day"
+                            (hamster day of the fact start).
+        Return an array of (name, or day in the YYYY-MM-DD format, seconds),
+        longest first.
+        """
+        range = from_dbus_range(dbus_range)
+
+        def read():
+            return [(str(key), int(delta.total_seconds()))
+                    for key, delta in self.get_totals(range, group_by=group_by,
+                                                      search_terms=search_terms)]
+        self._call_async("GetTotals", read, reply_handler, error_handler)
+
+
+    @dbus.service.method("org.gnome.Hamster",
+                         in_signature='ssbuu',
+                         out_signature='as',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def SearchFactsJSON(self, dbus_range, search_terms, ranked, limit, offset,
+                        reply_handler, error_handler):
+        """Search facts between the day of start and the day of end.
+
+        Args:
+            dbus_range (str): same format as on the command line.
+                              (cf. dt.Range.parse)
+            search_terms (str): words, "phrases", prefix*,
+                                activity:, category:, description:
+                                or tag: scoped terms.
+                                If starts with "not ",
+                                the search terms will be reversed
+            ranked (bool): best matches first (bm25),
+                           instead of chronological order.
+            limit (int): maximum number of facts, 0 for all of them.
+            offset (int): number of facts to skip.
+        Return:
+            array of D-Bus facts in JSON format.
+            (cf. to_dbus_fact_json)
+        """
+        range = from_dbus_range(dbus_range)
+
+        def read():
+            return [to_dbus_fact_json(fact)
+                    for fact in self.get_facts(range, search_terms=search_terms,
+                                               ranked=ranked, limit=limit or None,
+                                               offset=offset)]
+        self._call_async("SearchFactsJSON", read, reply_handler, error_handler)
+
+
+    @dbus.service.method("org.gnome.Hamster",
+                         in_signature='ss',
+                         out_signature='s')
+    def OpenFactsCursor(self, dbus_range, search_terms):
+        """Start going through facts a batch at a time (cf. FetchFacts).
+
+        Args: same as GetFactsJSON.
+        Return:
+            the cursor id. Unused cursors expire after a while.
+        """
+        range = from_dbus_range(dbus_range)
+        return self.open_facts_cursor(range, search_terms=search_terms)
+
+
+    @dbus.service.method("org.gnome.Hamster",
+                         in_signature='su',
+                         out_signature='as',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def FetchFacts(self, cursor, n, reply_handler, error_handler):
+        """Return the next n facts of the cursor, in JSON format.
+
+        Facts come in chronological order.
+        An empty array means the end; the cursor is then closed.
+        """
+        def read():
+            return [to_dbus_fact_json(fact) for fact in self.fetch_facts(cursor, n)]
+        self._call_async("FetchFacts", read, reply_handler, error_handler)
+
+
+    @dbus.service.method("org.gnome.Hamster", in_signature='s')
+    def CloseCursor(self, cursor):
+        """Close the cursor, e.g. when stopping before the end."""
+        self.close_cursor(cursor)
 
 
     @dbus.service.method("org.gnome.Hamster", out_signature='a{}'.format(fact_signature))
@@ -404,9 +735,12 @@ class Storage(db.Storage, dbus.service.Object):
                       self.get_category_activities(category_id = category_id)]
 
 
-    @dbus.service.method("org.gnome.Hamster", in_signature='s', out_signature='a(ss)')
-    def GetActivities(self, search = ""):
-        return [(row['name'], row['category'] or '') for row in self.get_activities(search)]
+    @dbus.service.method("org.gnome.Hamster", in_signature='s', out_signature='a(ss)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def GetActivities(self, search, reply_handler, error_handler):
+        def read():
+            return [(row['name'], row['category'] or '') for row in self.get_activities(search)]
+        self._call_async("GetActivities", read, reply_handler, error_handler)
 
 
     @dbus.service.method("org.gnome.Hamster", in_signature='ii', out_signature = 'b')
@@ -423,9 +757,12 @@ class Storage(db.Storage, dbus.service.Object):
             return {}
 
     # tags
-    @dbus.service.method("org.gnome.Hamster", in_signature='b', out_signature='a(isb)')
-    def GetTags(self, only_autocomplete):
-        return [(tag['id'], tag['name'], tag['autocomplete']) for tag in self.get_tags(only_autocomplete)]
+    @dbus.service.method("org.gnome.Hamster", in_signature='b', out_signature='a(isb)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def GetTags(self, only_autocomplete, reply_handler, error_handler):
+        def read():
+            return [(tag['id'], tag['name'], tag['autocomplete']) for tag in self.get_tags(only_autocomplete)]
+        self._call_async("GetTags", read, reply_handler, error_handler)
 
 
     @dbus.service.method("org.gnome.Hamster", in_signature='as', out_signature='a(isb)')
@@ -438,6 +775,25 @@ class Storage(db.Storage, dbus.service.Object):
         self.update_autocomplete_tags(tags)
 
 
+    @dbus.service.method("org.gnome.Hamster", in_signature='b')
+    def OptimizeIndex(self, rebuild):
+        """Optimize the full text search index.
+
+        rebuild (bool): rebuild it from scratch instead.
+        """
+        self.optimize_index(rebuild)
+
+
+    @dbus.service.method("org.gnome.Hamster", in_signature='b', out_signature='u')
+    def CheckDailyTotals(self, rebuild):
+        """Check the daily totals rollup (cf. GetTotals) against the facts.
+
+        rebuild (bool): rebuild it from scratch afterwards.
+        Return the number of wrong or missing rows found.
+        """
+        return self.check_daily_totals(rebuild)
+
+
     @dbus.service.method("org.gnome.Hamster", out_signature='s')
     def Version(self):
         return hamster.__version__
@@ -22,30 +22,93 @@
 import dbus
 import logging
 logger = logging.getLogger(__name__)   # noqa: E402
+import sqlite3 as sqlite
 import sys
 
 from calendar import timegm
+from concurrent.futures import Future
+from contextlib import contextmanager
+from gi.repository import GLib as glib
 from gi.repository import GObject as gobject
+from json import dumps, loads
 from textwrap import dedent
 
 import hamster
 from hamster.lib.dbus import (
     DBusMainLoop,
+    from_dbus_date,
     from_dbus_fact_json,
+    from_dbus_facts_batch,
     to_dbus_date,
     to_dbus_fact,
     to_dbus_fact_json,
     to_dbus_range,
     )
 from hamster.lib.fact import Fact, FactError
+from hamster.lib.factcache import FactCache
 from hamster.lib import datetime as dt
 
 
+def _from_dbus_facts_json(dbus_facts):
+    return [from_dbus_fact_json(fact) for fact in dbus_facts]
+
+
+def _resolve(future, decode, *result):
+    """Set the future result from a D-Bus reply, through decode."""
+    # reply handlers get one argument per returned value
+    result = result[0] if len(result) == 1 else (result or None)
+    try:
+        future.set_result(decode(result) if decode else result)
+    except Exception as error:
+        future.set_exception(error)
+
+
+def when_done(futures, callback):
+    """Call callback() once all the futures are done (cf. AsyncStorage)."""
+    futures = list(futures)
+    remaining = [len(futures)]
+
+    def on_done(future):
+        remaining[0] -= 1
+        if not remaining[0]:
+            callback()
+    if not futures:
+        callback()
+    for future in futures:
+        future.add_done_callback(on_done)
+
+
+class BatchCall(Future):
+    """A call queued in a Storage.batch(), a Future of its result."""
+
+    def __init__(self, method, args, decode):
+        super().__init__()
+        self.set_running_or_notify_cancel()
+        self.method = method
+        self.args = args
+        self._decode = decode
+
+    def _set_result(self, value):
+        _resolve(self, self._decode, value)
+
+    def result(self, timeout=None):
+        """Return the call result, once the batch is over.
+
+        Raise the call error, if any.
+        """
+        if not self.done():
+            raise RuntimeError("{} is still waiting for the end of its batch"
+                               .format(self.method))
+        return super().result()
+
+
 class Storage(gobject.GObject):
     """Hamster client class, communicating to hamster storage daemon via d-bus.
        Subscribe to the `tags-changed`, `facts-changed` and `activities-changed`
        signals to be notified when an appropriate factoid of interest has been
        changed.
+       `facts-changed-v2` tells which facts changed, and the hamster days
+       they affect (ids, min_day, max_day, revision; cf. FactsChangedV2).
 
        In storage a distinguishment is made between the classificator of
        activities and the event in tracking log.
@@ -57,6 +120,9 @@ class Storage(gobject.GObject):
     __gsignals__ = {
         "tags-changed": (gobject.SignalFlags.RUN_LAST, gobject.TYPE_NONE, ()),
         "facts-changed": (gobject.SignalFlags.RUN_LAST, gobject.TYPE_NONE, ()),
+        "facts-changed-v2": (gobject.SignalFlags.RUN_LAST, gobject.TYPE_NONE,
+                             (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT,
+                              gobject.TYPE_PYOBJECT, gobject.TYPE_INT64)),
         "activities-changed": (gobject.SignalFlags.RUN_LAST, gobject.TYPE_NONE, ()),
         "toggle-called": (gobject.SignalFlags.RUN_LAST, gobject.TYPE_NONE, ()),
     }
@@ -67,9 +133,16 @@ class Storage(gobject.GObject):
         DBusMainLoop(set_as_default=True)
         self.bus = dbus.SessionBus()
         self._connection = None # will be initiated on demand
+        self._facts_cache = FactCache()
+        self._batch = None  # queued BatchCall, within batch()
+        # whether the service emits FactsChangedV2 (older ones do not)
+        self._facts_changed_v2 = False
+        # whether the facts signals reach us (cf. _facts_cache_enabled)
+        self._facts_signals = False
 
         self.bus.add_signal_receiver(self._on_tags_changed, 'TagsChanged', 'org.gnome.Hamster')
         self.bus.add_signal_receiver(self._on_facts_changed, 'FactsChanged', 'org.gnome.Hamster')
+        self.bus.add_signal_receiver(self._on_facts_changed_v2, 'FactsChangedV2', 'org.gnome.Hamster')
         self.bus.add_signal_receiver(self._on_activities_changed, 'ActivitiesChanged', 'org.gnome.Hamster')
         self.bus.add_signal_receiver(self._on_toggle_called, 'ToggleCalled', 'org.gnome.Hamster')
 
@@ -108,16 +181,102 @@ class Storage(gobject.GObject):
                 )
         return self._connection
 
+    def _call(self, method, args=(), decode=None, batch=True):
+        """Return decode(conn.method(*args)).
+
+        Within a batch(), queue it instead, unless batch is False
+        (the method may write).
+        """
+        if batch and self._batch is not None:
+            call = BatchCall(method, args, decode)
+            self._batch.append(call)
+            return call
+        result = getattr(self.conn, method)(*args)
+        return decode(result) if decode else result
+
+    @contextmanager
+    def batch(self):
+        """Make the read calls of the block in a single D-Bus round trip.
+
+        Within the block, the get_* methods (except get_tag_ids and
+        get_activity_by_name, which may write) return a BatchCall instead
+        of their result, available through BatchCall.result() afterwards:
+
+            with storage.batch():
+                categories = storage.get_categories()
+                facts = storage.get_todays_facts()
+            categories = categories.result()
+        """
+        if self._batch is not None:
+            # nested, part of the outer batch
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+            calls = self._batch
+        finally:
+            self._batch = None
+        self._run_batch(calls)
+
+    def _run_batch(self, calls):
+        if not calls:
+            return
+        requests = [(call.method, list(call.args)) for call in calls]
+        try:
+            replies = self.conn.Batch(dumps(requests))
+        except dbus.exceptions.DBusException as error:
+            if error.get_dbus_name() != "org.freedesktop.DBus.Error.UnknownMethod":
+                raise
+            # older service, one call at a time
+            for call in calls:
+                try:
+                    call._set_result(getattr(self.conn, call.method)(*call.args))
+                except dbus.exceptions.DBusException as error:
+                    call.set_exception(error)
+            return
+        self._resolve_batch(calls, replies)
+
+    @staticmethod
+    def _resolve_batch(calls, replies):
+        for call, reply in zip(calls, loads(replies)):
+            if "error" in reply:
+                call.set_exception(dbus.exceptions.DBusException(reply["error"],
+                                                                 name=reply["name"]))
+            else:
+                call._set_result(reply["result"])
+
     def _on_dbus_connection_change(self, name, old, new):
         self._connection = None
+        self._facts_changed_v2 = False
+        self._facts_cache.invalidate()
 
     def _on_tags_changed(self):
+        # facts carry the tag names
+        self._facts_cache.invalidate()
         self.emit("tags-changed")
 
     def _on_facts_changed(self):
+        self._facts_signals = True
+        if not self._facts_changed_v2:
+            # no details, anything might have changed
+            self._facts_cache.invalidate()
+            self.emit("facts-changed-v2", [], None, None, 0)
         self.emit("facts-changed")
 
+    def _on_facts_changed_v2(self, ids, min_day, max_day, revision):
+        # FactsChanged follows, already handled here
+        self._facts_changed_v2 = True
+        self._facts_signals = True
+        min_day = from_dbus_date(min_day)
+        max_day = from_dbus_date(max_day)
+        self._facts_cache.invalidate(min_day, max_day)
+        self.emit("facts-changed-v2", [int(fact_id) for fact_id in ids],
+                  min_day, max_day, int(revision))
+
     def _on_activities_changed(self):
+        # facts carry the activity and category names
+        self._facts_cache.invalidate()
         self.emit("activities-changed")
 
     def _on_toggle_called(self):
@@ -125,39 +284,123 @@ class Storage(gobject.GObject):
 
     def toggle(self):
         """toggle visibility of the main application window if any"""
-        self.conn.Toggle()
+        return self._call("Toggle", batch=False)
 
     def get_todays_facts(self):
         """returns facts of the current date, respecting hamster midnight
            hamster midnight is stored in gconf, and presented in minutes
         """
-        return [from_dbus_fact_json(fact) for fact in self.conn.GetTodaysFactsJSON()]
+        return self._call("GetTodaysFactsJSON", (), _from_dbus_facts_json)
 
-    def get_facts(self, start, end=None, search_terms=""):
+    def get_facts(self, start, end=None, search_terms="", ranked=False, limit=None, offset=0):
         """Returns facts for the time span matching the optional filter criteria.
-           In search terms comma (",") translates to boolean OR and space (" ")
-           to boolean AND.
-           Filter is applied to tags, categories, activity names and description
+           In search terms space (" ") translates to boolean AND,
+           "quoted phrases" match as a whole and a trailing "*" matches
+           by prefix. Terms can be restricted to a field with activity:,
+           category:, description: or tag: (e.g. tag:"working late").
+           Otherwise the filter is applied to tags, categories,
+           activity names and description.
+           ranked: best matches first, instead of chronological order.
+           limit, offset: return only a page of the results.
         """
         range = dt.Range.from_start_end(start, end)
         dbus_range = to_dbus_range(range)
-        return [from_dbus_fact_json(fact)
-                for fact in self.conn.GetFactsJSON(dbus_range, search_terms)]
+        if ranked or limit is not None or offset:
+            return self._call("SearchFactsJSON",
+                              (dbus_range, search_terms, ranked, limit or 0, offset),
+                              _from_dbus_facts_json)
+        if not search_terms and self._batch is None and self._facts_cache_enabled():
+            facts = self._get_cached_facts(range)
+            if facts is not None:
+                return facts
+        return self._call("GetFactsBatch", (dbus_range, search_terms), from_dbus_facts_batch)
+
+    def get_totals(self, start, end=None, group_by="category", search_terms=""):
+        """Returns the time spent on the facts of get_facts(start, end, search_terms),
+           summed up by the service.
+           group_by: "activity", "category", "tag" or "day"
+           (hamster day of the fact start).
+           Returns a list of (name or dt.hday, dt.timedelta), longest first.
+        """
+        dbus_range = to_dbus_range(dt.Range.from_start_end(start, end))
+
+        def decode(result):
+            return [(dt.hday.parse(key) if group_by == "day" else str(key),
+                     dt.timedelta(seconds=int(seconds)))
+                    for key, seconds in result]
+        return self._call("GetTotals", (dbus_range, group_by, search_terms), decode)
+
+    def _facts_cache_enabled(self):
+        """Whether the facts cache can be used.
+
+        Changes made by other clients are known from the signals only,
+        and these are not delivered without a running main loop
+        (e.g. in scripts), so the cache would never be invalidated.
+        """
+        return self._facts_signals or glib.main_depth() > 0
+
+    def _write(self, method, args=(), decode=None):
+        """Call a method changing the facts, and forget the cached ones.
+
+        The signals come too late (if ever) for a get_facts right after.
+        """
+        try:
+            result = self._call(method, args, decode, batch=False)
+        finally:
+            self._facts_cache.invalidate()
+        if isinstance(result, Future):
+            # asynchronous, facts read meanwhile might be outdated
+            result.add_done_callback(lambda future: self._facts_cache.invalidate())
+        return result
+
+    def _get_cached_facts(self, range):
+        """Facts of range, if it is made of whole days (cf. FactCache), or None."""
+        return self._facts_cache.get(range, self._fetch_days)
+
+    def _fetch_days(self, first_day, last_day):
+        range = dt.Range.from_start_end(first_day, last_day)
+        return from_dbus_facts_batch(self.conn.GetFactsBatch(to_dbus_range(range), ""))
+
+    @property
+    def facts_cache_stats(self):
+        """(hits, misses) of the facts cache, in days."""
+        return self._facts_cache.hits, self._facts_cache.misses
+
+    def iter_facts(self, start, end=None, search_terms="", batch_size=500):
+        """Iterate over the facts of the time span matching search_terms,
+           in chronological order (cf. get_facts).
+           Facts are fetched batch_size at a time, so even years of facts
+           take little memory, and the first ones come right away.
+        """
+        range = dt.Range.from_start_end(start, end)
+        cursor = self.conn.OpenFactsCursor(to_dbus_range(range), search_terms)
+        try:
+            while True:
+                facts = self.conn.FetchFacts(cursor, batch_size)
+                if not facts:
+                    break
+                for fact in facts:
+                    yield from_dbus_fact_json(fact)
+        finally:
+            self.conn.CloseCursor(cursor)
 
     def get_activities(self, search = ""):
         """returns list of activities name matching search criteria.
            results are sorted by most recent usage.
            search is case insensitive
         """
-        return self._to_dict(('name', 'category'), self.conn.GetActivities(search))
+        return self._call("GetActivities", (search,),
+                          lambda result: self._to_dict(('name', 'category'), result))
 
     def get_categories(self):
         """returns list of categories"""
-        return self._to_dict(('id', 'name'), self.conn.GetCategories())
+        return self._call("GetCategories", (),
+                          lambda result: self._to_dict(('id', 'name'), result))
 
     def get_tags(self, only_autocomplete = False):
         """returns list of all tags. by default only those that have been set for autocomplete"""
-        return self._to_dict(('id', 'name', 'autocomplete'), self.conn.GetTags(only_autocomplete))
+        return self._call("GetTags", (only_autocomplete,),
+                          lambda result: self._to_dict(('id', 'name', 'autocomplete'), result))
 
 
     def get_tag_ids(self, tags):
@@ -167,16 +410,31 @@ class Storage(gobject.GObject):
            be created.
            on database changes the `tags-changed` signal is emitted.
         """
-        return self._to_dict(('id', 'name', 'autocomplete'), self.conn.GetTagIds(tags))
+        return self._call("GetTagIds", (tags,),
+                          lambda result: self._to_dict(('id', 'name', 'autocomplete'), result),
+                          batch=False)
 
     def update_autocomplete_tags(self, tags):
         """update list of tags that should autocomplete. this list replaces
            anything that is currently set"""
-        self.conn.SetTagsAutocomplete(tags)
+        return self._call("SetTagsAutocomplete", (tags,), batch=False)
 
     def get_fact(self, id):
         """returns fact by it's ID"""
-        return from_dbus_fact_json(self.conn.GetFactJSON(id))
+        return self._call("GetFactJSON", (id,), from_dbus_fact_json)
+
+    def get_changes_since(self, revision=0):
+        """Changes made to the facts after revision
+           (0: every fact), to keep a copy of them up to date.
+           Returns (revision, facts, removed_ids), revision being
+           the one to ask from next time (cf. facts-changed-v2).
+        """
+        def decode(result):
+            revision, facts, removed_ids = result
+            return (int(revision),
+                    [from_dbus_fact_json(fact) for fact in facts],
+                    [int(fact_id) for fact_id in removed_ids])
+        return self._call("GetChangesSince", (revision,), decode)
 
     def check_fact(self, fact, default_day=None):
         """Check Fact validity for inclusion in the storage.
@@ -192,10 +450,13 @@ class Storage(gobject.GObject):
             raise FactError("Missing start time")
         dbus_fact = to_dbus_fact_json(fact)
         dbus_day = to_dbus_date(default_day)
-        success, message = self.conn.CheckFact(dbus_fact, dbus_day)
-        if not success:
-            raise FactError(message)
-        return success, message
+
+        def decode(result):
+            success, message = result
+            if not success:
+                raise FactError(message)
+            return success, message
+        return self._call("CheckFact", (dbus_fact, dbus_day), decode, batch=False)
 
     def add_fact(self, fact, temporary_activity = False):
         """Add fact (Fact)."""
@@ -206,23 +467,32 @@ class Storage(gobject.GObject):
             fact.start_time = dt.datetime.now()
 
         dbus_fact = to_dbus_fact_json(fact)
-        new_id = self.conn.AddFactJSON(dbus_fact)
+        return self._write("AddFactJSON", (dbus_fact,))
+
+    def add_facts(self, facts):
+        """Add several facts (iterable of Fact) at once.
 
-        return new_id
+        Much faster than repeated add_fact calls, and the
+        `facts-changed` signal is emitted only once.
+        Every fact needs a start_time.
+        Return the list of new ids (0 means failure), in the same order.
+        """
+        dbus_facts = [to_dbus_fact_json(fact) for fact in facts]
+        return self._write("AddFactsJSON", (dbus_facts,), list)
 
     def stop_tracking(self, end_time = None):
         """Stop tracking current activity. end_time can be passed in if the
         activity should have other end time than the current moment"""
         end_time = timegm((end_time or dt.datetime.now()).timetuple())
-        return self.conn.StopTracking(end_time)
+        return self._write("StopTracking", (end_time,))
 
     def stop_or_restart_tracking(self):
         """Stop or restart tracking last activity."""
-        return self.conn.StopOrRestartTracking(0)
+        return self._write("StopOrRestartTracking", (0,))
 
     def remove_fact(self, fact_id):
         "delete fact from database"
-        self.conn.RemoveFact(fact_id)
+        return self._write("RemoveFact", (fact_id,))
 
     def update_fact(self, fact_id, fact, temporary_activity = False):
         """Update fact values. See add_fact for rules.
@@ -231,20 +501,20 @@ class Storage(gobject.GObject):
         from the fact dict that is returned by this function"""
 
         dbus_fact = to_dbus_fact_json(fact)
-        new_id = self.conn.UpdateFactJSON(fact_id, dbus_fact)
-
-        return new_id
+        return self._write("UpdateFactJSON", (fact_id, dbus_fact))
 
 
     def get_category_activities(self, category_id = None):
         """Return activities for category. If category is not specified, will
         return activities that have no category"""
         category_id = category_id or -1
-        return self._to_dict(('id', 'name', 'category_id', 'category'), self.conn.GetCategoryActivities(category_id))
+        return self._call("GetCategoryActivities", (category_id,),
+                          lambda result: self._to_dict(('id', 'name', 'category_id', 'category'),
+                                                       result))
 
     def get_category_id(self, category_name):
         """returns category id by name"""
-        return self.conn.GetCategoryId(category_name)
+        return self._call("GetCategoryId", (category_name,), int)
 
     def get_activity_by_name(self, activity, category_id = None, resurrect = True):
         """returns activity dict by name and optionally filtering by category.
@@ -252,26 +522,303 @@ class Storage(gobject.GObject):
            unless told otherwise in the resurrect param
         """
         category_id = category_id or 0
-        return self.conn.GetActivityByName(activity, category_id, resurrect)
+        return self._call("GetActivityByName", (activity, category_id, resurrect),
+                          batch=False)
 
     # category and activity manipulations (normally just via preferences)
     def remove_activity(self, id):
-        self.conn.RemoveActivity(id)
+        return self._write("RemoveActivity", (id,))
 
     def remove_category(self, id):
-        self.conn.RemoveCategory(id)
+        return self._write("RemoveCategory", (id,))
 
     def change_category(self, id, category_id):
-        return self.conn.ChangeCategory(id, category_id)
+        return self._write("ChangeCategory", (id, category_id))
 
     def update_activity(self, id, name, category_id):
-        return self.conn.UpdateActivity(id, name, category_id)
+        return self._write("UpdateActivity", (id, name, category_id))
 
     def add_activity(self, name, category_id = -1):
-        return self.conn.AddActivity(name, category_id)
+        return self._call("AddActivity", (name, category_id), batch=False)
 
     def update_category(self, id, name):
-        return self.conn.UpdateCategory(id, name)
+        return self._write("UpdateCategory", (id, name))
 
     def add_category(self, name):
-        return self.conn.AddCategory(name)
+        return self._call("AddCategory", (name,), batch=False)
+
+    def optimize_index(self, rebuild=False):
+        """Optimize the full text search index.
+
+        rebuild (bool): rebuild it from scratch instead.
+        """
+        return self._call("OptimizeIndex", (rebuild,), batch=False)
+
+    def check_daily_totals(self, rebuild=False):
+        """Check the daily totals rollup (cf. get_totals) against the facts.
+
+        rebuild (bool): rebuild it from scratch afterwards.
+        Return the number of wrong or missing rows found.
+        """
+        return self._call("CheckDailyTotals", (rebuild,), int, batch=False)
+
+
+class AsyncStorage(Storage):
+    """Storage not waiting for the service.
+
+    Same methods and signals as Storage, but the methods return
+    a concurrent.futures.Future right away. It is done (and its
+    callbacks called) from the main loop, once the reply has come:
+
+        storage.get_facts(day).add_done_callback(
+            lambda future: show(future.result()))
+
+    Within an asyncio event loop, asyncio.wrap_future makes it awaitable.
+    Batches work the same way: the futures are done after the block,
+    once the whole batch reply has come.
+    iter_facts is the exception, it still waits for each batch;
+    fetch_facts_batches calls back with them instead.
+    """
+
+    def _call(self, method, args=(), decode=None, batch=True):
+        if batch and self._batch is not None:
+            return super()._call(method, args, decode, batch)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        getattr(self.conn, method)(*args,
+                                   reply_handler=lambda *result: _resolve(future, decode, *result),
+                                   error_handler=future.set_exception)
+        return future
+
+    def _run_batch(self, calls):
+        if not calls:
+            return
+        requests = [(call.method, list(call.args)) for call in calls]
+
+        def on_error(error):
+            if error.get_dbus_name() != "org.freedesktop.DBus.Error.UnknownMethod":
+                for call in calls:
+                    call.set_exception(error)
+                return
+            # older service, one call at a time
+            for call in calls:
+                getattr(self.conn, call.method)(
+                    *call.args,
+                    reply_handler=lambda *result, call=call: _resolve(call, call._decode, *result),
+                    error_handler=call.set_exception)
+
+        self.conn.Batch(dumps(requests),
+                        reply_handler=lambda replies: self._resolve_batch(calls, replies),
+                        error_handler=on_error)
+
+    def _get_cached_facts(self, range):
+        facts = self._facts_cache.get(range)
+        if facts is not None:
+            future = Future()
+            future.set_result(facts)
+            return future
+        # same query as without the cache, then kept for next time
+        generation = self._facts_cache.generation
+        future = self._call("GetFactsBatch", (to_dbus_range(range), ""), from_dbus_facts_batch)
+
+        def keep(future):
+            if not future.exception():
+                self._facts_cache.store(range, future.result(), generation)
+        future.add_done_callback(keep)
+        return future
+
+    def fetch_facts_batches(self, start, end=None, search_terms="", batch_size=500, *, callback):
+        """Go through the facts of get_facts(start, end, search_terms),
+           batch_size at a time, in chronological order (cf. iter_facts).
+           callback(facts) is called with each batch (a list of Fact),
+           as they come. It can return False to stop there.
+           Return a Future, done (with the number of facts passed to callback)
+           after the last batch, once the service cursor is closed.
+        """
+        done = Future()
+        done.set_running_or_notify_cancel()
+        count = [0]
+
+        def close(cursor, error=None):
+            def on_closed(future):
+                if error or future.exception():
+                    done.set_exception(error or future.exception())
+                else:
+                    done.set_result(count[0])
+            self._call("CloseCursor", (cursor,), batch=False).add_done_callback(on_closed)
+
+        def fetch(cursor):
+            self._call("FetchFacts", (cursor, batch_size), _from_dbus_facts_json,
+                       batch=False).add_done_callback(lambda future: on_facts(cursor, future))
+
+        def on_facts(cursor, future):
+            if future.exception():
+                close(cursor, future.exception())
+                return
+            facts = future.result()
+            if not facts:
+                # the service closes the cursor at the end, this is a no-op
+                close(cursor)
+                return
+            count[0] += len(facts)
+            try:
+                more = callback(facts) is not False
+            except Exception as error:
+                close(cursor, error)
+                return
+            if more:
+                fetch(cursor)
+            else:
+                close(cursor)
+
+        def on_open(future):
+            if future.exception():
+                done.set_exception(future.exception())
+            else:
+                fetch(future.result())
+
+        range = dt.Range.from_start_end(start, end)
+        self._call("OpenFactsCursor", (to_dbus_range(range), search_terms),
+                   batch=False).add_done_callback(on_open)
+        return done
+
+
+class DirectStorage(object):
+    """Storage reading the database file in-process, writing through D-Bus.
+
+    Same methods as Storage. The get_* ones query a read-only
+    db.Storage, without the service round trip (nor the service
+    start, if it was not running). Anything else (writes, signals)
+    goes to a Storage, connected on first use, so the service
+    remains the only writer.
+
+    database_dir: as for db.Storage (None: the default location).
+    Raise sqlite3.Error if the database cannot be read
+    (e.g. missing, or not upgraded yet; cf. open_storage).
+    """
+
+    def __init__(self, database_dir=None):
+        # work around cyclic imports (db needs the configuration, which needs Storage)
+        from hamster.storage import db
+
+        self._db = db.Storage(unsorted_localized="", database_dir=database_dir,
+                              read_only=True)
+        self._dbus_storage = None
+        self._batch = False
+
+    @property
+    def dbus_storage(self):
+        """The Storage used for the writes."""
+        if self._dbus_storage is None:
+            self._dbus_storage = Storage()
+        return self._dbus_storage
+
+    def __getattr__(self, name):
+        # only called for what is not defined here
+        return getattr(self.dbus_storage, name)
+
+    def _read(self, method, *args, convert=None):
+        """Return convert(self._db.method(*args)).
+
+        Within a batch(), as a BatchCall already done.
+        """
+        result = getattr(self._db, method)(*args)
+        if convert:
+            result = convert(result)
+        if self._batch:
+            call = BatchCall(method, args, None)
+            call.set_result(result)
+            return call
+        return result
+
+    @contextmanager
+    def batch(self):
+        """Same as Storage.batch(). The calls are made right away."""
+        if self._batch:
+            yield
+            return
+        self._batch = True
+        try:
+            yield
+        finally:
+            self._batch = False
+
+    def get_todays_facts(self):
+        return self._read("get_todays_facts")
+
+    def get_facts(self, start, end=None, search_terms="", ranked=False, limit=None, offset=0):
+        return self._read("get_facts", start, end, search_terms, ranked, limit, offset)
+
+    def get_totals(self, start, end=None, group_by="category", search_terms=""):
+        return self._read("get_totals", start, end, group_by, search_terms)
+
+    def iter_facts(self, start, end=None, search_terms="", batch_size=500):
+        cursor = self._db.open_facts_cursor(start, end, search_terms)
+        try:
+            while True:
+                facts = self._db.fetch_facts(cursor, batch_size)
+                if not facts:
+                    break
+                yield from facts
+        finally:
+            self._db.close_cursor(cursor)
+
+    def get_activities(self, search=""):
+        return self._read("get_activities", search,
+                          convert=lambda rows: [{'name': row['name'],
+                                                 'category': row['category'] or ''}
+                                                for row in rows])
+
+    def get_categories(self):
+        return self._read("get_categories",
+                          convert=lambda rows: [{'id': row['id'], 'name': row['name']}
+                                                for row in rows])
+
+    def get_tags(self, only_autocomplete=False):
+        return self._read("get_tags", only_autocomplete,
+                          convert=lambda rows: [{'id': row['id'],
+                                                 'name': row['name'],
+                                                 'autocomplete': row['autocomplete'] not in (0, "false")}
+                                                for row in rows])
+
+    def get_fact(self, id):
+        return self._read("get_fact", id)
+
+    def get_changes_since(self, revision=0):
+        return self._read("get_changes_since", revision)
+
+    def get_category_activities(self, category_id=None):
+        return self._read("get_category_activities", category_id or -1,
+                          convert=lambda rows: [{'id': row['id'],
+                                                 'name': row['name'],
+                                                 'category_id': row['category_id'],
+                                                 'category': row['category'] or ''}
+                                                for row in rows])
+
+    def get_category_id(self, category_name):
+        return self._read("get_category_id", category_name, convert=int)
+
+
+def open_storage(mode="dbus", database_dir=None):
+    """Return a storage client.
+
+    mode (str):
+        "dbus": Storage, everything through the service.
+        "async": AsyncStorage, the same without waiting.
+        "direct": DirectStorage, reading the database in-process
+                  (database_dir, cf. db.Storage), much faster to start,
+                  e.g. for the command line. Falls back to "dbus"
+                  if the database cannot be read directly.
+    """
+    if mode == "dbus":
+        return Storage()
+    elif mode == "async":
+        return AsyncStorage()
+    elif mode == "direct":
+        try:
+            return DirectStorage(database_dir)
+        except sqlite.Error as error:
+            logger.warning("cannot read the database directly ({}), using D-Bus"
+                           .format(error))
+            return Storage()
+    raise ValueError("unknown storage mode: {}".format(mode))
@@ -140,6 +140,9 @@ class GSettingsStore(gobject.GObject, Singleton):
     def __init__(self):
         gobject.GObject.__init__(self)
         self._settings = gio.Settings(schema_id='org.gnome.Hamster')
+        self._day_start = None  # cached, reset when the setting changes
+        self._settings.connect("changed", self._key_changed)
+        self.connect("changed", self._on_changed)
 
     def _key_changed(self, client, key, data=None):
         """
@@ -148,6 +151,10 @@ class GSettingsStore(gobject.GObject, Singleton):
         value = self._settings.get_value(key)
         self.emit('changed', key, value)
 
+    def _on_changed(self, store, key, value):
+        if key == "day-start-minutes":
+            self._day_start = None
+
     def get(self, key, default=None):
         """
         Returns the value of the key or the default value if the key is
@@ -175,10 +182,15 @@ class GSettingsStore(gobject.GObject, Singleton):
 
     @property
     def day_start(self):
-        """Start of the hamster day."""
-        day_start_minutes = self.get("day-start-minutes")
-        hours, minutes = divmod(day_start_minutes, 60)
-        return dt.time(hours, minutes)
+        """Start of the hamster day.
+
+        Needed for every hamster day computation, hence cached.
+        """
+        if self._day_start is None:
+            day_start_minutes = self.get("day-start-minutes")
+            hours, minutes = divmod(day_start_minutes, 60)
+            self._day_start = dt.time(hours, minutes)
+        return self._day_start
 
 
 conf = GSettingsStore()
@@ -14,8 +14,10 @@ logger = logging.getLogger(__name__)   # noqa: E402
 
 import datetime as pdt  # standard datetime
 import re
+import threading
 
 from collections import namedtuple
+from contextlib import contextmanager
 from textwrap import dedent
 from functools import lru_cache
 
@@ -28,6 +30,15 @@ class time:  # predeclaration for return type annotations
     pass
 
 
+def _whole_minutes(delta):
+    """Whether delta is a timedelta of whole minutes.
+
+    Adding such a delta to a datetime keeps it rounded to the minute.
+    """
+    return (isinstance(delta, pdt.timedelta)
+            and not (delta.seconds % 60 or delta.microseconds))
+
+
 class date(pdt.date):
     """Hamster date.
 
@@ -42,17 +53,24 @@ class date(pdt.date):
         return pdt.date.__new__(cls, year, month, day)
 
     def __add__(self, other):
+        res = pdt.date.__add__(self, other)
+        if type(res) is type(self):
+            # python >= 3.8, no conversion needed
+            return res
         # python date.__add__ was not type stable prior to 3.8
         return self.from_pdt(self.to_pdt() + other)
 
     __radd__ = __add__
 
     def __sub__(self, other):
-        # python date.__sub__ was not type stable prior to 3.8
         if isinstance(other, pdt.timedelta):
+            res = pdt.date.__sub__(self, other)
+            if type(res) is type(self):
+                return res
+            # python date.__sub__ was not type stable prior to 3.8
             return self.from_pdt(self.to_pdt() - other)
         elif isinstance(other, pdt.date):
-            return timedelta.from_pdt(self.to_pdt() - other)
+            return timedelta.from_pdt(pdt.date.__sub__(self, other))
         else:
             return NotImplemented
 
@@ -105,16 +123,61 @@ class hday(date):
     @property
     def end(self) -> datetime:
         """Day end."""
-        return datetime.from_day_time(self + timedelta(days=1), self.start_time())
+        start_time = self.start_time()
+        return datetime.from_day_time(self + timedelta(days=1), start_time, start_time)
 
     @property
     def start(self) -> datetime:
         """Day start."""
-        return datetime.from_day_time(self, self.start_time())
+        start_time = self.start_time()
+        return datetime.from_day_time(self, start_time, start_time)
+
+    @classmethod
+    def from_datetimes(cls, datetimes):
+        """Return the list of the days the datetimes belong to.
+
+        None values give None.
+        The day start is looked up once for the whole batch,
+        and days are built once for each civil date.
+        """
+        day_start = cls.start_time()
+        days = {}  # (civil date, early morning): hday
+        res = []
+        for t in datetimes:
+            if t is None:
+                res.append(None)
+                continue
+            key = (t.year, t.month, t.day, t.time() < day_start)
+            day = days.get(key)
+            if day is None:
+                day = days[key] = t.hday(day_start)
+            res.append(day)
+        return res
+
+    # day start handed over to the current thread (cf. fixed_start_time)
+    _local = threading.local()
+
+    @classmethod
+    @contextmanager
+    def fixed_start_time(cls, start_time):
+        """Use start_time as day start in the current thread, within the context.
+
+        For worker threads, which must not read the settings:
+        the day start is read on the main thread and handed over.
+        """
+        previous = getattr(cls._local, "start_time", None)
+        cls._local.start_time = start_time
+        try:
+            yield
+        finally:
+            cls._local.start_time = previous
 
     @classmethod
     def start_time(cls) -> time:
         """Day start time."""
+        start_time = getattr(cls._local, "start_time", None)
+        if start_time is not None:
+            return start_time
         # work around cyclic imports
         from hamster.lib.configuration import conf
         return conf.day_start
@@ -222,12 +285,16 @@ class datetime(pdt.datetime):
                 second=0, microsecond=0,
                 tzinfo=None, **kwargs):
             # round down to zero seconds and microseconds
+            # (positional arguments are faster, this is called a lot)
             return pdt.datetime.__new__(cls, year, month, day,
-                                        hour=hour, minute=minute,
-                                        second=0, microsecond=0,
-                                        tzinfo=None, **kwargs)
+                                        hour, minute, 0, 0, None, **kwargs)
 
     def __add__(self, other):
+        if _whole_minutes(other):
+            # already rounded, and python >= 3.8 keeps the type
+            res = pdt.datetime.__add__(self, other)
+            if type(res) is datetime:
+                return res
         # python datetime.__add__ was not type stable prior to 3.8
         return datetime.from_pdt(self.to_pdt() + other)
 
@@ -244,11 +311,15 @@ class datetime(pdt.datetime):
     __radd__ = __add__
 
     def __sub__(self, other):
-        # python datetime.__sub__ was not type stable prior to 3.8
         if isinstance(other, timedelta):
+            if _whole_minutes(other):
+                res = pdt.datetime.__sub__(self, other)
+                if type(res) is datetime:
+                    return res
+            # python datetime.__sub__ was not type stable prior to 3.8
             return datetime.from_pdt(self.to_pdt() - other)
         elif isinstance(other, datetime):
-            return timedelta.from_pdt(self.to_pdt() - other)
+            return timedelta.from_pdt(pdt.datetime.__sub__(self, other))
         else:
             return NotImplemented
 
@@ -288,17 +359,19 @@ class datetime(pdt.datetime):
                 return None
 
     # not a property, to match other extractions such as .date() or .time()
-    def hday(self) -> hday:
+    def hday(self, day_start=None) -> hday:
         """Return the day belonged to.
 
         The hamster day start is taken into account.
-        """
 
-        # work around cyclic imports
-        from hamster.lib.configuration import conf
+        day_start (time): day start, if already known (default: hday.start_time()).
+                          For many datetimes, see hday.from_datetimes.
+        """
+        if day_start is None:
+            day_start = hday.start_time()
 
         _day = hday(self.year, self.month, self.day)
-        if self.time() < conf.day_start:
+        if self.time() < day_start:
             # early morning, between midnight and day_start
             # => the hamster day is the previous civil day
             _day -= timedelta(days=1)
@@ -307,16 +380,17 @@ class datetime(pdt.datetime):
         return _day
 
     @classmethod
-    def from_day_time(cls, d: hday, t: time):
+    def from_day_time(cls, d: hday, t: time, day_start=None):
         """Return a datetime with time t belonging to day.
 
         The hamster day start is taken into account.
-        """
 
-        # work around cyclic imports
-        from hamster.lib.configuration import conf
+        day_start (time): day start, if already known (default: hday.start_time()).
+        """
+        if day_start is None:
+            day_start = hday.start_time()
 
-        if t < conf.day_start:
+        if t < day_start:
             # early morning, between midnight and day_start
             # => the hamster day is the previous civil day
             civil_date = d + timedelta(days=1)
@@ -503,20 +577,7 @@ class Range():
             default_day = hday.today()
 
         assert position in ("exact", "head", "tail"), "position unknown: '{}'".format(position)
-        if position == "exact":
-            p = "^{}$".format(cls.pattern())
-        elif position == "head":
-            # ( )?: require either only the range (no rest),
-            #       or separator between range and rest,
-            #       to avoid matching 10.00@cat
-            # .*? so rest is as little as possible
-            p = "^{}( {}(?P<rest>.*?) )?$".format(cls.pattern(), separator)
-        elif position == "tail":
-            p = "^( (?P<rest>.*?){} )? {}$".format(separator, cls.pattern())
-        # No need to compile, recent patterns are cached by re.
-        # DOTALL, so rest may contain newlines
-        # (important for multiline descriptions)
-        m = re.search(p, text, flags=re.VERBOSE | re.DOTALL)
+        m = cls._compiled(position, separator).search(text)
 
         if not m:
             return Range(None, None), text
@@ -559,6 +620,25 @@ class Range():
 
         return Range(start, end), rest
 
+    @classmethod
+    @lru_cache()
+    def _compiled(cls, position, separator):
+        """Return the compiled parse pattern for this position and separator."""
+        if position == "exact":
+            p = "^{}$".format(cls.pattern())
+        elif position == "head":
+            # ( )?: require either only the range (no rest),
+            #       or separator between range and rest,
+            #       to avoid matching 10.00@cat
+            # .*? so rest is as little as possible
+            p = "^{}( {}(?P<rest>.*?) )?$".format(cls.pattern(), separator)
+        elif position == "tail":
+            p = "^( (?P<rest>.*?){} )? {}$".format(separator, cls.pattern())
+        # Compiled once; the re cache is small and the pattern is large.
+        # DOTALL, so rest may contain newlines
+        # (important for multiline descriptions)
+        return re.compile(p, flags=re.VERBOSE | re.DOTALL)
+
     @classmethod
     @lru_cache()
     def pattern(cls):
@@ -655,35 +735,36 @@ class timedelta(pdt.timedelta):
     def __new__(cls, days=0, seconds=0, microseconds=0,
                 milliseconds=0, minutes=0, hours=0, weeks=0):
         # Tempted to round down ? Resist. Not so useful + issues down the line.
-        return pdt.timedelta.__new__(cls,
-                                     days=days,
-                                     seconds=seconds,
-                                     microseconds=microseconds,
-                                     milliseconds=milliseconds,
-                                     minutes=minutes,
-                                     hours=hours,
-                                     weeks=weeks)
-
-    # timedelta subclassing is not type stable yet
+        return pdt.timedelta.__new__(cls, days, seconds, microseconds,
+                                     milliseconds, minutes, hours, weeks)
+
+    # timedelta subclassing is not type stable yet.
+    # The python operations accept subclasses though,
+    # only the result needs a conversion.
     def __add__(self, other):
-        return timedelta.from_pdt(self.to_pdt() + other)
+        res = pdt.timedelta.__add__(self, other)
+        if res is NotImplemented:
+            return res
+        return timedelta.from_pdt(res)
 
     __radd__ = __add__
 
     def __sub__(self, other):
-        return timedelta.from_pdt(self.to_pdt() - other)
+        res = pdt.timedelta.__sub__(self, other)
+        if res is NotImplemented:
+            return res
+        return timedelta.from_pdt(res)
 
     def __neg__(self):
-        return timedelta.from_pdt(-self.to_pdt())
+        return timedelta.from_pdt(pdt.timedelta.__neg__(self))
 
     @classmethod
     def from_pdt(cls, delta):
         """Convert python timedelta to hamster timedelta."""
 
         # Only days, seconds and microseconds are stored internally
-        return cls(days=delta.days,
-                   seconds=delta.seconds,
-                   microseconds=delta.microseconds)
+        # (already normalized, no need to go through __new__ keywords)
+        return pdt.timedelta.__new__(cls, delta.days, delta.seconds, delta.microseconds)
 
     def to_pdt(self):
         """Convert to python timedelta."""
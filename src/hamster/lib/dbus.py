@@ -17,12 +17,16 @@ from hamster.lib.fact import Fact
 # dates
 
 def from_dbus_date(dbus_date):
-    """Convert D-Bus timestamp (seconds since epoch) to date."""
-    return dt.date.fromtimestamp(dbus_date) if dbus_date else None
+    """Convert D-Bus timestamp (seconds since epoch) to date.
+
+    The timestamp is the UTC midnight of the date (cf. to_dbus_date),
+    whatever the local timezone.
+    """
+    return dt.date.fromordinal(_EPOCH_ORDINAL + dbus_date // 86400) if dbus_date else None
 
 
 def to_dbus_date(date):
-    """Convert date to D-Bus timestamp (seconds since epoch)."""
+    """Convert date to D-Bus timestamp (seconds since epoch, UTC midnight)."""
     return timegm(date.timetuple()) if date else 0
 
 
@@ -56,6 +60,112 @@ def to_dbus_fact_json(fact):
     return dumps(d)
 
 
+"""
+facts batch signature: parallel arrays, one item per fact,
+strings being interned in tables.
+    ai  ids
+    ai  start times, in minutes since epoch (local time)
+    ai  end times, in minutes since epoch, or NO_END for on-going facts
+    ai  activity ids
+    as  activity names table
+    ai  activity name indices, in the table
+    as  category names table
+    ai  category name indices, in the table
+    as  tag names table
+    ai  number of tags of each fact
+    ai  tag name indices, in the table, for all the facts one after the other
+    as  descriptions
+"""
+facts_batch_signature = '(aiaiaiaiasaiasaiasaiaias)'
+
+NO_END = -2 ** 31
+_EPOCH_ORDINAL = dt.date(1970, 1, 1).toordinal()
+
+
+def _interned(values, table, indices):
+    """Return the indices of values, adding new ones to table.
+
+    indices ({value: index}): used to look up and record table indices.
+    """
+    res = []
+    for value in values:
+        index = indices.get(value)
+        if index is None:
+            index = indices[value] = len(table)
+            table.append(value)
+        res.append(index)
+    return res
+
+
+def from_dbus_facts_batch(batch):
+    """Convert D-Bus facts batch to a list of Fact."""
+    (ids, starts, ends, activity_ids, activities, activity_indices,
+     categories, category_indices, tags, tag_counts, tag_indices,
+     descriptions) = batch
+    activities = [str(name) for name in activities]
+    categories = [str(name) for name in categories]
+    tags = [str(name) for name in tags]
+
+    # the end of a fact is often the start of the next one
+    datetimes = {}
+
+    def to_datetime(minutes):
+        res = datetimes.get(minutes)
+        if res is None:
+            days, minutes_of_day = divmod(minutes, 24 * 60)
+            date = dt.date.fromordinal(_EPOCH_ORDINAL + days)
+            res = datetimes[minutes] = dt.datetime(date.year, date.month, date.day,
+                                                   *divmod(minutes_of_day, 60))
+        return res
+
+    facts = []
+    tag_position = 0
+    for i, fact_id in enumerate(ids):
+        tag_count = tag_counts[i]
+        fact_tags = [tags[j] for j in tag_indices[tag_position:tag_position + tag_count]]
+        tag_position += tag_count
+        end = ends[i]
+        facts.append(Fact(activity=activities[activity_indices[i]],
+                          category=categories[category_indices[i]],
+                          description=str(descriptions[i]),
+                          tags=fact_tags,
+                          start_time=to_datetime(int(starts[i])),
+                          end_time=to_datetime(int(end)) if end != NO_END else None,
+                          id=int(fact_id),
+                          activity_id=int(activity_ids[i])))
+    return facts
+
+
+def to_dbus_facts_batch(facts):
+    """Convert a list of Fact to a D-Bus facts batch.
+
+    Times are rounded to the minute.
+    """
+    def to_minutes(t):
+        return (t.toordinal() - _EPOCH_ORDINAL) * 24 * 60 + t.hour * 60 + t.minute
+
+    activities, categories, tags = [], [], []
+    activity_indices = _interned((fact.activity for fact in facts), activities, {})
+    category_indices = _interned((fact.category for fact in facts), categories, {})
+    tag_indices = []
+    tag_table = {}
+    for fact in facts:
+        tag_indices += _interned(fact.tags, tags, tag_table)
+    return (dbus.Array([fact.id or 0 for fact in facts], signature='i'),
+            dbus.Array([to_minutes(fact.range.start) for fact in facts], signature='i'),
+            dbus.Array([to_minutes(fact.range.end) if fact.range.end else NO_END
+                        for fact in facts], signature='i'),
+            dbus.Array([fact.activity_id or 0 for fact in facts], signature='i'),
+            dbus.Array(activities, signature='s'),
+            dbus.Array(activity_indices, signature='i'),
+            dbus.Array(categories, signature='s'),
+            dbus.Array(category_indices, signature='i'),
+            dbus.Array(tags, signature='s'),
+            dbus.Array([len(fact.tags) for fact in facts], signature='i'),
+            dbus.Array(tag_indices, signature='i'),
+            dbus.Array([fact.description or '' for fact in facts], signature='s'))
+
+
 # Range
 
 def from_dbus_range(dbus_range):
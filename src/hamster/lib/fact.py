@@ -11,8 +11,6 @@ logger = logging.getLogger(__name__)   # noqa: E402
 
 import calendar
 
-from copy import deepcopy
-
 from hamster.lib import datetime as dt
 from hamster.lib.parsing import parse_fact, get_tags_from_description
 
@@ -22,6 +20,10 @@ class FactError(Exception):
 
 
 class Fact(object):
+    # many facts can be loaded at once (e.g. a year in the overview)
+    __slots__ = ('_activity', '_category', '_description', 'tags', 'range',
+                 'id', 'activity_id')
+
     def __init__(self, activity="", category=None, description=None, tags=None,
                  range=None, start=None, end=None, start_time=None, end_time=None,
                  id=None, activity_id=None):
@@ -102,10 +104,20 @@ class Fact(object):
     def copy(self, **kwds):
         """Return an independent copy, with overrides as keyword arguments.
 
-        By default, only copy user-visible attributes.
-        To also copy the id, use fact.copy(id=fact.id)
+        The id is copied too (override it with id=None for a new fact).
         """
-        fact = deepcopy(self)
+        fact = object.__new__(type(self))
+        # strings and datetimes are immutable, they can be shared
+        fact._activity = self._activity
+        fact._category = self._category
+        fact._description = self._description
+        fact.tags = list(self.tags)
+        fact.range = dt.Range(self.range.start, self.range.end)
+        fact.id = self.id
+        fact.activity_id = self.activity_id
+        if hasattr(self, "__dict__"):
+            # subclass attributes
+            fact.__dict__.update(self.__dict__)
         fact._set(**kwds)
         return fact
 
@@ -0,0 +1,138 @@
+# This file is part of Hamster
+# Copyright (c) The Hamster time tracker developers
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+"""Client side cache of the facts, per hamster day."""
+
+
+import logging
+logger = logging.getLogger(__name__)   # noqa: E402
+
+from hamster.lib import datetime as dt
+
+
+def fact_days(start_time, end_time):
+    """First and last hamster days whose get_facts include such a fact.
+
+    These are the days overlapping the fact (a fact starting right at
+    a day start also touches the end of the previous day), but no more
+    than 30 days after its start (on-going facts included).
+    """
+    first_day = start_time.hday()
+    if start_time == first_day.start:
+        first_day -= dt.timedelta(days=1)
+    last_day = (start_time + dt.timedelta(days=30)).hday()
+    if end_time is not None:
+        last_day = min(last_day, end_time.hday())
+    return first_day, last_day
+
+
+def _days(first_day, last_day):
+    """List of the days from first_day to last_day, included."""
+    return [first_day + dt.timedelta(days=i)
+            for i in range((last_day - first_day).days + 1)]
+
+
+class FactCache():
+    """Facts of each hamster day, as returned by get_facts(day).
+
+    The facts of several days are the union of the facts of each day,
+    so overlapping queries share the days already known,
+    and only the missing ones are fetched.
+
+    Facts of a day are the ones overlapping it, including those
+    started up to 30 days before (same as the storage get_facts).
+    """
+
+    def __init__(self):
+        self._days = {}  # hday: list of facts
+        self._day_start = None
+        self.hits = 0  # days found in the cache
+        self.misses = 0  # days fetched
+        # changes with each invalidation (cf. store)
+        self.generation = 0
+
+    def _whole_days(self, range):
+        """Return the first and last days of range, or None if it is not made of whole days."""
+        if range.start is None or range.end is None:
+            return None
+        if dt.hday.start_time() != self._day_start:
+            # days are not the same anymore
+            self.invalidate()
+            self._day_start = dt.hday.start_time()
+        first_day = range.start.hday()
+        last_day = range.end.hday()
+        if range.end == last_day.start:
+            # hday.end is the start of the next day
+            last_day -= dt.timedelta(days=1)
+        if range.start != first_day.start or range.end != last_day.end:
+            return None
+        return first_day, last_day
+
+    def get(self, range, fetch=None):
+        """Return the facts of range, or None if it is not made of whole days.
+
+        fetch (function): fetch(first_day, last_day) returns the facts of these days
+                          (a list, in the get_facts order).
+                          None: only answer from the cache,
+                          return None if some days are missing.
+        Facts are copies, they can be modified freely.
+        """
+        whole_days = self._whole_days(range)
+        if whole_days is None:
+            return None
+
+        days = _days(*whole_days)
+        missing = [day for day in days if day not in self._days]
+        if missing and fetch is None:
+            return None
+        self.hits += len(days) - len(missing)
+        self.misses += len(missing)
+        # fetch contiguous missing days at once
+        while missing:
+            run_start = missing.pop(0)
+            run_end = run_start
+            while missing and missing[0] == run_end + dt.timedelta(days=1):
+                run_end = missing.pop(0)
+            self._store(run_start, run_end, fetch(run_start, run_end))
+
+        facts = {}
+        for day in days:
+            for fact in self._days[day]:
+                facts[fact.id] = fact
+        return [fact.copy() for fact in sorted(facts.values(),
+                                               key=lambda fact: (fact.start_time, fact.id))]
+
+    def store(self, range, facts, generation):
+        """Keep the facts of range, as returned by get_facts(range).
+
+        generation (int): self.generation when the facts were asked for;
+                          they are ignored if they might be outdated since.
+        """
+        whole_days = self._whole_days(range)
+        if whole_days is None or generation != self.generation:
+            return
+        self.misses += len(_days(*whole_days))
+        # the caller keeps the originals
+        self._store(*whole_days, [fact.copy() for fact in facts])
+
+    def invalidate(self, first_day=None, last_day=None):
+        """Forget the facts of these days (default: all of them)."""
+        self.generation += 1
+        if first_day is None and last_day is None:
+            self._days = {}
+            return
+        for day in list(self._days):
+            if (first_day is None or day >= first_day) and (last_day is None or day <= last_day):
+                del self._days[day]
+
+    def _store(self, first_day, last_day, facts):
+        """Dispatch the facts of the first_day to last_day range in each day."""
+        for day in _days(first_day, last_day):
+            self._days[day] = []
+        for fact in facts:
+            fact_first_day, fact_last_day = fact_days(fact.start_time, fact.end_time)
+            for day in _days(max(first_day, fact_first_day),
+                             min(last_day, fact_last_day)):
+                self._days[day].append(fact)
@@ -0,0 +1,261 @@
+# This file is part of Hamster
+# Copyright (c) The Hamster time tracker developers
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+"""Facts as columns, for totals and grouping over many facts.
+
+Times are in minutes since epoch (local time, same as the D-Bus facts batch),
+names are coded as indices in name tables.
+Uses numpy if available; otherwise plain lists, same results, only slower.
+"""
+
+
+import logging
+logger = logging.getLogger(__name__)   # noqa: E402
+
+from hamster.lib import datetime as dt
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+GROUPS = ("activity", "category", "tag", "day")
+
+_DAY_MINUTES = 24 * 60
+_EPOCH_ORDINAL = dt.date(1970, 1, 1).toordinal()
+
+
+def to_minutes(t):
+    """Minutes since epoch of datetime t (local time)."""
+    return (t.toordinal() - _EPOCH_ORDINAL) * _DAY_MINUTES + t.hour * 60 + t.minute
+
+
+def from_minutes(minutes):
+    """Datetime of minutes since epoch (local time)."""
+    days, minutes_of_day = divmod(minutes, _DAY_MINUTES)
+    date = dt.date.fromordinal(_EPOCH_ORDINAL + days)
+    return dt.datetime(date.year, date.month, date.day, *divmod(minutes_of_day, 60))
+
+
+def _coded(values, table, codes):
+    """Return the codes of values, adding new values to table.
+
+    codes ({value: code}): used to look up and record table indices.
+    """
+    res = []
+    for value in values:
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(table)
+            table.append(value)
+        res.append(code)
+    return res
+
+
+class FactFrame():
+    """Columns of a list of facts.
+
+    Per fact, in the facts order:
+        starts, ends: minutes since epoch. On-going facts end at now.
+        activity_codes, category_codes: indices in activities, categories.
+    Per (fact, tag) pair:
+        tag_facts: fact positions.
+        tag_codes: indices in tags.
+
+    Columns are numpy arrays if numpy is available (and use_numpy is not False),
+    lists otherwise.
+    """
+
+    def __init__(self, starts, ends, activity_codes, category_codes,
+                 tag_facts, tag_codes, activities, categories, tags, use_numpy=None):
+        self.use_numpy = np is not None if use_numpy is None else use_numpy
+        if self.use_numpy and np is None:
+            raise ImportError("numpy is not available")
+        column = (lambda values: np.array(values, dtype=np.int64)) if self.use_numpy else list
+        self.starts = column(starts)
+        self.ends = column(ends)
+        self.activity_codes = column(activity_codes)
+        self.category_codes = column(category_codes)
+        self.tag_facts = column(tag_facts)
+        self.tag_codes = column(tag_codes)
+        self.activities = activities
+        self.categories = categories
+        self.tags = tags
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_facts(cls, facts, now=None, use_numpy=None):
+        """Frame of a list of Fact.
+
+        now (dt.datetime): end of the on-going facts (default: now).
+        """
+        return cls._from_columns([fact.range.start for fact in facts],
+                                 [fact.range.end for fact in facts],
+                                 [fact.activity for fact in facts],
+                                 [fact.category for fact in facts],
+                                 [fact.tags for fact in facts],
+                                 now=now, use_numpy=use_numpy)
+
+    @classmethod
+    def from_rows(cls, rows, now=None, use_numpy=None):
+        """Frame of storage fact rows (with the tags column, cf. db.Storage.__get_facts).
+
+        Same as from_facts(facts), without building the facts.
+        """
+        # work around cyclic imports
+        from hamster.storage.db import split_tags
+
+        return cls._from_columns([row["start_time"] for row in rows],
+                                 [row["end_time"] for row in rows],
+                                 [row["name"] for row in rows],
+                                 [row["category"] for row in rows],
+                                 [split_tags(row["tags"]) for row in rows],
+                                 now=now, use_numpy=use_numpy)
+
+    @classmethod
+    def _from_columns(cls, starts, ends, activities, categories, tags, now, use_numpy):
+        now_minutes = to_minutes(now or dt.datetime.now())
+        # the end of a fact is often the start of the next one
+        minutes = {}
+
+        def cached_minutes(t):
+            res = minutes.get(t)
+            if res is None:
+                res = minutes[t] = to_minutes(t)
+            return res
+
+        activity_table, category_table, tag_table = [], [], []
+        tag_facts, tag_codes = [], []
+        codes = {}
+        for i, fact_tags in enumerate(tags):
+            tag_facts += [i] * len(fact_tags)
+            tag_codes += _coded(fact_tags, tag_table, codes)
+        return cls([cached_minutes(start) for start in starts],
+                   [cached_minutes(end) if end else now_minutes for end in ends],
+                   _coded(activities, activity_table, {}),
+                   _coded(categories, category_table, {}),
+                   tag_facts, tag_codes,
+                   activity_table, category_table, tag_table,
+                   use_numpy=use_numpy)
+
+    def durations(self):
+        """Durations of the facts, in minutes."""
+        if self.use_numpy:
+            return self.ends - self.starts
+        return [end - start for start, end in zip(self.starts, self.ends)]
+
+    def day_ordinals(self):
+        """Ordinals of the hamster days of the facts (cf. Fact.date).
+
+        The day start is taken into account.
+        """
+        day_start = dt.hday.start_time()
+        shift = day_start.hour * 60 + day_start.minute
+        if self.use_numpy:
+            return (self.starts - shift) // _DAY_MINUTES + _EPOCH_ORDINAL
+        return [(start - shift) // _DAY_MINUTES + _EPOCH_ORDINAL for start in self.starts]
+
+    def hdays(self):
+        """List of the hamster days of the facts (cf. Fact.date)."""
+        days = {}
+        res = []
+        for ordinal in self.day_ordinals():
+            day = days.get(ordinal)
+            if day is None:
+                day = days[ordinal] = dt.hday.fromordinal(int(ordinal))
+            res.append(day)
+        return res
+
+    def totals(self, group_by="category"):
+        """Time spent per activity, category, tag or hamster day.
+
+        Same as storage get_totals: durations are counted in full
+        in the day the facts start, facts are counted in each of their tags.
+
+        Return a list of (name or dt.hday, dt.timedelta), longest first.
+        """
+        assert group_by in GROUPS, "unknown group: '{}'".format(group_by)
+        durations = self.durations()
+        if group_by == "day":
+            ordinals = self.day_ordinals()
+            if self.use_numpy:
+                if len(ordinals):
+                    first = int(ordinals.min())
+                    sums = np.bincount(ordinals - first, weights=durations)
+                else:
+                    first, sums = 0, []
+                keys = [dt.hday.fromordinal(first + code) for code in range(len(sums))]
+                minutes = self._present(sums, np.bincount(ordinals - first) if len(ordinals) else [])
+            else:
+                sums = {}
+                for ordinal, duration in zip(ordinals, durations):
+                    sums[ordinal] = sums.get(ordinal, 0) + duration
+                keys = [dt.hday.fromordinal(ordinal) for ordinal in sums]
+                minutes = list(sums.values())
+        else:
+            if group_by == "tag":
+                keys, codes = self.tags, self.tag_codes
+                if self.use_numpy:
+                    durations = durations[self.tag_facts]
+                else:
+                    durations = [durations[i] for i in self.tag_facts]
+            elif group_by == "activity":
+                keys, codes = self.activities, self.activity_codes
+            else:
+                keys, codes = self.categories, self.category_codes
+            if self.use_numpy:
+                sums = np.bincount(codes, weights=durations, minlength=len(keys))
+                minutes = self._present(sums, np.bincount(codes, minlength=len(keys)))
+            else:
+                minutes = [0] * len(keys)
+                for code, duration in zip(codes, durations):
+                    minutes[code] += duration
+        totals = [(key, value) for key, value in zip(keys, minutes) if value is not None]
+        # same order as get_totals
+        totals.sort(key=lambda total: (-total[1], total[0]))
+        return [(key, dt.timedelta(minutes=value)) for key, value in totals]
+
+    @staticmethod
+    def _present(sums, counts):
+        """Integer sums of the groups having facts, None for the others."""
+        return [int(round(value)) if count else None for value, count in zip(sums, counts)]
+
+    def overlaps(self):
+        """Return the pairs of overlapping facts.
+
+        Facts are half-open ranges, [start, end).
+
+        Return:
+            sorted list of (i, j) fact positions, i < j.
+        """
+        res = []
+        if self.use_numpy:
+            order = np.argsort(self.starts, kind="stable")
+            starts = self.starts[order]
+            ends = self.ends[order]
+            if len(order) < 2:
+                return res
+            # facts starting before the latest end of the previous ones
+            latest_end = np.maximum.accumulate(ends)
+            candidates = np.nonzero(starts[1:] < latest_end[:-1])[0] + 1
+            # an earlier fact overlapping k started at most this long before
+            longest = int((ends - starts).max())
+            for k in candidates.tolist():
+                first = int(np.searchsorted(starts, starts[k] - longest, side="left"))
+                previous = np.arange(first, k)
+                hits = previous[(ends[first:k] > starts[k]) & (starts[first:k] < ends[k])]
+                res += [(int(order[j]), int(order[k])) for j in hits]
+        else:
+            order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+            active = []  # positions of the facts not ended yet
+            for k in order:
+                start, end = self.starts[k], self.ends[k]
+                active = [j for j in active if self.ends[j] > start]
+                res += [(j, k) for j in active if self.starts[j] < end]
+                active.append(k)
+        return sorted((min(pair), max(pair)) for pair in res)
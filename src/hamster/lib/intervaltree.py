@@ -0,0 +1,162 @@
+# This file is part of Hamster
+# Copyright (c) The Hamster time tracker developers
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+"""Interval tree.
+
+In-memory index answering "what overlaps [start, end)" in O(log n + k).
+"""
+
+
+import random
+
+
+class _Node():
+    __slots__ = ('key', 'start', 'end', 'priority', 'max_end', 'left', 'right')
+
+    def __init__(self, key, start, end):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.priority = random.random()
+        self.max_end = end
+        self.left = None
+        self.right = None
+
+    @property
+    def order(self):
+        return (self.start, self.key)
+
+
+def _later(a, b):
+    """Latest of two ends. None is an open end, hence the latest."""
+    if a is None or b is None:
+        return None
+    return a if a > b else b
+
+
+def _update(node):
+    """Recompute the subtree maximum end."""
+    max_end = node.end
+    if node.left:
+        max_end = _later(max_end, node.left.max_end)
+    if node.right:
+        max_end = _later(max_end, node.right.max_end)
+    node.max_end = max_end
+    return node
+
+
+def _split(node, order):
+    """Split into the nodes before order and the nodes from order on."""
+    if node is None:
+        return None, None
+    if node.order < order:
+        node.right, right = _split(node.right, order)
+        return _update(node), right
+    else:
+        left, node.left = _split(node.left, order)
+        return left, _update(node)
+
+
+def _merge(left, right):
+    """Merge two treaps, all nodes in left being before those in right."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    else:
+        right.left = _merge(left, right.left)
+        return _update(right)
+
+
+def _remove(node, order):
+    if node is None:
+        return None
+    if order == node.order:
+        return _merge(node.left, node.right)
+    if order < node.order:
+        node.left = _remove(node.left, order)
+    else:
+        node.right = _remove(node.right, order)
+    return _update(node)
+
+
+class IntervalTree():
+    """Intervals indexed by a unique key.
+
+    A randomized binary search tree (treap) ordered by start,
+    each node knowing the latest end in its subtree.
+
+    Intervals are half-open, [start, end).
+    An end of None means the interval is open (e.g. an on-going fact).
+    """
+
+    def __init__(self, intervals=()):
+        self._root = None
+        self._intervals = {}  # key: (start, end)
+        for key, start, end in intervals:
+            self.add(key, start, end)
+
+    def __contains__(self, key):
+        return key in self._intervals
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def add(self, key, start, end):
+        """Add an interval, replacing any previous one with the same key."""
+        assert start is not None, "interval needs a start"
+        self.discard(key)
+        node = _Node(key, start, end)
+        left, right = _split(self._root, node.order)
+        self._root = _merge(_merge(left, node), right)
+        self._intervals[key] = (start, end)
+
+    def clear(self):
+        self._root = None
+        self._intervals = {}
+
+    def discard(self, key):
+        """Remove the interval with this key, if any."""
+        interval = self._intervals.pop(key, None)
+        if interval:
+            start, __ = interval
+            self._root = _remove(self._root, (start, key))
+
+    def get(self, key):
+        """Return (start, end) for key, or None."""
+        return self._intervals.get(key)
+
+    def overlapping(self, start, end=None):
+        """Return the intervals overlapping [start, end).
+
+        end (None): no upper bound.
+
+        Return:
+            list of (key, start, end), sorted by start.
+        """
+        res = []
+        stack = []
+        node = self._root
+        # in-order traversal, skipping the subtrees that cannot overlap
+        while stack or node:
+            if node:
+                if node.max_end is not None and node.max_end <= start:
+                    # everything below ends too early
+                    node = None
+                else:
+                    stack.append(node)
+                    node = node.left
+                continue
+            node = stack.pop()
+            if end is not None and node.start >= end:
+                # this one and everything after starts too late
+                break
+            if node.end is None or node.end > start:
+                res.append((node.key, node.start, node.end))
+            node = node.right
+        return res
@@ -3,6 +3,8 @@ logger = logging.getLogger(__name__)   # noqa: E402
 
 import re
 
+from functools import lru_cache
+
 from hamster.lib import datetime as dt
 
 
@@ -50,19 +52,41 @@ def parse_fact(text, range_pos="head", default_day=None, ref="now"):
     Tentative syntax (not accurate):
     start [- end_time] activity[@category][, description][,]{ #tag}
     According to the legacy tests, # were allowed in the description
-    """
-
-    res = {}
 
+    The same text is often parsed several times in a row
+    (e.g. on each keystroke in the activity entry), so recent results
+    are kept. Relative times (e.g. -15) and the default day depend
+    on ref (rounded to the minute) and on the day start,
+    these are part of the key.
+    """
     text = text.strip()
     if not text:
-        return res
+        return {}
+
+    if ref == "now":
+        ref = dt.datetime.now()
+    res = _parse_fact(text, range_pos, default_day, ref, dt.hday.start_time())
+    # the tags list is the only mutable value
+    return dict(res, tags=list(res["tags"]))
+
+
+@lru_cache(maxsize=256)
+def _parse_fact(text, range_pos, default_day, ref, day_start):
+    """parse_fact, once ref is known.
+
+    day_start is needed in the key, since it changes the parsed datetimes.
+    """
+    if default_day is None:
+        default_day = ref.hday(day_start)
+
+    res = {}
 
     # datetimes
     # force at least a space to avoid matching 10.00@cat
     (start, end), remaining_text = dt.Range.parse(text, position=range_pos,
                                                   separator=activity_separator,
-                                                  default_day=default_day)
+                                                  default_day=default_day,
+                                                  ref=ref)
     res["start_time"] = start
     res["end_time"] = end
 
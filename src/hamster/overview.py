@@ -22,7 +22,6 @@ import bisect
 import itertools
 import webbrowser
 
-from collections import defaultdict
 from math import ceil
 
 from gi.repository import GLib as glib
@@ -316,18 +315,11 @@ class Totals(graphics.Scene):
         self.connect("style-updated", self.on_style_changed)
 
 
-    def set_facts(self, facts):
-        totals = defaultdict(lambda: defaultdict(dt.timedelta))
-        for fact in facts:
-            for key in ('category', 'activity'):
-                totals[key][getattr(fact, key)] += fact.delta
+    # storage.get_totals group_by values shown
+    groups = ('activity', 'category', 'tag')
 
-            for tag in fact.tags:
-                totals["tag"][tag] += fact.delta
-
-
-        for key, group in totals.items():
-            totals[key] = sorted(group.items(), key=lambda x: x[1], reverse=True)
+    def set_totals(self, totals):
+        """Show totals, {group_by: storage.get_totals(…, group_by)} for each of groups."""
         self.totals = totals
 
         self.activities_chart.set_values(totals['activity'])
@@ -419,8 +411,8 @@ class Overview(Controller):
         self.window.set_default_icon_name("org.gnome.Hamster.GUI")
         self.window.set_default_size(700, 500)
 
-        self.storage = hamster.client.Storage()
-        self.storage.connect("facts-changed", self.on_facts_changed)
+        self.storage = hamster.client.AsyncStorage()
+        self.storage.connect("facts-changed-v2", self.on_facts_changed_v2)
         self.storage.connect("activities-changed", self.on_facts_changed)
 
         self.header_bar = HeaderBar()
@@ -474,6 +466,7 @@ class Overview(Controller):
         self.window.connect("key-press-event", self.on_key_press)
 
         self.facts = []
+        self.facts_future = None  # latest get_facts
         self.find_facts()
 
         # update every minute (necessary if an activity is running)
@@ -528,9 +521,26 @@ class Overview(Controller):
         search_active = self.header_bar.search_button.get_active()
         search = "" if not search_active else self.filter_entry.get_text()
         search = "%s*" % search if search else "" # search anywhere
-        self.facts = self.storage.get_facts(start, end, search_terms=search)
+        facts = self.facts_future = self.storage.get_facts(start, end, search_terms=search)
+        # summed up by the service
+        with self.storage.batch():
+            totals = {group_by: self.storage.get_totals(start, end, group_by=group_by,
+                                                        search_terms=search)
+                      for group_by in Totals.groups}
+
+        def on_done():
+            if facts is not self.facts_future:
+                # a later search is on its way
+                return
+            self.set_facts(facts.result(),
+                           {group_by: future.result() for group_by, future in totals.items()},
+                           scroll_to_top=scroll_to_top)
+        hamster.client.when_done([facts] + list(totals.values()), on_done)
+
+    def set_facts(self, facts, totals, scroll_to_top=False):
+        self.facts = facts
         self.fact_tree.set_facts(self.facts, scroll_to_top=scroll_to_top)
-        self.totals.set_facts(self.facts)
+        self.totals.set_totals(totals)
         self.header_bar.stop_button.set_sensitive(
             self.facts and not self.facts[-1].end_time)
 
@@ -553,6 +563,13 @@ class Overview(Controller):
     def on_facts_changed(self, event):
         self.find_facts()
 
+    def on_facts_changed_v2(self, event, ids, min_day, max_day, revision):
+        start, end = self.header_bar.range_pick.get_range()
+        if (min_day and min_day > end) or (max_day and max_day < start):
+            # none of the shown days changed
+            return
+        self.find_facts()
+
     def on_add_activity_clicked(self, button):
         self.start_new_fact(clone_selected=True, fallback=True)
 
@@ -563,8 +580,8 @@ class Overview(Controller):
         self.present_fact_controller("edit", fact_id=fact.id)
 
     def on_row_delete_called(self, tree, fact):
-        self.storage.remove_fact(fact.id)
-        self.find_facts()
+        self.storage.remove_fact(fact.id).add_done_callback(
+            lambda future: self.find_facts())
 
     def on_search_toggled(self, button):
         active = button.get_active()
@@ -22,7 +22,6 @@
 import os, sys
 from xml.dom.minidom import Document
 import csv
-import copy
 import itertools
 import re
 import codecs
@@ -47,7 +46,7 @@ from calendar import timegm
 from io import StringIO, IOBase
 
 def simple(facts, start_date, end_date, format, path = None):
-    facts = copy.deepcopy(facts) # dont want to do anything bad to the input
+    facts = [fact.copy() for fact in facts] # dont want to do anything bad to the input
     report_path = stuff.locale_from_utf8(path)
 
     if format == "tsv":
@@ -269,8 +268,9 @@ class HTMLWriter(ReportWriter):
 
         # group by date
         by_date = []
-        for date, date_facts in itertools.groupby(facts, lambda fact:fact.date):
-            by_date.append((date, [fact.as_dict() for fact in date_facts]))
+        dates = dt.hday.from_datetimes(fact.range.start for fact in facts)
+        for date, date_facts in itertools.groupby(zip(dates, facts), lambda item: item[0]):
+            by_date.append((date, [fact.as_dict() for __, fact in date_facts]))
         by_date = dict(by_date)
 
         date_facts = []
@@ -24,12 +24,16 @@
 import logging
 logger = logging.getLogger(__name__)   # noqa: E402
 
-import os, time
-import itertools
+import os, queue, re, threading, time
 import sqlite3 as sqlite
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from shutil import copy as copyfile
+from urllib.parse import quote
 try:
     from gi.repository import Gio as gio
+    from gi.repository import GLib as glib
 except ImportError:
     print("Could not import gio - requires pygobject. File monitoring will be disabled")
     gio = None
@@ -38,6 +42,7 @@ import hamster
 from hamster.lib import datetime as dt
 from hamster.lib.configuration import conf
 from hamster.lib.fact import Fact
+from hamster.lib.intervaltree import IntervalTree
 from hamster.storage import storage
 
 
@@ -47,7 +52,25 @@ from hamster.storage import storage
 
 class Storage(storage.Storage):
     con = None # Connection will be created on demand
-    def __init__(self, unsorted_localized="Unsorted", database_dir=None):
+
+    # how far back the in-memory fact intervals go.
+    # Overlaps before that are looked up in the database.
+    intervals_span = dt.timedelta(days=30)
+
+    # number of read-only connections (and worker threads) for read_async
+    readers = 4
+
+    # methods that read_async can run
+    read_only_methods = {"get_facts", "get_todays_facts", "get_fact",
+                         "get_changes_since", "get_totals",
+                         "get_activities", "get_category_activities",
+                         "get_categories", "get_tags"}
+
+    # database version the code expects (cf. run_fixtures)
+    schema_version = 13
+
+    def __init__(self, unsorted_localized="Unsorted", database_dir=None,
+                 connection_profile=None, read_only=False):
         """Database storage.
 
         Args:
@@ -60,6 +83,13 @@ class Storage(storage.Storage):
             database_dir (path):
                 Directory holding the database file,
                 or None to use the default location.
+            connection_profile (dict):
+                Connection settings (cf. default_connection_profile),
+                or None to use the GSettings ones.
+            read_only (bool):
+                Only read the database, e.g. next to a running service.
+                The database is neither created nor upgraded;
+                it must already be at schema_version.
 
         Note: Zero id means failure.
               Unsorted category id is hard-coded as -1
@@ -67,15 +97,33 @@ class Storage(storage.Storage):
         storage.Storage.__init__(self)
 
         self._unsorted_localized = unsorted_localized
+        self.read_only = read_only
+        self.connection_profile = connection_profile or default_connection_profile()
 
         self.__con = None
         self.__cur = None
         self.__last_etag = None
 
+        # fact intervals, loaded on demand
+        self.__intervals = None
+        self.__intervals_start = None
+        # data_version when the intervals were loaded (cf. __get_intervals)
+        self.__intervals_version = None
+
+        # idle read-only connections
+        self.__readers = queue.LifoQueue()
+        self.__readers_generation = 0
+        # reader connection of the current thread, if any
+        self.__local = threading.local()
+        self.__executor = None
 
         self.db_path = self.__init_db_file(database_dir)
         logger.info("database: '{}'".format(self.db_path))
 
+        if read_only:
+            self.check_version()
+            return
+
         if gio:
             # add file monitoring so the app does not have to be restarted
             # when db file is rewritten
@@ -90,9 +138,12 @@ class Storage(storage.Storage):
                         return
                 elif event == gio.FileMonitorEvent.DELETED:
                     self.con = None
+                    self.__intervals = None
+                    self.__close_readers()
 
                 if event == gio.FileMonitorEvent.CHANGES_DONE_HINT:
                     logger.warning("DB file has been modified externally. Calling all stations")
+                    self.__intervals = None
                     self.dispatch_overwrite()
 
             self.__database_file = gio.File.new_for_path(self.db_path)
@@ -100,6 +151,10 @@ class Storage(storage.Storage):
             self.__db_monitor.connect("changed", on_db_file_change)
 
         self.run_fixtures()
+        if (self.fetchone("SELECT minutes FROM daily_totals_day_start")["minutes"]
+                != _day_start_minutes()):
+            # the hamster days changed
+            self.__rebuild_daily_totals()
 
     def __init_db_file(self, database_dir):
         from gi.repository import GLib
@@ -107,11 +162,15 @@ class Storage(storage.Storage):
         if not database_dir:
             database_dir = os.path.join(xdg_data_home, 'hamster')
 
+        db_path = os.path.join(database_dir, "hamster.db")
+
+        if self.read_only:
+            # opening a missing file fails in read-only mode
+            return os.path.realpath(db_path)
+
         if not os.path.exists(database_dir):
             os.makedirs(database_dir, 0o744)
 
-        db_path = os.path.join(database_dir, "hamster.db")
-
         # check if we have a database at all
         if not os.path.exists(db_path):
             # handle pre-existing hamster-applet database
@@ -169,8 +228,18 @@ class Storage(storage.Storage):
     def __get_tag_ids(self, tags):
         """look up tags by their name. create if not found"""
 
-        db_tags = self.fetchall("select * from tags where name in (%s)"
-                                            % ",".join(["?"] * len(tags)), tags) # bit of magic here - using sqlites bind variables
+        tags = list(set(tags))
+
+        def lookup():
+            db_tags = []
+            # stay below the sqlite bind variables limit
+            for i in range(0, len(tags), 500):
+                chunk = tags[i:i + 500]
+                db_tags.extend(self.fetchall("select * from tags where name in (%s)"
+                                             % ",".join(["?"] * len(chunk)), chunk)) # bit of magic here - using sqlites bind variables
+            return db_tags
+
+        db_tags = lookup()
 
         changes = False
 
@@ -185,11 +254,8 @@ class Storage(storage.Storage):
 
         add = set(tags) - set(found_tags)
         if add:
-            statement = "insert into tags(name) values(?)"
-
-            self.execute([statement] * len(add), [(tag,) for tag in add])
-
-            return self.__get_tag_ids(tags)[0], True # all done, recurse
+            self.executemany("insert into tags(name) values(?)", [(tag,) for tag in add])
+            return lookup(), True
         else:
             return db_tags, changes
 
@@ -236,9 +302,6 @@ class Storage(storage.Storage):
         """
         self.execute(query, (name, name.lower(), category_id, id))
 
-        affected_ids = [res[0] for res in self.fetchall("select id from facts where activity_id = ?", (id,))]
-        self.__remove_index(affected_ids)
-
 
     def __change_category(self, id, category_id):
         """Change the category of an activity.
@@ -282,11 +345,6 @@ class Storage(storage.Storage):
 
             self.execute(statement, (category_id, id))
 
-        affected_ids = [res[0] for res in self.fetchall("select id from facts where activity_id = ?", (id,))]
-        if existing_activity:
-            affected_ids.extend([res[0] for res in self.fetchall("select id from facts where activity_id = ?", (existing_activity['id'],))])
-        self.__remove_index(affected_ids)
-
         return True
 
     def __add_category(self, name):
@@ -306,14 +364,69 @@ class Storage(storage.Storage):
             """
             self.execute(update, (name, name.lower(), id))
 
-        affected_query = """
-            SELECT id
-              FROM facts
-             WHERE activity_id in (SELECT id FROM activities where category_id=?)
+    def __get_category_ids(self, names):
+        """Return {name: category id}, adding the missing categories.
+
+        Bulk version of __get_category_id and __add_category.
+        """
+        def lookup():
+            res = {}
+            for row in self.fetchall("SELECT id, name FROM categories ORDER BY id desc"):
+                res.setdefault(_sql_lower(row["name"] or ""), row["id"])
+            return res
+
+        by_name = lookup()
+        missing = {}
+        for name in names:
+            if name and _sql_lower(name) not in by_name:
+                missing.setdefault(_sql_lower(name), name)
+        if missing:
+            self.executemany("INSERT INTO categories (name, search_name) VALUES (?, ?)",
+                             [(name, name.lower()) for name in missing.values()])
+            by_name = lookup()
+
+        return {name: by_name[_sql_lower(name)] if name else -1
+                for name in names}
+
+    def __get_activity_ids(self, keys, temporary=False):
+        """Return {(name, category_id): activity id}, adding the missing activities.
+
+        Bulk version of __get_activity_by_name and __add_activity.
         """
-        affected_ids = [res[0] for res in self.fetchall(affected_query, (id,))]
-        self.__remove_index(affected_ids)
+        def lookup():
+            res = {}
+            query = """
+                       SELECT id, name, deleted, category_id
+                         FROM activities
+                     ORDER BY deleted, id desc
+            """
+            for row in self.fetchall(query):
+                res.setdefault((_sql_lower(row["name"] or ""), row["category_id"]), row)
+            return res
 
+        by_key = lookup()
+        missing = {}
+        resurrect = set()
+        for name, category_id in keys:
+            row = by_key.get((_sql_lower(name), category_id))
+            if not row:
+                missing.setdefault((_sql_lower(name), category_id), (name, category_id))
+            elif row["deleted"] and not temporary:
+                resurrect.add(row["id"])
+
+        if resurrect:
+            # same as in __get_activity_by_name
+            self.executemany("UPDATE activities SET deleted = null, category_id = -1 WHERE id = ?",
+                             [(id,) for id in resurrect])
+        if missing:
+            self.executemany("""INSERT INTO activities (name, search_name, category_id, deleted)
+                                     VALUES (?, ?, ?, ?)""",
+                             [(name, name.lower(), category_id, 1 if temporary else None)
+                              for name, category_id in missing.values()])
+            by_key.update(lookup())
+
+        return {(name, category_id): by_key[(_sql_lower(name), category_id)]["id"]
+                for name, category_id in keys}
 
     def __get_activity_by_name(self, name, category_id = None, resurrect = True):
         """Get most recent, preferably not deleted activity by it's name.
@@ -387,11 +500,11 @@ class Storage(storage.Storage):
         return 0
 
     def _dbfact_to_libfact(self, db_fact):
-        """Convert a db fact (coming from __group_facts) to Fact."""
+        """Convert a db fact row (with the tags column, cf. __get_facts) to Fact."""
         return Fact(activity=db_fact["name"],
                     category=db_fact["category"],
                     description=db_fact["description"],
-                    tags=db_fact["tags"],
+                    tags=split_tags(db_fact["tags"]),
                     start_time=db_fact["start_time"],
                     end_time=db_fact["end_time"],
                     id=db_fact["id"],
@@ -405,44 +518,19 @@ class Storage(storage.Storage):
                           a.description as description,
                           b.name AS name, b.id as activity_id,
                           coalesce(c.name, ?) as category, coalesce(c.id, -1) as category_id,
-                          e.name as tag
+                          %s as tags
                      FROM facts a
                 LEFT JOIN activities b ON a.activity_id = b.id
                 LEFT JOIN categories c ON b.category_id = c.id
-                LEFT JOIN fact_tags d ON d.fact_id = a.id
-                LEFT JOIN tags e ON e.id = d.tag_id
                     WHERE a.id = ?
-                 ORDER BY e.name
-        """
+        """ % TAGS_COLUMN
 
-        fact_rows = self.fetchall(query, (self._unsorted_localized, id))
-        assert len(fact_rows) > 0, "No fact with id {}".format(id)
-        dbfact = self.__group_tags(fact_rows)[0]
-        fact = self._dbfact_to_libfact(dbfact)
+        fact_row = self.fetchone(query, (self._unsorted_localized, id))
+        assert fact_row, "No fact with id {}".format(id)
+        fact = self._dbfact_to_libfact(fact_row)
         logger.info("got fact {}".format(fact))
         return fact
 
-    def __group_tags(self, facts):
-        """put the fact back together and move all the unique tags to an array"""
-        if not facts: return facts  #be it None or whatever
-
-        grouped_facts = []
-        for fact_id, fact_tags in itertools.groupby(facts, lambda f: f["id"]):
-            fact_tags = list(fact_tags)
-
-            # first one is as good as the last one
-            grouped_fact = fact_tags[0]
-
-            # we need dict so we can modify it (sqlite.Row is read only)
-            # in python 2.5, sqlite does not have keys() yet, so we hardcode them (yay!)
-            keys = ["id", "start_time", "end_time", "description", "name",
-                    "activity_id", "category", "tag"]
-            grouped_fact = dict([(key, grouped_fact[key]) for key in keys])
-
-            grouped_fact["tags"] = [ft["tag"] for ft in fact_tags if ft["tag"]]
-            grouped_facts.append(grouped_fact)
-        return grouped_facts
-
 
     def __touch_fact(self, fact, end_time = None):
         end_time = end_time or dt.datetime.now()
@@ -456,6 +544,74 @@ class Storage(storage.Storage):
                         WHERE id = ?
             """
             self.execute(query, (end_time, fact.id))
+            self.__set_interval(fact.id, fact.start_time, end_time)
+
+    def __get_intervals(self, start_time):
+        """Return the in-memory fact intervals.
+
+        They hold every fact that ends after self.__intervals_start
+        (intervals_span before loading, reloaded once twice that old),
+        so they are only returned if start_time is past that;
+        otherwise None is returned and the database should be queried.
+        """
+        if self.__intervals is not None and self.__data_version() != self.__intervals_version:
+            # committed by another connection. In WAL mode, these writes
+            # go to the -wal file, the file monitor does not see them.
+            logger.info("facts changed outside, reloading the intervals")
+            self.__intervals = None
+        if (self.__intervals is not None
+                and dt.datetime.now() - self.__intervals_start > 2 * self.intervals_span):
+            # new facts keep being added, move the window forward
+            logger.info("intervals window too old, reloading the intervals")
+            self.__intervals = None
+        if self.__intervals is None:
+            self.__intervals_version = self.__data_version()
+            self.__intervals_start = dt.datetime.now() - self.intervals_span
+            query = """
+                       SELECT id, start_time, end_time
+                         FROM facts
+                        WHERE end_time >= ? OR end_time IS NULL
+            """
+            rows = self.fetchall(query, (self.__intervals_start, ))
+            self.__intervals = IntervalTree((row["id"], row["start_time"], row["end_time"])
+                                            for row in rows)
+            logger.info("loaded {} fact intervals".format(len(self.__intervals)))
+
+        if start_time < self.__intervals_start:
+            return None
+        return self.__intervals
+
+    def __data_version(self):
+        """Changes whenever another connection commits to the database."""
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def __set_interval(self, fact_id, start_time, end_time):
+        """Keep the in-memory fact intervals in sync with the facts table."""
+        if self.__intervals is None:
+            return
+        if end_time is None or end_time >= self.__intervals_start:
+            self.__intervals.add(fact_id, start_time, end_time)
+        else:
+            self.__intervals.discard(fact_id)
+
+    def __get_interval_facts(self, intervals, start_time, end_time):
+        """Return the facts rows overlapping [start_time, end_time).
+
+        Same columns as in __solve_overlaps, ordered by start_time.
+        """
+        ids = [fact_id for fact_id, __, __ in intervals.overlapping(start_time, end_time)]
+        if not ids:
+            return []
+
+        query = """
+                   SELECT a.*, b.name, c.name as category
+                     FROM facts a
+                LEFT JOIN activities b on b.id = a.activity_id
+                LEFT JOIN categories c on b.category_id = c.id
+                    WHERE a.id in (%s)
+                 ORDER BY a.start_time
+        """ % ",".join(["?"] * len(ids))
+        return self.fetchall(query, ids)
 
     def __squeeze_in(self, start_time):
         """ tries to put task in the given date
@@ -465,26 +621,40 @@ class Storage(storage.Storage):
         # we are checking if our start time is in the middle of anything
         # or maybe there is something after us - so we know to adjust end time
         # in the latter case go only few hours ahead. everything else is madness, heh
-        query = """
-                   SELECT a.*, b.name
-                     FROM facts a
-                LEFT JOIN activities b on b.id = a.activity_id
-                    WHERE ((start_time < ? and end_time > ?)
-                           OR (start_time > ? and start_time < ? and end_time is null)
-                           OR (start_time > ? and start_time < ?))
-                 ORDER BY start_time
-                    LIMIT 1
-                """
-        fact = self.fetchone(query, (start_time, start_time,
-                                     start_time - dt.timedelta(hours = 12),
-                                     start_time, start_time,
-                                     start_time + dt.timedelta(hours = 12)))
+        before = start_time - dt.timedelta(hours = 12)
+        after = start_time + dt.timedelta(hours = 12)
+        intervals = self.__get_intervals(start_time)
+        if intervals is not None:
+            # same conditions as in the query below
+            candidates = self.__get_interval_facts(intervals, start_time, after)
+            fact = next((fact for fact in candidates
+                         if (fact["end_time"] is not None
+                             and fact["start_time"] < start_time < fact["end_time"])
+                            or (fact["end_time"] is None
+                                and before < fact["start_time"] < start_time)
+                            or start_time < fact["start_time"] < after),
+                        None)
+        else:
+            query = """
+                       SELECT a.*, b.name
+                         FROM facts a
+                    LEFT JOIN activities b on b.id = a.activity_id
+                        WHERE ((start_time < ? and end_time > ?)
+                               OR (start_time > ? and start_time < ? and end_time is null)
+                               OR (start_time > ? and start_time < ?))
+                     ORDER BY start_time
+                        LIMIT 1
+                    """
+            fact = self.fetchone(query, (start_time, start_time,
+                                         before, start_time,
+                                         start_time, after))
         end_time = None
         if fact:
             if start_time > fact["start_time"]:
                 #we are in middle of a fact - truncate it to our start
                 self.execute("UPDATE facts SET end_time=? WHERE id=?",
                              (start_time, fact["id"]))
+                self.__set_interval(fact["id"], fact["start_time"], start_time)
 
             else: #otherwise we have found a task that is after us
                 end_time = fact["start_time"]
@@ -503,19 +673,33 @@ class Storage(storage.Storage):
         #             |----------------- NEW -----------------|
         #      |--- old --- 1|   |2 --- old --- 1|   |2 --- old ---|
         # |3 -----------------------  big old   ------------------------ 3|
-        query = """
-                   SELECT a.*, b.name, c.name as category
-                     FROM facts a
-                LEFT JOIN activities b on b.id = a.activity_id
-                LEFT JOIN categories c on b.category_id = c.id
-                    WHERE (end_time > ? and end_time < ?)
-                       OR (start_time > ? and start_time < ?)
-                       OR (start_time < ? and end_time > ?)
-                 ORDER BY start_time
-                """
-        conflicts = self.fetchall(query, (start_time, end_time,
-                                          start_time, end_time,
-                                          start_time, end_time))
+        intervals = self.__get_intervals(start_time)
+        if intervals is not None:
+            candidates = self.__get_interval_facts(intervals, start_time, end_time)
+            conflicts = [fact for fact in candidates
+                         if (fact["end_time"] is not None
+                             and start_time < fact["end_time"] < end_time)
+                            or start_time < fact["start_time"] < end_time
+                            or (fact["end_time"] is not None
+                                and fact["start_time"] < start_time
+                                and fact["end_time"] > end_time)]
+        else:
+            # note: each OR term can be answered by one of the time indexes.
+            #       The unary + keeps sqlite from walking the whole start_time
+            #       index just to get the ordering for free.
+            query = """
+                       SELECT a.*, b.name, c.name as category
+                         FROM facts a
+                    LEFT JOIN activities b on b.id = a.activity_id
+                    LEFT JOIN categories c on b.category_id = c.id
+                        WHERE (end_time > ? and end_time < ?)
+                           OR (start_time > ? and start_time < ?)
+                           OR (end_time > ? and start_time < ?)
+                     ORDER BY +start_time
+                    """
+            conflicts = self.fetchall(query, (start_time, end_time,
+                                              start_time, end_time,
+                                              end_time, start_time))
 
         for fact in conflicts:
             # fact is a sqlite.Row, indexable by column name
@@ -534,6 +718,7 @@ class Storage(storage.Storage):
                 self.execute("""UPDATE facts
                                    SET end_time = ?
                                  WHERE id = ?""", (start_time, fact["id"]))
+                self.__set_interval(fact["id"], fact["start_time"], start_time)
                 fact_name = fact["name"]
 
                 # create new fact for the end
@@ -557,12 +742,14 @@ class Storage(storage.Storage):
                 logger.info("Overlapping start of %s" % fact["name"])
                 self.execute("UPDATE facts SET start_time=? WHERE id=?",
                              (end_time, fact["id"]))
+                self.__set_interval(fact["id"], end_time, fact["end_time"])
 
             # overlap end
             elif start_time < fact_end_time < end_time:
                 logger.info("Overlapping end of %s" % fact["name"])
                 self.execute("UPDATE facts SET end_time=? WHERE id=?",
                              (start_time, fact["id"]))
+                self.__set_interval(fact["id"], fact["start_time"], start_time)
 
 
     def __add_fact(self, fact, temporary=False):
@@ -580,9 +767,6 @@ class Storage(storage.Storage):
         """
         logger.info("adding fact {}".format(fact))
 
-        start_time = fact.start_time
-        end_time = fact.end_time
-
         # get tags from database - this will create any missing tags too
         tags = [(tag['id'], tag['name'], tag['autocomplete']) for tag in self.get_tag_ids(fact.tags)]
 
@@ -601,6 +785,53 @@ class Storage(storage.Storage):
         else:
             activity_id = activity_id['id']
 
+        return self.__insert_fact(fact, activity_id, tags)
+
+    def __add_facts(self, facts, temporary=False):
+        """Add several facts.
+
+        Tags, categories and activities are looked up (or created)
+        all at once, then the facts are added in chronological order
+        (so if they overlap, the later one prevails).
+
+        Args:
+            facts (list of Fact)
+        Returns:
+            list of the new fact ids, in the same order as facts
+            (see __add_fact for the meaning of each id).
+        """
+        logger.info("adding {} facts".format(len(facts)))
+
+        tags = {tag['name']: (tag['id'], tag['name'], tag['autocomplete'])
+                for tag in self.get_tag_ids({tag for fact in facts for tag in fact.tags})}
+        # dict rather than set, so that names are created in order of appearance
+        category_ids = self.__get_category_ids(dict.fromkeys(fact.category for fact in facts))
+        activity_ids = self.__get_activity_ids(dict.fromkeys((fact.activity, category_ids[fact.category])
+                                                             for fact in facts),
+                                               temporary)
+
+        ids = [0] * len(facts)
+        for i in sorted(range(len(facts)), key=lambda i: facts[i].start_time):
+            fact = facts[i]
+            activity_id = activity_ids[(fact.activity, category_ids[fact.category])]
+            ids[i] = self.__insert_fact(fact, activity_id,
+                                        [tags[tag] for tag in fact.tags])
+
+        return ids
+
+    def __insert_fact(self, fact, activity_id, tags):
+        """Insert fact, making room for it among the existing ones.
+
+        Args:
+            fact (Fact)
+            activity_id (int): resolved fact.activity
+            tags (list): (id, name, autocomplete) of the resolved fact.tags
+        Returns:
+            int, see __add_fact.
+        """
+        start_time = fact.start_time
+        end_time = fact.end_time
+
         # if we are working on +/- current day - check the last_activity
         if (dt.timedelta(days=-1) <= dt.datetime.now() - start_time <= dt.timedelta(days=1)):
             # pull in previous facts
@@ -641,6 +872,7 @@ class Storage(storage.Storage):
                                         WHERE id = ?
                             """
                             self.execute(update, (before.id,))
+                            self.__set_interval(before.id, before.start_time, None)
 
                             return before.id
                 else:
@@ -651,6 +883,7 @@ class Storage(storage.Storage):
                                 WHERE id = ?
                     """
                     self.execute(update, (start_time, previous.id))
+                    self.__set_interval(previous.id, previous.start_time, start_time)
 
 
         # done with the current activity, now we can solve overlaps
@@ -668,13 +901,13 @@ class Storage(storage.Storage):
         self.execute(insert, (activity_id, start_time, end_time, fact.description))
 
         fact_id = self.__last_insert_rowid()
+        self.__set_interval(fact_id, start_time, end_time)
 
         #now link tags
-        insert = ["insert into fact_tags(fact_id, tag_id) values(?, ?)"] * len(tags)
+        insert = "insert into fact_tags(fact_id, tag_id) values(?, ?)"
         params = [(fact_id, tag[0]) for tag in tags]
-        self.execute(insert, params)
+        self.executemany(insert, params)
 
-        self.__remove_index([fact_id])
         logger.info("fact successfully added, with id #{}".format(fact_id))
         return fact_id
 
@@ -685,12 +918,30 @@ class Storage(storage.Storage):
     def __get_todays_facts(self):
         return self.__get_facts(dt.Range.today())
 
-    def __get_facts(self, range, search_terms=""):
+    def __get_facts(self, range, search_terms="", ranked=False, limit=None, offset=0,
+                    after=None):
+        """Return the facts of the range, matching search_terms.
+
+        ranked, limit, offset: cf. storage.Storage.get_facts.
+        after ((start_time, id)): only the facts coming after that one
+                                  (chronological order, then by id).
+        """
         datetime_from = range.start
         datetime_to = range.end
 
         logger.info("searching for facts from {} to {}".format(datetime_from, datetime_to))
 
+        search_join, search_filter, match = self.__search_clauses(search_terms)
+        # facts starting at the same time ordered by id (cf. after)
+        order = "a.start_time, a.id"
+        if ranked and search_join:
+            # best first. Columns weights: name, category, description, tag
+            order = "bm25(fact_index, 4.0, 2.0, 1.0, 2.0), a.start_time, a.id"
+        if after:
+            # keyset pagination
+            search_filter += " AND (a.start_time > ? OR (a.start_time = ? AND a.id > ?))"
+            order = "a.start_time, a.id"
+
         query = """
                    SELECT a.id AS id,
                           a.start_time AS start_time,
@@ -698,48 +949,243 @@ class Storage(storage.Storage):
                           a.description as description,
                           b.name AS name, b.id as activity_id,
                           coalesce(c.name, ?) as category,
-                          e.name as tag
+                          %s as tags
                      FROM facts a
+                     %s
                 LEFT JOIN activities b ON a.activity_id = b.id
                 LEFT JOIN categories c ON b.category_id = c.id
-                LEFT JOIN fact_tags d ON d.fact_id = a.id
-                LEFT JOIN tags e ON e.id = d.tag_id
-                    WHERE (a.end_time >= ? OR a.end_time IS NULL) AND a.start_time <= ?
+                    WHERE (a.end_time >= ? OR a.end_time IS NULL)
+                      AND a.start_time >= ? AND a.start_time <= ?
+                      %s
+                 ORDER BY %s
+        """ % (TAGS_COLUMN, search_join, search_filter, order)
+
+        params = [self._unsorted_localized] + self.__range_params(range)
+        if match:
+            params.append(match)
+        if after:
+            after_start, after_id = after
+            params += [after_start, after_start, after_id]
+
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset]
+
+        fact_rows = self.fetchall(query, params)
+        return [self._dbfact_to_libfact(row) for row in fact_rows]
+
+    @staticmethod
+    def __search_clauses(search_terms):
+        """Return (join, filter, match) restricting facts a to search_terms.
+
+        match is the full text query parameter of filter, if any.
         """
+        # flip the query around when it starts with "not "
+        reverse_search_terms = search_terms.lower().startswith("not ")
+        if reverse_search_terms:
+            search_terms = search_terms[4:]
+        match = _fts_query(search_terms)
+
+        if match and reverse_search_terms:
+            return ("",
+                    """AND a.id NOT IN (SELECT rowid
+                                          FROM fact_index
+                                         WHERE fact_index MATCH ?)""",
+                    match)
+        elif match:
+            return ("JOIN fact_index ON fact_index.rowid = a.id",
+                    "AND fact_index MATCH ?",
+                    match)
+        return "", "", None
+
+    @staticmethod
+    def __range_params(range):
+        """Parameters of the facts a range condition:
+
+            (a.end_time >= ? OR a.end_time IS NULL)
+            AND a.start_time >= ? AND a.start_time <= ?
+        """
+        # ignore old on-going facts;
+        # the lower bound also lets sqlite do a range search on start_time
+        return [range.start, range.start - dt.timedelta(days=30), range.end]
+
+    # get_totals keys, for the facts a and for the daily_totals t
+    __totals_keys = {"activity": ("b.name", "b.name"),
+                     "category": ("coalesce(c.name, ?)", "coalesce(c.name, ?)"),
+                     "tag": ("e.name", "e.name"),
+                     # shifted back by the day start, the hamster day is the civil date
+                     "day": ("date(a.start_time, ?)", "t.hday")}
+
+    def __get_totals(self, range, group_by, search_terms=""):
+        """Return the total duration of the facts of the range, by group_by.
+
+        Same facts as __get_facts, summed as Fact.delta would
+        (whole facts, on-going ones up to now).
+        Whole days without search_terms come from the daily_totals,
+        and only the facts it does not hold are summed up.
+
+        group_by (str): "activity", "category", "tag" (facts without tags
+                        are not counted) or "day" (hamster day of the start).
+        Returns:
+            list of (key (str, or dt.hday for days), seconds (int)),
+            longest first.
+        """
+        if group_by not in self.__totals_keys:
+            raise ValueError("cannot group facts by {}".format(group_by))
+        days = None if search_terms else self.__daily_totals_days(range)
+        if days is None:
+            rows = self.__sum_facts(range, group_by, search_terms)
+        else:
+            first_day, last_day = days
+            totals = dict(self.__sum_daily_totals(group_by, first_day, last_day))
+            # facts started before, on-going ones and those starting right at the end
+            others = """AND a.id IN (SELECT id FROM facts
+                                      WHERE start_time >= ? AND start_time < ?
+                                  UNION ALL
+                                     SELECT id FROM facts
+                                      WHERE end_time IS NULL
+                                        AND start_time >= ? AND start_time < ?
+                                  UNION ALL
+                                     SELECT id FROM facts WHERE start_time = ?)"""
+            others_params = [range.start - dt.timedelta(days=30), range.start,
+                             range.start, range.end, range.end]
+            for key, seconds in self.__sum_facts(range, group_by,
+                                                 extra_filter=others,
+                                                 extra_params=others_params):
+                totals[key] = totals.get(key, 0) + seconds
+            rows = sorted(totals.items(), key=lambda row: (-row[1], row[0] or ""))
+        if group_by == "day":
+            return [(dt.hday.parse(key), seconds) for key, seconds in rows]
+        return rows
+
+    def __sum_facts(self, range, group_by, search_terms="", extra_filter="", extra_params=()):
+        """Sum the facts durations (cf. __get_totals), with the extra_filter condition.
+
+        Return a list of (key, seconds).
+        """
+        key, __ = self.__totals_keys[group_by]
+        key_params = {"category": [self._unsorted_localized],
+                      "day": ["-{} minutes".format(_day_start_minutes())]}
+        tags_join = ""
+        if group_by == "tag":
+            tags_join = """JOIN fact_tags d ON d.fact_id = a.id
+                           JOIN tags e ON e.id = d.tag_id"""
+
+        search_join, search_filter, match = self.__search_clauses(search_terms)
+        query = """
+                   SELECT %s AS key,
+                          sum(strftime('%%s', coalesce(a.end_time, ?))
+                              - strftime('%%s', a.start_time)) AS seconds
+                     FROM facts a
+                     %s
+                LEFT JOIN activities b ON a.activity_id = b.id
+                LEFT JOIN categories c ON b.category_id = c.id
+                     %s
+                    WHERE (a.end_time >= ? OR a.end_time IS NULL)
+                      AND a.start_time >= ? AND a.start_time <= ?
+                      %s %s
+                 GROUP BY key
+                 ORDER BY seconds DESC, key
+        """ % (key, search_join, tags_join, search_filter, extra_filter)
+        params = key_params.get(group_by, []) + [dt.datetime.now()] + self.__range_params(range)
+        if match:
+            params.append(match)
+        params += extra_params
+        return [(row["key"], row["seconds"]) for row in self.fetchall(query, params)]
+
+    def __sum_daily_totals(self, group_by, first_day, last_day):
+        """Sum the daily_totals from first_day to last_day, by group_by.
+
+        Return a list of (key, seconds).
+        """
+        __, key = self.__totals_keys[group_by]
+        query = """
+                   SELECT %s AS key, sum(t.minutes) * 60 AS seconds
+                     FROM daily_totals t
+                LEFT JOIN activities b ON t.activity_id = b.id
+                LEFT JOIN categories c ON t.category_id = c.id
+                LEFT JOIN tags e ON t.tag_id = e.id
+                    WHERE t.hday >= ? AND t.hday <= ?
+                      AND t.tag_id %s 0
+                 GROUP BY key
+        """ % (key, "!=" if group_by == "tag" else "=")
+        params = [self._unsorted_localized] if group_by == "category" else []
+        params += [str(first_day), str(last_day)]
+        return [(row["key"], row["seconds"]) for row in self.fetchall(query, params)]
+
+    def __daily_totals_days(self, range):
+        """Return the first and last days of range, if daily_totals can tell their totals.
+
+        None if range is not made of whole days,
+        or if the day start changed since daily_totals was built.
+        """
+        if range.start is None or range.end is None:
+            return None
+        first_day = range.start.hday()
+        last_day = range.end.hday()
+        if range.end == last_day.start:
+            # hday.end is the start of the next day
+            last_day -= dt.timedelta(days=1)
+        if range.start != first_day.start or range.end != last_day.end:
+            return None
+        row = self.fetchone("SELECT minutes FROM daily_totals_day_start")
+        if row["minutes"] != _day_start_minutes():
+            # rebuilt on the next start
+            return None
+        return first_day, last_day
+
+    # what daily_totals should hold, given the day start shift (twice)
+    __daily_totals_query = """
+               SELECT date(a.start_time, ?) AS hday, a.activity_id,
+                      coalesce(b.category_id, -1) AS category_id, 0 AS tag_id,
+                      sum((strftime('%s', a.end_time) - strftime('%s', a.start_time)) / 60)
+                        AS minutes
+                 FROM facts a
+            LEFT JOIN activities b ON b.id = a.activity_id
+                WHERE a.end_time IS NOT NULL
+             GROUP BY 1, 2, 3
+               HAVING minutes != 0
+            UNION ALL
+               SELECT date(a.start_time, ?), a.activity_id,
+                      coalesce(b.category_id, -1), d.tag_id,
+                      sum((strftime('%s', a.end_time) - strftime('%s', a.start_time)) / 60)
+                        AS minutes
+                 FROM facts a
+                 JOIN fact_tags d ON d.fact_id = a.id
+            LEFT JOIN activities b ON b.id = a.activity_id
+                WHERE a.end_time IS NOT NULL
+             GROUP BY 1, 2, 3, 4
+               HAVING minutes != 0
+    """
 
-        if search_terms:
-            # check if we need changes to the index
-            self.__check_index(datetime_from, datetime_to)
-
-            # flip the query around when it starts with "not "
-            reverse_search_terms = search_terms.lower().startswith("not ")
-            if reverse_search_terms:
-                search_terms = search_terms[4:]
-
-            search_terms = search_terms.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace("'", "''")
-            query += """ AND a.id %s IN (SELECT id
-                                         FROM fact_index
-                                         WHERE fact_index MATCH '%s')""" % ('NOT' if reverse_search_terms else '',
-                                                                            search_terms)
-
-        query += " ORDER BY a.start_time, e.name"
-
-        fact_rows = self.fetchall(query, (self._unsorted_localized,
-                                          datetime_from,
-                                          datetime_to))
-        #first let's put all tags in an array
-        dbfacts = self.__group_tags(fact_rows)
-        # ignore old on-going facts
-        return [self._dbfact_to_libfact(dbfact) for dbfact in dbfacts
-                if dbfact["start_time"] >= datetime_from - dt.timedelta(days=30)]
+    def __rebuild_daily_totals(self):
+        """Rebuild the daily_totals from the facts, with the current day start."""
+        logger.info("rebuild the daily totals")
+        minutes = _day_start_minutes()
+        shift = "-{} minutes".format(minutes)
+        self.execute(["DELETE FROM daily_totals",
+                      "UPDATE daily_totals_day_start SET minutes = ?",
+                      "INSERT INTO daily_totals " + self.__daily_totals_query],
+                     [(), (minutes,), (shift, shift)])
+
+    def __check_daily_totals(self):
+        """Return the number of daily_totals rows that are wrong or missing."""
+        minutes = self.fetchone("SELECT minutes FROM daily_totals_day_start")["minutes"]
+        shift = "-{} minutes".format(minutes)
+        query = """SELECT (SELECT count(*) FROM (SELECT * FROM daily_totals
+                                                 EXCEPT SELECT * FROM ({expected})))
+                          + (SELECT count(*) FROM ({expected}
+                                                 EXCEPT SELECT * FROM daily_totals)) AS count
+                """.format(expected=self.__daily_totals_query)
+        return self.fetchone(query, (shift, shift) * 2)["count"]
 
     def __remove_fact(self, fact_id):
         logger.info("removing fact #{}".format(fact_id))
         statements = ["DELETE FROM fact_tags where fact_id = ?",
                       "DELETE FROM facts where id = ?"]
         self.execute(statements, [(fact_id,)] * 2)
-
-        self.__remove_index([fact_id])
+        if self.__intervals is not None:
+            self.__intervals.discard(fact_id)
 
     def __get_category_activities(self, category_id):
         """returns list of activities, if category is specified, order by name
@@ -794,20 +1240,11 @@ class Storage(storage.Storage):
     def __remove_category(self, id):
         """move all activities to unsorted and remove category"""
 
-        affected_query = """
-            SELECT id
-              FROM facts
-             WHERE activity_id in (SELECT id FROM activities where category_id=?)
-        """
-        affected_ids = [res[0] for res in self.fetchall(affected_query, (id,))]
-
         update = "update activities set category_id = -1 where category_id = ?"
         self.execute(update, (id, ))
 
         self.execute("delete from categories where id = ?", (id, ))
 
-        self.__remove_index(affected_ids)
-
 
     def __add_activity(self, name, category_id = None, temporary = False):
         # first check that we don't have anything like that yet
@@ -830,57 +1267,113 @@ class Storage(storage.Storage):
         self.execute(query, (name, name.lower(), category_id, deleted))
         return self.__last_insert_rowid()
 
-    def __remove_index(self, ids):
-        """remove affected ids from the index"""
-        if not ids:
-            return
-        ids = ",".join((str(id) for id in ids))
-        logger.info("removing fact #{} from index".format(ids))
-        self.execute("DELETE FROM fact_index where id in (%s)" % ids)
-
+    def __optimize_index(self, rebuild=False):
+        """Maintain the full text search index.
 
-    def __check_index(self, start_date, end_date):
-        """check if maybe index needs rebuilding in the time span"""
-        index_query = """SELECT id
-                           FROM facts
-                          WHERE (end_time >= ? OR end_time IS NULL)
-                            AND start_time <= ?
-                            AND id not in(select id from fact_index)"""
+        The index is kept up to date by triggers,
+        this only merges its segments for faster searches.
 
-        rebuild_ids = ",".join([str(res[0]) for res in self.fetchall(index_query, (start_date, end_date))])
+        rebuild (bool): rebuild it from scratch instead,
+                        in case it went out of sync (e.g. after manual edits).
+        """
+        command = "rebuild" if rebuild else "optimize"
+        logger.info("{} search index".format(command))
+        self.execute("INSERT INTO fact_index (fact_index) VALUES (?)", (command,))
 
-        if rebuild_ids:
-            query = """
-                       SELECT a.id AS id,
-                              a.start_time AS start_time,
-                              a.end_time AS end_time,
-                              a.description as description,
-                              b.name AS name, b.id as activity_id,
-                              coalesce(c.name, ?) as category,
-                              e.name as tag
-                         FROM facts a
-                    LEFT JOIN activities b ON a.activity_id = b.id
-                    LEFT JOIN categories c ON b.category_id = c.id
-                    LEFT JOIN fact_tags d ON d.fact_id = a.id
-                    LEFT JOIN tags e ON e.id = d.tag_id
-                        WHERE a.id in (%s)
-                     ORDER BY a.id
-            """ % rebuild_ids
+    def __get_revision(self):
+        """Revision of the last change in the journal."""
+        return self.fetchone("SELECT coalesce(max(revision), 0) FROM fact_changes")[0]
 
-            dbfacts = self.__group_tags(self.fetchall(query, (self._unsorted_localized, )))
-            facts = [self._dbfact_to_libfact(dbfact) for dbfact in dbfacts]
+    def __get_changes_since(self, revision):
+        """Return the facts changed after revision (cf. fact_changes).
 
-            insert = """INSERT INTO fact_index (id, name, category, description, tag)
-                             VALUES (?, ?, ?, ?, ?)"""
-            params = [(fact.id, fact.activity, fact.category, fact.description, " ".join(fact.tags)) for fact in facts]
+        Returns:
+            (revision, facts, removed_ids): the revision of the last change
+            (or revision itself if there is none),
+            the facts added or changed, ordered by revision,
+            and the ids of the facts removed.
+        """
+        query = """
+                   SELECT j.revision AS revision,
+                          j.fact_id AS fact_id,
+                          j.deleted AS deleted,
+                          a.id AS id,
+                          a.start_time AS start_time,
+                          a.end_time AS end_time,
+                          a.description as description,
+                          b.name AS name, b.id as activity_id,
+                          coalesce(c.name, ?) as category,
+                          %s as tags
+                     FROM fact_changes j
+                LEFT JOIN facts a ON a.id = j.fact_id
+                LEFT JOIN activities b ON a.activity_id = b.id
+                LEFT JOIN categories c ON b.category_id = c.id
+                    WHERE j.revision > ?
+                 ORDER BY j.revision
+        """ % TAGS_COLUMN
+        rows = self.fetchall(query, (self._unsorted_localized, revision))
+        if rows:
+            revision = rows[-1]["revision"]
+        facts = [self._dbfact_to_libfact(row) for row in rows if not row["deleted"]]
+        removed_ids = [row["fact_id"] for row in rows if row["deleted"]]
+        return revision, facts, removed_ids
+
+    def __pop_fact_changes(self):
+        """Return and forget the facts changed since the last call.
 
-            self.executemany(insert, params)
+        Returns:
+            list of (id, start_time, end_time), the values before and after
+            each change (a fact moved in time appears twice).
+        """
+        rows = self.fetchall("SELECT id, start_time, end_time FROM temp.changed_facts")
+        self.execute("DELETE FROM temp.changed_facts")
+        return [(row["id"], row["start_time"], row["end_time"]) for row in rows]
 
     """ Here be dragons (lame connection/cursor wrappers) """
+    def __connect(self, read_only=False):
+        profile = self.connection_profile
+        detect_types = sqlite.PARSE_DECLTYPES|sqlite.PARSE_COLNAMES
+        if read_only:
+            # handed over between the worker threads, used by one at a time
+            con = sqlite.connect("file:{}?mode=ro".format(quote(self.db_path)), uri=True,
+                                 detect_types=detect_types, check_same_thread=False,
+                                 cached_statements=profile["cached_statements"])
+            pragmas = []
+        else:
+            con = sqlite.connect(self.db_path, detect_types=detect_types,
+                                 cached_statements=profile["cached_statements"])
+            pragmas = [("journal_mode", profile["journal_mode"]),
+                       ("synchronous", profile["synchronous"])]
+        con.row_factory = sqlite.Row
+        # negative cache_size: in KiB instead of pages
+        pragmas += [("cache_size", -profile["cache_size"]),
+                    ("mmap_size", profile["mmap_size"] * 2 ** 20),
+                    ("temp_store", "memory")]
+        for name, value in pragmas:
+            con.execute("PRAGMA {} = {}".format(name, value))
+        if not read_only:
+            # facts changed through this connection,
+            # until the listeners are told (cf. __pop_fact_changes)
+            con.executescript("""
+                CREATE TEMP TABLE changed_facts (id integer,
+                                                 start_time timestamp,
+                                                 end_time timestamp);
+                CREATE TEMP TRIGGER changed_facts_ai AFTER INSERT ON main.facts BEGIN
+                    INSERT INTO changed_facts VALUES (new.id, new.start_time, new.end_time);
+                END;
+                CREATE TEMP TRIGGER changed_facts_au AFTER UPDATE ON main.facts BEGIN
+                    INSERT INTO changed_facts VALUES (old.id, old.start_time, old.end_time);
+                    INSERT INTO changed_facts VALUES (new.id, new.start_time, new.end_time);
+                END;
+                CREATE TEMP TRIGGER changed_facts_ad AFTER DELETE ON main.facts BEGIN
+                    INSERT INTO changed_facts VALUES (old.id, old.start_time, old.end_time);
+                END;
+            """)
+        return con
+
     def get_connection(self):
         if self.con is None:
-            self.con = sqlite.connect(self.db_path, detect_types=sqlite.PARSE_DECLTYPES|sqlite.PARSE_COLNAMES)
-            self.con.row_factory = sqlite.Row
+            self.con = self.__connect(read_only=self.read_only)
 
         return self.con
 
@@ -892,7 +1385,7 @@ class Storage(storage.Storage):
         Returns:
             list(sqlite.Row)
         """
-        con = self.connection
+        con = getattr(self.__local, "reader", None) or self.connection
         cur = con.cursor()
 
         logger.debug("%s %s" % (query, params))
@@ -949,6 +1442,89 @@ class Storage(storage.Storage):
 
 
 
+    @contextmanager
+    def reading(self):
+        """Run the queries of the current thread on a read-only connection.
+
+        In WAL journal mode, these neither wait for the writes nor block them.
+        Connections are taken from a pool, and given back afterwards.
+        """
+        generation = self.__readers_generation
+        try:
+            con = self.__readers.get_nowait()
+        except queue.Empty:
+            con = self.__connect(read_only=True)
+        self.__local.reader = con
+        try:
+            yield con
+        finally:
+            self.__local.reader = None
+            if generation == self.__readers_generation:
+                self.__readers.put(con)
+            else:
+                con.close()
+
+    def in_reader(self):
+        """Whether the current thread runs its queries within reading().
+
+        e.g. on a read_async worker thread.
+        """
+        return getattr(self.__local, "reader", None) is not None
+
+    def __close_readers(self):
+        """Close the idle read-only connections, and the busy ones once done."""
+        self.__readers_generation += 1
+        while True:
+            try:
+                self.__readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def read_async(self, method, *args, callback=None, error_callback=None, **kwargs):
+        """Call a read-only method on a worker thread.
+
+        Args:
+            method (str or function): name of the method
+                                      (cf. read_only_methods), e.g. "get_facts",
+                                      or a function calling only those.
+            args, kwargs: the method arguments.
+            callback (function): called with the result,
+                                 from the main loop.
+            error_callback (function): called with the exception
+                                       if the method failed, from the main loop.
+        Return:
+            concurrent.futures.Future of the result.
+        """
+        if isinstance(method, str):
+            assert method in self.read_only_methods, "{} is not read-only".format(method)
+            method = getattr(self, method)
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=self.readers,
+                                                 thread_name_prefix="hamster-reader")
+
+        # the settings are only read from the main thread
+        day_start = dt.hday.start_time()
+
+        def read():
+            with self.reading(), dt.hday.fixed_start_time(day_start):
+                return method(*args, **kwargs)
+
+        def done(future):
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is None:
+                if callback:
+                    in_main_loop(callback, future.result())
+            elif error_callback:
+                in_main_loop(error_callback, error)
+            else:
+                logger.error("{} failed: {}".format(method.__name__, error))
+
+        future = self.__executor.submit(read)
+        future.add_done_callback(done)
+        return future
+
     def start_transaction(self):
         # will give some hints to execute not to close or commit anything
         self.__con = self.connection
@@ -960,12 +1536,27 @@ class Storage(storage.Storage):
         self.__con, self.__cur = None, None
         self.register_modification()
 
+    def rollback_transaction(self):
+        """Cancel the changes made since start_transaction."""
+        self.__con.rollback()
+        self.__cur.close()
+        self.__con, self.__cur = None, None
+        # the intervals were updated along, reload them on demand
+        self.__intervals = None
+
+    def check_version(self):
+        """Raise sqlite.DatabaseError unless the database is at schema_version."""
+        version = self.fetchone("SELECT version FROM version")["version"]
+        if version != self.schema_version:
+            raise sqlite.DatabaseError("database version is {}, expected {}"
+                                       .format(version, self.schema_version))
+
     def run_fixtures(self):
         self.start_transaction()
 
         """upgrade DB to hamster version"""
         version = self.fetchone("SELECT version FROM version")["version"]
-        current_version = 9
+        current_version = self.schema_version
 
         if version < 8:
             # working around sqlite's utf-f case sensitivity (bug 624438)
@@ -989,6 +1580,199 @@ class Storage(storage.Storage):
             self.execute("""CREATE VIRTUAL TABLE fact_index
                                            USING fts3(id, name, category, description, tag)""")
 
+        if version < 10:
+            # time range lookups (overview, overlap solving).
+            # Both orders, so either bound of a range can be searched for
+            # without touching the table.
+            self.execute("CREATE INDEX idx_facts_start_end ON facts(start_time, end_time)")
+            self.execute("CREATE INDEX idx_facts_end_start ON facts(end_time, start_time)")
+
+        if version < 11:
+            # full text search kept up to date by triggers,
+            # instead of being rebuilt lazily at search time
+            self.execute("DROP TABLE IF EXISTS fact_index")
+            self.execute("""CREATE VIEW fact_index_content AS
+                                 SELECT a.id AS id,
+                                        b.name AS name,
+                                        c.name AS category,
+                                        a.description AS description,
+                                        %s AS tag
+                                   FROM facts a
+                              LEFT JOIN activities b ON a.activity_id = b.id
+                              LEFT JOIN categories c ON b.category_id = c.id""" % TAGS_COLUMN)
+            self.execute("""CREATE VIRTUAL TABLE fact_index
+                                           USING fts5(name, category, description, tag,
+                                                      content=fact_index_content,
+                                                      content_rowid=id)""")
+
+            # fts5 needs the indexed values to remove a row,
+            # so the affected facts are dropped from the index before the change
+            # and added back after it.
+            remove = """INSERT INTO fact_index (fact_index, rowid, name, category, description, tag)
+                             SELECT 'delete', id, name, category, description, tag
+                               FROM fact_index_content
+                              WHERE id IN (%s);"""
+            add = """INSERT INTO fact_index (rowid, name, category, description, tag)
+                          SELECT id, name, category, description, tag
+                            FROM fact_index_content
+                           WHERE id IN (%s);"""
+            facts_of_activity = "SELECT id FROM facts WHERE activity_id = {}.id"
+            facts_of_category = """SELECT id FROM facts
+                                    WHERE activity_id IN (SELECT id FROM activities
+                                                           WHERE category_id = {}.id)"""
+            triggers = [
+                ("facts_ai", "AFTER INSERT ON facts", "", add % "new.id"),
+                ("facts_bu", "BEFORE UPDATE OF activity_id, description ON facts",
+                 "old.activity_id IS NOT new.activity_id OR old.description IS NOT new.description",
+                 remove % "old.id"),
+                ("facts_au", "AFTER UPDATE OF activity_id, description ON facts",
+                 "old.activity_id IS NOT new.activity_id OR old.description IS NOT new.description",
+                 add % "new.id"),
+                ("facts_bd", "BEFORE DELETE ON facts", "", remove % "old.id"),
+                ("fact_tags_bi", "BEFORE INSERT ON fact_tags", "", remove % "new.fact_id"),
+                ("fact_tags_ai", "AFTER INSERT ON fact_tags", "", add % "new.fact_id"),
+                ("fact_tags_bd", "BEFORE DELETE ON fact_tags", "", remove % "old.fact_id"),
+                ("fact_tags_ad", "AFTER DELETE ON fact_tags", "", add % "old.fact_id"),
+                ("activities_bu", "BEFORE UPDATE OF name, category_id ON activities",
+                 "old.name IS NOT new.name OR old.category_id IS NOT new.category_id",
+                 remove % facts_of_activity.format("old")),
+                ("activities_au", "AFTER UPDATE OF name, category_id ON activities",
+                 "old.name IS NOT new.name OR old.category_id IS NOT new.category_id",
+                 add % facts_of_activity.format("new")),
+                ("activities_bd", "BEFORE DELETE ON activities", "",
+                 remove % facts_of_activity.format("old")),
+                ("activities_ad", "AFTER DELETE ON activities", "",
+                 add % facts_of_activity.format("old")),
+                ("categories_bu", "BEFORE UPDATE OF name ON categories", "old.name IS NOT new.name",
+                 remove % facts_of_category.format("old")),
+                ("categories_au", "AFTER UPDATE OF name ON categories", "old.name IS NOT new.name",
+                 add % facts_of_category.format("new")),
+                ("categories_bd", "BEFORE DELETE ON categories", "",
+                 remove % facts_of_category.format("old")),
+                ("categories_ad", "AFTER DELETE ON categories", "",
+                 add % facts_of_category.format("old")),
+            ]
+            for name, event, when, statement in triggers:
+                self.execute("""CREATE TRIGGER fact_index_{} {} {}
+                                BEGIN {} END""".format(name, event,
+                                                       "WHEN {}".format(when) if when else "",
+                                                       statement))
+
+            self.__optimize_index(rebuild=True)
+
+        if version < 12:
+            # change journal, for GetChangesSince.
+            # Only the last change of each fact is kept
+            # (replacing the previous one), with a new revision.
+            self.execute("""CREATE TABLE fact_changes (revision integer PRIMARY KEY AUTOINCREMENT,
+                                                       fact_id integer NOT NULL UNIQUE,
+                                                       deleted boolean NOT NULL DEFAULT 0)""")
+            # existing facts are the first changes
+            self.execute("INSERT INTO fact_changes (fact_id) SELECT id FROM facts ORDER BY id")
+
+            changed = """INSERT OR REPLACE INTO fact_changes (fact_id, deleted)
+                              SELECT id, 0 FROM facts WHERE id IN (%s);"""
+            deleted = """INSERT OR REPLACE INTO fact_changes (fact_id, deleted)
+                              VALUES (old.id, 1);"""
+            facts_of_activity = "SELECT id FROM facts WHERE activity_id = new.id"
+            facts_of_category = """SELECT id FROM facts
+                                    WHERE activity_id IN (SELECT id FROM activities
+                                                           WHERE category_id = new.id)"""
+            triggers = [
+                ("facts_ai", "AFTER INSERT ON facts", "", changed % "new.id"),
+                ("facts_au", "AFTER UPDATE ON facts", "", changed % "new.id"),
+                ("facts_ad", "AFTER DELETE ON facts", "", deleted),
+                ("fact_tags_ai", "AFTER INSERT ON fact_tags", "", changed % "new.fact_id"),
+                ("fact_tags_ad", "AFTER DELETE ON fact_tags", "", changed % "old.fact_id"),
+                ("activities_au", "AFTER UPDATE OF name, category_id ON activities",
+                 "old.name IS NOT new.name OR old.category_id IS NOT new.category_id",
+                 changed % facts_of_activity),
+                ("categories_au", "AFTER UPDATE OF name ON categories", "old.name IS NOT new.name",
+                 changed % facts_of_category),
+            ]
+            for name, event, when, statement in triggers:
+                self.execute("""CREATE TRIGGER fact_changes_{} {} {}
+                                BEGIN {} END""".format(name, event,
+                                                       "WHEN {}".format(when) if when else "",
+                                                       statement))
+
+        if version < 13:
+            # daily rollup of the finished facts durations, for get_totals.
+            # tag_id 0 rows count each fact once, the other ones per tag.
+            # hday depends on the day start, kept in daily_totals_day_start
+            # (cf. __rebuild_daily_totals).
+            self.execute("""CREATE TABLE daily_totals (hday text NOT NULL,
+                                                       activity_id integer NOT NULL,
+                                                       category_id integer NOT NULL,
+                                                       tag_id integer NOT NULL,
+                                                       minutes integer NOT NULL,
+                                                       PRIMARY KEY (hday, activity_id,
+                                                                    category_id, tag_id))
+                                               WITHOUT ROWID""")
+            self.execute("CREATE TABLE daily_totals_day_start (minutes integer NOT NULL)")
+            self.execute("INSERT INTO daily_totals_day_start VALUES (-1)")
+
+            def hday(start_time):
+                return """date({}, (SELECT '-' || minutes || ' minutes'
+                                      FROM daily_totals_day_start))""".format(start_time)
+
+            def add(sign, fact, tag_id="0", source="", condition=""):
+                """Add (sign 1) or remove (sign -1) the minutes of a finished fact.
+
+                fact: the facts row (e.g. new), or its alias in source (a FROM clause).
+                """
+                return """INSERT INTO daily_totals (hday, activity_id, category_id, tag_id, minutes)
+                               SELECT {hday}, {fact}.activity_id,
+                                      coalesce((SELECT category_id FROM activities
+                                                 WHERE id = {fact}.activity_id), -1),
+                                      {tag_id},
+                                      {sign} * ((strftime('%s', {fact}.end_time)
+                                                 - strftime('%s', {fact}.start_time)) / 60)
+                                 {source}
+                                WHERE {fact}.end_time IS NOT NULL {condition}
+                          ON CONFLICT (hday, activity_id, category_id, tag_id)
+                            DO UPDATE SET minutes = minutes + excluded.minutes;
+                       """.format(hday=hday("{}.start_time".format(fact)), fact=fact,
+                                  tag_id=tag_id, sign=sign, source=source, condition=condition)
+
+            def add_fact(sign, fact):
+                """Same as add, for the fact and each of its tags."""
+                return add(sign, fact) + add(sign, fact, "t.tag_id", "FROM fact_tags t",
+                                             "AND t.fact_id = {}.id".format(fact))
+
+            def cleanup(start_time):
+                return "DELETE FROM daily_totals WHERE hday = {} AND minutes = 0;".format(
+                    hday(start_time))
+
+            # rows down to zero minutes are removed
+            triggers = [
+                ("facts_ai", "AFTER INSERT ON facts", "",
+                 add_fact(1, "new") + cleanup("new.start_time")),
+                ("facts_au", "AFTER UPDATE OF start_time, end_time, activity_id ON facts", "",
+                 add_fact(-1, "old") + add_fact(1, "new")
+                 + cleanup("old.start_time") + cleanup("new.start_time")),
+                ("facts_ad", "AFTER DELETE ON facts", "",
+                 add_fact(-1, "old") + cleanup("old.start_time")),
+                # the fact might be gone already
+                ("fact_tags_ai", "AFTER INSERT ON fact_tags", "",
+                 add(1, "f", "new.tag_id", "FROM facts f", "AND f.id = new.fact_id")
+                 + cleanup("(SELECT start_time FROM facts WHERE id = new.fact_id)")),
+                ("fact_tags_ad", "AFTER DELETE ON fact_tags", "",
+                 add(-1, "f", "old.tag_id", "FROM facts f", "AND f.id = old.fact_id")
+                 + cleanup("(SELECT start_time FROM facts WHERE id = old.fact_id)")),
+                ("activities_au", "AFTER UPDATE OF category_id ON activities",
+                 "old.category_id IS NOT new.category_id",
+                 """UPDATE daily_totals SET category_id = coalesce(new.category_id, -1)
+                     WHERE activity_id = new.id;"""),
+                ("activities_ad", "AFTER DELETE ON activities", "",
+                 "UPDATE daily_totals SET category_id = -1 WHERE activity_id = old.id;"),
+            ]
+            for name, event, when, statement in triggers:
+                self.execute("""CREATE TRIGGER daily_totals_{} {} {}
+                                BEGIN {} END""".format(name, event,
+                                                       "WHEN {}".format(when) if when else "",
+                                                       statement))
+            self.__rebuild_daily_totals()
 
         # at the happy end, update version number
         if version < current_version:
@@ -999,6 +1783,106 @@ class Storage(storage.Storage):
         self.end_transaction()
 
 
+def _day_start_minutes():
+    """Day start, in minutes after midnight."""
+    day_start = dt.hday.start_time()
+    return day_start.hour * 60 + day_start.minute
+
+
+def in_main_loop(func, *args):
+    """Call func(*args) from the main loop (right away without GLib)."""
+    if gio:
+        def once():
+            func(*args)
+            return False  # do not call again
+        glib.idle_add(once)
+    else:
+        func(*args)
+
+
+def default_connection_profile():
+    """Return the connection settings from GSettings.
+
+    journal_mode (str): sqlite journal mode, e.g. "wal".
+    synchronous (str): "off", "normal" or "full".
+    cache_size (int): page cache size, in KiB.
+    mmap_size (int): memory mapped size, in MiB.
+    cached_statements (int): number of prepared statements to keep.
+    """
+    return {"journal_mode": conf.get("database-journal-mode"),
+            "synchronous": conf.get("database-synchronous"),
+            "cache_size": conf.get("database-cache-size"),
+            "mmap_size": conf.get("database-mmap-size"),
+            "cached_statements": conf.get("database-cached-statements")}
+
+
+# tags are aggregated in a single column, joined by the ASCII unit separator
+# (same as char(31) in the queries)
+TAGS_SEPARATOR = "\x1f"
+
+# the tags column of the fact a, in the queries.
+# group_concat order is not defined, cf. split_tags.
+TAGS_COLUMN = """(SELECT group_concat(e.name, char(31))
+                    FROM fact_tags d
+                    JOIN tags e ON e.id = d.tag_id
+                   WHERE d.fact_id = a.id)"""
+
+
+def split_tags(tags):
+    """Sorted list of the tag names of a TAGS_COLUMN value."""
+    return sorted(tags.split(TAGS_SEPARATOR)) if tags else []
+
+
+# search fields, and the fact_index columns they look into
+SEARCH_FIELDS = {"activity": "name",
+                 "category": "category",
+                 "description": "description",
+                 "tag": "tag"}
+
+_SEARCH_TERM = re.compile(r"""(?:(?P<field>\w+):(?=\S))?   # field:
+                              (?:"(?P<phrase>[^"]*)"?(?P<star>\*)?  # "some phrase"
+                                 |(?P<word>\S+))""", re.VERBOSE)
+
+
+def _fts_query(search_terms):
+    """Return the fts5 query matching all the search terms.
+
+    Search terms are words or "quoted phrases", separated by spaces.
+    A trailing * matches by prefix (e.g. banan* or "green banan"*).
+    Terms can be restricted to a field (see SEARCH_FIELDS),
+    e.g. activity:bananas, tag:"working late".
+
+    Everything else is quoted, so that punctuation is taken literally
+    (fts5 would choke on e.g. "e-mail").
+    """
+    terms = []
+    for match in _SEARCH_TERM.finditer(search_terms):
+        field, phrase, word = match.group("field", "phrase", "word")
+        if field and field.lower() not in SEARCH_FIELDS:
+            # not a field after all (e.g. a time, 10:30)
+            field, phrase, word = None, None, match.group(0)
+        if phrase is not None:
+            text, prefix = phrase, match.group("star")
+        else:
+            text, prefix = word.rstrip("*"), word.endswith("*")
+        if not text.strip():
+            continue
+        term = '"{}"{}'.format(text.replace('"', '""'), "*" if prefix else "")
+        if field:
+            term = "{} : {}".format(SEARCH_FIELDS[field.lower()], term)
+        terms.append(term)
+    return " ".join(terms)
+
+
+# sqlite lower() only folds ASCII letters
+_SQL_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def _sql_lower(s):
+    """Same as the sqlite lower() function."""
+    return s.translate(_SQL_LOWER)
+
+
 # datetime/sql conversions
 
 DATETIME_LOCAL_FMT = "%Y-%m-%d %H:%M:%S"
@@ -1009,15 +1893,31 @@ def adapt_datetime(t):
     return t.isoformat(" ")
 
 
+@lru_cache(maxsize=4096)
 def convert_datetime(s):
     """Convert the sql timestamp to datetime.
 
     s is in bytes.
+
+    Cached, the same timestamps come back over and over
+    (e.g. a fact start is often the previous fact end).
+    Returned datetimes are immutable, so sharing them is safe.
     """
 
-    # convert s from bytes to utf-8, and keep only data up to seconds
     # 10 chars for YYYY-MM-DD, 1 space, 8 chars for HH:MM:SS
     # note: let's leave any further rounding to dt.datetime.
+    head = s[0:19]
+    if (len(head) == 19 and head[10] == 32
+        and head.translate(None, b"0123456789") == b"-- ::"):
+        # fast path, the layout written by adapt_datetime
+        # (only digits besides the separators, and the space in the middle)
+        try:
+            return dt.datetime(int(head[0:4]), int(head[5:7]), int(head[8:10]),
+                               int(head[11:13]), int(head[14:16]), int(head[17:19]))
+        except ValueError:
+            pass
+
+    # convert s from bytes to utf-8, and keep only data up to seconds
     datetime_string = s.decode('utf-8')[0:19]
 
     return dt.datetime.strptime(datetime_string, DATETIME_LOCAL_FMT)
@@ -23,9 +23,14 @@ logger = logging.getLogger(__name__)   # noqa: E402
 
 from hamster.lib import datetime as dt
 
+import itertools
+import threading
+import time
+from contextlib import contextmanager
 from textwrap import dedent
 
 from hamster.lib.fact import Fact, FactError
+from hamster.lib.factcache import fact_days
 
 
 class Storage(object):
@@ -35,14 +40,64 @@ class Storage(object):
     such as __get_facts.
     """
 
+    # cursors not used for that long (in seconds) are closed
+    cursor_timeout = 600
+
+    def __init__(self):
+        # cursor id: {range, search_terms, after, last_used, lock}
+        self.__cursors = {}
+        self.__cursor_ids = itertools.count(1)
+        # fetch_facts may run on worker threads
+        self.__cursors_lock = threading.Lock()
+
     def run_fixtures(self):
         pass
 
     # signals that are called upon changes
     def tags_changed(self): pass
-    def facts_changed(self): pass
+    def facts_changed(self, ids=(), min_day=None, max_day=None, revision=0):
+        """Facts were added, changed or removed.
+
+        ids (list of int): the facts concerned.
+        min_day, max_day (hday): get_facts of the days outside that range
+                                 did not change.
+                                 None: no bound, any day might have changed.
+        revision (int): the change journal revision after the change
+                        (cf. get_changes_since), 0 if unknown.
+        """
+        pass
     def activities_changed(self): pass
 
+    def __dispatch_facts_changed(self):
+        """Call facts_changed with the changes made since the last call.
+
+        To be called after any change that might write the facts,
+        so that none is left for the next call.
+        """
+        changes = self.__pop_fact_changes()
+        if not changes:
+            return
+        ids = sorted({fact_id for fact_id, __, __ in changes})
+        days = [fact_days(start_time, end_time) for __, start_time, end_time in changes]
+        self.facts_changed(ids,
+                           min(first_day for first_day, __ in days),
+                           max(last_day for __, last_day in days),
+                           self.__get_revision())
+
+    @contextmanager
+    def transaction(self):
+        """Make the enclosed changes in a single transaction.
+
+        If an exception is raised, the changes are rolled back.
+        """
+        self.start_transaction()
+        try:
+            yield
+        except BaseException:
+            self.rollback_transaction()
+            raise
+        self.end_transaction()
+
     def dispatch_overwrite(self):
         self.tags_changed()
         self.facts_changed()
@@ -109,18 +164,54 @@ class Storage(object):
 
         # better fail before opening the transaction
         self.check_fact(fact)
-        self.start_transaction()
-        result = self.__add_fact(fact, temporary)
-        self.end_transaction()
+        with self.transaction():
+            result = self.__add_fact(fact, temporary)
 
         if result:
-            self.facts_changed()
+            self.__dispatch_facts_changed()
+        return result
+
+    def add_facts(self, facts, temporary=False):
+        """Add several facts at once, in a single transaction.
+
+        facts: iterable of Fact instances.
+
+        Facts are checked first; if any of them is invalid,
+        FactError is raised and nothing is added.
+        Listeners are notified only once.
+
+        Return the list of the new fact ids, in the same order as facts
+        (0 for facts that did not need to be added, cf. add_fact).
+        """
+        facts = list(facts)
+        for fact in facts:
+            self.check_fact(fact)
+        with self.transaction():
+            result = self.__add_facts(facts, temporary)
+
+        if any(result):
+            self.__dispatch_facts_changed()
         return result
 
     def get_fact(self, fact_id):
         """Get fact by id. For output format see GetFacts"""
         return self.__get_fact(fact_id)
 
+    def get_changes_since(self, revision):
+        """Return the changes made to the facts after revision.
+
+        Every change to a fact (or to its activity, category or tags)
+        gets a new revision, so mirrors can keep up to date
+        by asking for the changes since the last revision they saw,
+        starting from 0 (everything).
+
+        Return:
+            (revision, facts, removed_ids): the revision to ask from next time,
+            the facts added or changed since revision
+            and the ids of the facts removed since then.
+        """
+        return self.__get_changes_since(revision)
+
     def update_fact(self, fact_id, fact, start_time=None, end_time=None, temporary=False):
         # to be removed once update facts use Fact directly.
         if isinstance(fact, str):
@@ -128,14 +219,13 @@ class Storage(object):
             fact = fact.copy(start_time=start_time, end_time=end_time)
         # better fail before opening the transaction
         self.check_fact(fact)
-        self.start_transaction()
-        self.__remove_fact(fact_id)
-        result = self.__add_fact(fact, temporary)
-        if not result:
-            logger.warning("failed to update fact {} ({})".format(fact_id, fact))
-        self.end_transaction()
+        with self.transaction():
+            self.__remove_fact(fact_id)
+            result = self.__add_fact(fact, temporary)
+            if not result:
+                logger.warning("failed to update fact {} ({})".format(fact_id, fact))
         if result:
-            self.facts_changed()
+            self.__dispatch_facts_changed()
         return result
 
     def stop_tracking(self, end_time):
@@ -143,7 +233,7 @@ class Storage(object):
         facts = self.__get_todays_facts()
         if facts and not facts[-1].end_time:
             self.__touch_fact(facts[-1], end_time)
-            self.facts_changed()
+            self.__dispatch_facts_changed()
 
 
     def stop_or_restart_tracking(self):
@@ -155,23 +245,104 @@ class Storage(object):
                                              end_time = None))
             else:
                 self.__touch_fact(facts[-1], end_time=dt.datetime.now())
-            self.facts_changed()
+            self.__dispatch_facts_changed()
 
 
     def remove_fact(self, fact_id):
         """Remove fact from storage by it's ID"""
-        self.start_transaction()
-        fact = self.__get_fact(fact_id)
-        if fact:
-            self.__remove_fact(fact_id)
-            self.facts_changed()
-        self.end_transaction()
+        with self.transaction():
+            fact = self.__get_fact(fact_id)
+            if fact:
+                self.__remove_fact(fact_id)
+                self.__dispatch_facts_changed()
+
+
+    def get_facts(self, start, end=None, search_terms="", ranked=False, limit=None, offset=0):
+        """Return facts of the range (see dt.Range.from_start_end).
+
+        search_terms (str): words, "phrases", prefix*, field:term
+                            (see db.SEARCH_FIELDS).
+                            If it starts with "not ", return the facts
+                            that do not match.
+        ranked (bool): best matches first, instead of chronological order.
+        limit (int): return at most that many facts.
+        offset (int): skip the first facts.
+        """
+        range = dt.Range.from_start_end(start, end)
+        return self.__get_facts(range, search_terms, ranked=ranked,
+                                limit=limit, offset=offset)
 
+    def get_totals(self, start, end=None, group_by="category", search_terms=""):
+        """Return the time spent on the facts of get_facts(start, end, search_terms).
 
-    def get_facts(self, start, end=None, search_terms=""):
+        group_by (str): "activity", "category", "tag" or "day"
+                        (hamster day of the fact start).
+        Facts count whole, on-going ones up to now (cf. Fact.delta).
+        Return a list of (name or dt.hday, dt.timedelta), longest first.
+        """
         range = dt.Range.from_start_end(start, end)
-        return self.__get_facts(range, search_terms)
+        return [(key, dt.timedelta(seconds=seconds))
+                for key, seconds in self.__get_totals(range, group_by, search_terms)]
+
+
+    def open_facts_cursor(self, start, end=None, search_terms=""):
+        """Start going through facts a batch at a time (cf. fetch_facts).
 
+        Same arguments as get_facts.
+        Return the cursor id (str).
+        """
+        self.__expire_cursors()
+        with self.__cursors_lock:
+            cursor = "cursor-{}".format(next(self.__cursor_ids))
+            self.__cursors[cursor] = {"range": dt.Range.from_start_end(start, end),
+                                      "search_terms": search_terms,
+                                      "after": None,
+                                      "last_used": time.monotonic(),
+                                      # held from reading to updating "after"
+                                      "lock": threading.Lock()}
+        return cursor
+
+    def fetch_facts(self, cursor, n):
+        """Return the next n facts of the cursor (cf. open_facts_cursor).
+
+        Facts come in chronological order.
+        At the end, return an empty list and close the cursor.
+        Concurrent calls on the same cursor are answered one after the other.
+        """
+        self.__expire_cursors()
+        state = self.__get_cursor(cursor)
+        with state["lock"]:
+            # might have been closed while waiting
+            self.__get_cursor(cursor)
+            facts = self.__get_facts(state["range"], state["search_terms"],
+                                     limit=n, after=state["after"])
+            if facts:
+                state["after"] = (facts[-1].start_time, facts[-1].id)
+            else:
+                self.close_cursor(cursor)
+        return facts
+
+    def close_cursor(self, cursor):
+        """Close the cursor, if not already done."""
+        with self.__cursors_lock:
+            self.__cursors.pop(cursor, None)
+
+    def __get_cursor(self, cursor):
+        """Return the cursor state, marked as used now."""
+        with self.__cursors_lock:
+            state = self.__cursors.get(cursor)
+            if state is None:
+                raise ValueError("unknown or expired cursor: {}".format(cursor))
+            state["last_used"] = time.monotonic()
+        return state
+
+    def __expire_cursors(self):
+        now = time.monotonic()
+        with self.__cursors_lock:
+            for cursor, state in list(self.__cursors.items()):
+                if now - state["last_used"] > self.cursor_timeout:
+                    logger.info("{} expired".format(cursor))
+                    del self.__cursors[cursor]
 
     def get_todays_facts(self):
         """Gets facts of today, respecting hamster midnight. See GetFacts for
@@ -190,10 +361,12 @@ class Storage(object):
 
     def update_category(self, id, name):
         self.__update_category(id, name)
+        self.__dispatch_facts_changed()
         self.activities_changed()
 
     def remove_category(self, id):
         self.__remove_category(id)
+        self.__dispatch_facts_changed()
         self.activities_changed()
 
 
@@ -209,10 +382,12 @@ class Storage(object):
 
     def update_activity(self, id, name, category_id):
         self.__update_activity(id, name, category_id)
+        self.__dispatch_facts_changed()
         self.activities_changed()
 
     def remove_activity(self, id):
         result = self.__remove_activity(id)
+        self.__dispatch_facts_changed()
         self.activities_changed()
         return result
 
@@ -225,6 +400,8 @@ class Storage(object):
     def change_category(self, id, category_id):
         changed = self.__change_category(id, category_id)
         if changed:
+            # merging into an existing activity moves its facts
+            self.__dispatch_facts_changed()
             self.activities_changed()
         return changed
 
@@ -249,3 +426,20 @@ class Storage(object):
         changes = self.__update_autocomplete_tags(tags)
         if changes:
             self.tags_changed()
+
+    # maintenance
+    def optimize_index(self, rebuild=False):
+        self.__optimize_index(rebuild)
+
+    def check_daily_totals(self, rebuild=False):
+        """Check the daily totals rollup (cf. get_totals) against the facts.
+
+        It is kept up to date by triggers; this finds the rows that went
+        out of sync (e.g. after manual edits).
+        rebuild (bool): rebuild it from scratch afterwards.
+        Return the number of wrong or missing rows found.
+        """
+        wrong = self.__check_daily_totals()
+        if rebuild:
+            self.__rebuild_daily_totals()
+        return wrong
@@ -36,7 +36,6 @@ from hamster import client
 from hamster.lib import datetime as dt
 from hamster.lib import stuff
 from hamster.lib import graphics
-from hamster.lib.configuration import runtime
 from hamster.lib.fact import Fact
 
 
@@ -226,7 +225,9 @@ class CmdLineEntry(gtk.Entry):
         self.complete_tree.connect("on-click", self.on_tree_click)
         box.add(self.complete_tree)
 
-        self.storage = client.Storage()
+        self.storage = client.AsyncStorage()
+        self.todays_facts = []
+        self.suggestions = []
         self.load_suggestions()
         self.ignore_stroke = False
 
@@ -293,17 +294,25 @@ class CmdLineEntry(gtk.Entry):
 
 
     def load_suggestions(self):
-        self.todays_facts = self.storage.get_todays_facts()
-
         # list of facts of last month
         now = dt.datetime.now()
-        last_month = self.storage.get_facts(now - dt.timedelta(days=30), now)
+        with self.storage.batch():
+            todays_facts = self.storage.get_todays_facts()
+            last_month = self.storage.get_facts(now - dt.timedelta(days=30), now)
+            activities = self.storage.get_activities()
+        client.when_done([todays_facts, last_month, activities],
+                         lambda: self.set_suggestions(now, todays_facts.result(),
+                                                      last_month.result(), activities.result()))
+
+    def set_suggestions(self, now, todays_facts, last_month, activities):
+        self.todays_facts = todays_facts
 
         # naive recency and frequency rank
         # score is as simple as you get 30-days_ago points for each occurence
         suggestions = defaultdict(int)
-        for fact in last_month:
-            days = 30 - (now - dt.datetime.combine(fact.date, dt.time())).total_seconds() / 60 / 60 / 24
+        dates = dt.hday.from_datetimes(fact.range.start for fact in last_month)
+        for date, fact in zip(dates, last_month):
+            days = 30 - (now - dt.datetime.combine(date, dt.time())).total_seconds() / 60 / 60 / 24
             label = fact.activity
             if fact.category:
                 label += "@%s" % fact.category
@@ -314,7 +323,7 @@ class CmdLineEntry(gtk.Entry):
                 label += " #%s" % (" #".join(fact.tags))
                 suggestions[label] += days
 
-        for rec in self.storage.get_activities():
+        for rec in activities:
             label = rec["name"]
             if rec["category"]:
                 label += "@%s" % rec["category"]
@@ -485,6 +494,7 @@ class ActivityEntry():
             self.widget = gtk.Entry(**kwds)
 
         self.category_widget = category_widget
+        self.storage = client.AsyncStorage()
 
         # internal list of actions added to the suggestions
         self._action_list = []
@@ -580,19 +590,29 @@ class ActivityEntry():
         return True  # prevent the standard callback from overwriting text
 
     def populate_completions(self):
-        self.model.clear()
         if self.filter_on_category:
-            category_names = [self.category_widget.get_text()]
+            category_name = self.category_widget.get_text()
+            self.storage.get_category_id(category_name).add_done_callback(
+                lambda future: self.populate_activities([(future.result(), category_name)]))
         else:
-            category_names = [category['name']
-                              for category in runtime.storage.get_categories()]
-        for category_name in category_names:
-            category_id = runtime.storage.get_category_id(category_name)
-            activities = runtime.storage.get_category_activities(category_id)
-            for activity in activities:
-                activity_name = activity["name"]
-                text = "{}@{}".format(activity_name, category_name)
-                self.model.append([text, activity_name, category_name])
+            self.storage.get_categories().add_done_callback(
+                lambda future: self.populate_activities(
+                    [(category['id'], category['name']) for category in future.result()]))
+
+    def populate_activities(self, categories):
+        """Suggest the activities of categories (list of (id, name))."""
+        with self.storage.batch():
+            activities = [self.storage.get_category_activities(category_id)
+                          for category_id, __ in categories]
+
+        def fill():
+            self.model.clear()
+            for (__, category_name), category_activities in zip(categories, activities):
+                for activity in category_activities.result():
+                    activity_name = activity["name"]
+                    text = "{}@{}".format(activity_name, category_name)
+                    self.model.append([text, activity_name, category_name])
+        client.when_done(activities, fill)
 
     def __getattr__(self, name):
         return getattr(self.widget, name)
@@ -609,6 +629,7 @@ class CategoryEntry():
         self.widget = widget
         if not self.widget:
             self.widget = gtk.Entry(**kwds)
+        self.storage = client.AsyncStorage()
 
         self.completion = self.widget.get_completion()
         if not self.completion:
@@ -653,9 +674,11 @@ class CategoryEntry():
         self.clear()
 
     def populate_completions(self):
-        self.model.clear()
-        for category in runtime.storage.get_categories():
-            self.model.append([category['name']])
+        def fill(future):
+            self.model.clear()
+            for category in future.result():
+                self.model.append([category['name']])
+        self.storage.get_categories().add_done_callback(fill)
 
     def __getattr__(self, name):
         return getattr(self.widget, name)
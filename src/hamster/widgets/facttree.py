@@ -31,6 +31,7 @@ from hamster.lib import datetime as dt
 from hamster.lib import graphics
 from hamster.lib import stuff
 from hamster.lib.fact import Fact
+from hamster.lib.factframe import FactFrame
 
 
 class ActionRow(graphics.Sprite):
@@ -314,6 +315,8 @@ class FactTree(graphics.Scene, gtk.Scrollable):
 
         self.row_positions = []
         self.row_heights = []
+        # id(fact): (y, height) of each fact row
+        self.fact_positions = {}
 
         self.y = 0
         self.day_padding = 20
@@ -416,10 +419,11 @@ class FactTree(graphics.Scene, gtk.Scrollable):
     def set_current_fact(self, fact):
         self.current_fact = fact
 
-        if fact.y < self.y:
-            self.y = fact.y
-        if (fact.y + fact.height) > (self.y + self.height):
-            self.y = fact.y + fact.height - self.height
+        fact_y, fact_height = self.fact_positions[id(fact)]
+        if fact_y < self.y:
+            self.y = fact_y
+        if (fact_y + fact_height) > (self.y + self.height):
+            self.y = fact_y + fact_height - self.height
 
         self.on_scroll()
 
@@ -456,7 +460,8 @@ class FactTree(graphics.Scene, gtk.Scrollable):
 
         if self.hover_day:
             for fact in self.hover_day.get('facts', []):
-                if (fact.y - self.y) <= event.y <= (fact.y - self.y + fact.height):
+                fact_y, fact_height = self.fact_positions[id(fact)]
+                if (fact_y - self.y) <= event.y <= (fact_y - self.y + fact_height):
                     hover_fact = fact
                     break
 
@@ -472,7 +477,8 @@ class FactTree(graphics.Scene, gtk.Scrollable):
         if self.hover_fact:
             self.action_row.visible = True
             self.action_row.x = self.width - 80 - self.action_row.width
-            self.action_row.y = self.hover_fact.y - self.y
+            fact_y, __ = self.fact_positions[id(self.hover_fact)]
+            self.action_row.y = fact_y - self.y
         else:
             self.action_row.visible = False
 
@@ -483,9 +489,8 @@ class FactTree(graphics.Scene, gtk.Scrollable):
         self.set_size_request(500, 300)
 
     def set_facts(self, facts, scroll_to_top=False):
-        # FactTree adds attributes to its facts. isolate these side effects
-        # copy the id too; most of the checks are based on id here.
-        self.facts = [fact.copy(id=fact.id) for fact in facts]
+        # only read, no need to copy them (row positions are kept aside)
+        self.facts = list(facts)
         del facts  # make sure facts is not used by inadvertance below.
 
         # If we get an entirely new set of facts, scroll back to the top
@@ -495,17 +500,18 @@ class FactTree(graphics.Scene, gtk.Scrollable):
         if self.vadjustment:
             self.vadjustment.set_value(self.y)
 
+        dates = dt.hday.from_datetimes(fact.range.start for fact in self.facts)
         if self.facts:
-            start = self.facts[0].date
-            end = self.facts[-1].date
+            start = dates[0]
+            end = dates[-1]
         else:
             start = end = dt.hday.today()
 
         by_date = defaultdict(list)
-        delta_by_date = defaultdict(dt.timedelta)
-        for fact in self.facts:
-            by_date[fact.date].append(fact)
-            delta_by_date[fact.date] += fact.delta
+        for date, fact in zip(dates, self.facts):
+            by_date[date].append(fact)
+        # a year of facts can be shown
+        delta_by_date = dict(FactFrame.from_facts(self.facts).totals("day"))
 
         # Add a TotalFact at the end of each day if we are
         # displaying more than one day.
@@ -545,16 +551,16 @@ class FactTree(graphics.Scene, gtk.Scrollable):
             return
 
         y, pos, heights = 0, [], []
+        self.fact_positions = {}
 
         for date, facts in self.days:
             height = 0
             for fact in facts:
                 self.fact_row.set_fact(fact)
                 fact_height = self.fact_row.height
-                fact.y = y + height
-                fact.height = fact_height
+                self.fact_positions[id(fact)] = (y + height, fact_height)
 
-                height += fact.height
+                height += fact_height
 
             height += self.day_padding
             height = max(height, 60)
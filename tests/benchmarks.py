@@ -0,0 +1,564 @@
+"""Performance benchmarks.
+
+These are not unit tests (they take a while), run them explicitly:
+
+    python3 tests/benchmarks.py            # all of them
+    python3 tests/benchmarks.py get_facts  # only some
+"""
+
+import sys, os.path
+# a convoluted line to add hamster module to absolute path
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "../src")))
+
+import argparse
+import itertools
+import random
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+from hamster.lib import datetime as dt
+from hamster.storage import db
+
+
+benchmarks = {}
+
+
+def benchmark(func):
+    """Register a benchmark."""
+    benchmarks[func.__name__] = func
+    return func
+
+
+def report(label, seconds, count=None):
+    if count:
+        print("    {:<40} {:8.3f} s  ({:.2f} µs each)".format(label, seconds,
+                                                           seconds / count * 1e6))
+    else:
+        print("    {:<40} {:8.3f} s".format(label, seconds))
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    """Best time out of repeat runs. Return (seconds, last result)."""
+    best = None
+    for __ in range(repeat):
+        start = time.perf_counter()
+        res = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+
+def synthetic_storage(database_dir, n_facts=100000, seed=0):
+    """Return a db.Storage filled with n_facts consecutive facts.
+
+    Facts are inserted directly, without the overlap handling,
+    so this is fast even for large databases.
+    The last fact ends now.
+    """
+    rng = random.Random(seed)
+    storage = db.Storage(unsorted_localized="", database_dir=database_dir)
+
+    categories = ["category {}".format(i) for i in range(10)]
+    activities = [("activity {}".format(i), i % len(categories) + 1) for i in range(200)]
+    tags = ["tag {}".format(i) for i in range(50)]
+
+    storage.start_transaction()
+    storage.execute("DELETE FROM activities")
+    storage.execute("DELETE FROM categories")
+    storage.executemany("INSERT INTO categories (id, name, search_name) VALUES (?, ?, ?)",
+                        [(i + 1, name, name) for i, name in enumerate(categories)])
+    storage.executemany("INSERT INTO activities (id, name, search_name, category_id) VALUES (?, ?, ?, ?)",
+                        [(i + 1, name, name, category_id)
+                         for i, (name, category_id) in enumerate(activities)])
+    storage.executemany("INSERT INTO tags (id, name) VALUES (?, ?)",
+                        [(i + 1, name) for i, name in enumerate(tags)])
+
+    durations = [rng.randrange(10, 240) for __ in range(n_facts)]
+    end = dt.datetime.now()
+    start = end - dt.timedelta(minutes=sum(durations))
+    facts = []
+    fact_tags = []
+    for fact_id, duration in enumerate(durations, 1):
+        fact_end = start + dt.timedelta(minutes=duration)
+        facts.append((fact_id, rng.randrange(len(activities)) + 1, start, fact_end,
+                      "description {}".format(fact_id)))
+        for tag_id in rng.sample(range(1, len(tags) + 1), rng.randrange(4)):
+            fact_tags.append((fact_id, tag_id))
+        start = fact_end
+    storage.executemany("""INSERT INTO facts (id, activity_id, start_time, end_time, description)
+                                VALUES (?, ?, ?, ?, ?)""", facts)
+    storage.executemany("INSERT INTO fact_tags (fact_id, tag_id) VALUES (?, ?)", fact_tags)
+    storage.end_transaction()
+    return storage
+
+
+def legacy_get_facts(storage, range):
+    """get_facts as it was before the tags column (one row per tag)."""
+    query = """
+               SELECT a.id AS id,
+                      a.start_time AS start_time,
+                      a.end_time AS end_time,
+                      a.description as description,
+                      b.name AS name, b.id as activity_id,
+                      coalesce(c.name, ?) as category,
+                      e.name as tag
+                 FROM facts a
+            LEFT JOIN activities b ON a.activity_id = b.id
+            LEFT JOIN categories c ON b.category_id = c.id
+            LEFT JOIN fact_tags d ON d.fact_id = a.id
+            LEFT JOIN tags e ON e.id = d.tag_id
+                WHERE (a.end_time >= ? OR a.end_time IS NULL)
+                  AND a.start_time >= ? AND a.start_time <= ?
+             ORDER BY a.start_time, e.name
+    """
+    rows = storage.fetchall(query, ("", range.start,
+                                    range.start - dt.timedelta(days=30),
+                                    range.end))
+    res = []
+    keys = ["id", "start_time", "end_time", "description", "name",
+            "activity_id", "category", "tag"]
+    for fact_id, fact_rows in itertools.groupby(rows, lambda row: row["id"]):
+        fact_rows = list(fact_rows)
+        grouped = dict([(key, fact_rows[0][key]) for key in keys])
+        tags = [row["tag"] for row in fact_rows if row["tag"]]
+        grouped["tags"] = db.TAGS_SEPARATOR.join(tags) if tags else None
+        res.append(storage._dbfact_to_libfact(grouped))
+    return res
+
+
+@benchmark
+def get_facts():
+    """Fact retrieval, one row per tag (legacy) vs one row per fact."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = synthetic_storage(tmpdir)
+        everything = dt.Range(dt.datetime(1970, 1, 1), dt.datetime.now())
+        for label, range in (("month", dt.Range.from_start_end(dt.hday.today() - dt.timedelta(days=30),
+                                                               dt.hday.today())),
+                             ("all 100k facts", everything)):
+            seconds, legacy = timed(legacy_get_facts, storage, range)
+            report("{}, legacy join".format(label), seconds, len(legacy))
+            seconds, facts = timed(storage.get_facts, range)
+            report("{}, tags column".format(label), seconds, len(facts))
+            assert facts == legacy
+
+
+def synthetic_facts(n_facts=100000, seed=0):
+    """List of n_facts consecutive facts, as loaded from the database."""
+    from hamster.lib.fact import Fact
+
+    rng = random.Random(seed)
+    start = dt.datetime(2010, 1, 1)
+    facts = []
+    for i in range(n_facts):
+        end = start + dt.timedelta(minutes=rng.randrange(5, 240))
+        facts.append(Fact(activity="activity {}".format(rng.randrange(50)),
+                          category="category {}".format(rng.randrange(10)),
+                          description="some description" if rng.random() < 0.3 else "",
+                          tags=["tag{}".format(rng.randrange(20))] if rng.random() < 0.3 else [],
+                          start=start, end=end, id=i + 1, activity_id=rng.randrange(50)))
+        start = end
+    return facts
+
+
+@benchmark
+def fact_copy():
+    """Fact footprint and copy, slots vs instance dict, deepcopy vs copy."""
+    import copy
+    import tracemalloc
+    import types
+    from hamster.lib.fact import Fact
+
+    facts = synthetic_facts()
+
+    def footprint(make):
+        """Bytes allocated by make(fact), per fact."""
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        res = [make(fact) for fact in facts]
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        # the list itself
+        size -= sys.getsizeof(res)
+        return size / len(facts)
+
+    # same attributes, in an instance dict (Fact layout without __slots__)
+    dict_layout = lambda fact: types.SimpleNamespace(**{slot: getattr(fact, slot)
+                                                        for slot in Fact.__slots__})
+    print("    {:<40} {:8.0f} bytes".format("instance dict, per fact", footprint(dict_layout)))
+    print("    {:<40} {:8.0f} bytes".format("slots, per fact (range and tags included)", footprint(Fact.copy)))
+
+    seconds, legacy = timed(lambda: [copy.deepcopy(fact) for fact in facts])
+    report("deepcopy", seconds, len(facts))
+    seconds, copies = timed(lambda: [fact.copy() for fact in facts])
+    report("copy", seconds, len(facts))
+    assert copies == legacy == facts
+
+
+@benchmark
+def hdays():
+    """Hamster days of 100k facts, one by one vs in a batch."""
+    facts = synthetic_facts()
+
+    seconds, expected = timed(lambda: [fact.date for fact in facts])
+    report("fact.date", seconds, len(facts))
+    seconds, days = timed(dt.hday.from_datetimes, [fact.range.start for fact in facts])
+    report("hday.from_datetimes", seconds, len(facts))
+    assert days == expected
+
+
+@benchmark
+def arithmetic():
+    """Summing fact durations, through python datetimes (legacy) vs fast path."""
+    facts = synthetic_facts()
+    ranges = [(fact.range.start, fact.range.end) for fact in facts]
+
+    # the conversions of the previous implementation
+    def legacy_timedelta(delta):
+        return dt.timedelta(days=delta.days, seconds=delta.seconds,
+                            microseconds=delta.microseconds)
+
+    def legacy_total():
+        total = dt.timedelta()
+        for start, end in ranges:
+            total = legacy_timedelta(total.to_pdt() + legacy_timedelta(end.to_pdt() - start))
+        return total
+
+    def total():
+        total = dt.timedelta()
+        for start, end in ranges:
+            total += end - start
+        return total
+
+    def legacy_shift():
+        return [dt.datetime.from_pdt(start.to_pdt() + dt.timedelta(hours=1))
+                for start, __ in ranges]
+
+    def shift():
+        return [start + dt.timedelta(hours=1) for start, __ in ranges]
+
+    seconds, expected = timed(legacy_total)
+    report("sum of durations, legacy", seconds, len(ranges))
+    seconds, res = timed(total)
+    report("sum of durations", seconds, len(ranges))
+    assert res == expected and type(res) is dt.timedelta
+    seconds, expected = timed(legacy_shift)
+    report("shifted starts, legacy", seconds, len(ranges))
+    seconds, res = timed(shift)
+    report("shifted starts", seconds, len(ranges))
+    assert res == expected and type(res[0]) is dt.datetime
+    seconds, __ = timed(lambda: sum((fact.delta for fact in facts), dt.timedelta()))
+    report("sum of fact.delta", seconds, len(facts))
+
+
+def parsing_corpus():
+    """Strings parsed in tests/test_stuff.py."""
+    import ast
+
+    with open(os.path.join(os.path.dirname(__file__), "test_stuff.py")) as f:
+        tree = ast.parse(f.read())
+    corpus = []
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr == "parse" and node.args):
+            value = node.args[0]
+        elif (isinstance(node, ast.Assign) and len(node.targets) == 1
+                and isinstance(node.targets[0], ast.Name) and node.targets[0].id == "s"):
+            value = node.value
+        else:
+            continue
+        if isinstance(value, ast.Constant) and isinstance(value.value, str):
+            corpus.append(value.value)
+    return corpus
+
+
+@benchmark
+def parsing():
+    """Fact parsing over the test corpus, re cache vs compiled pattern, memo."""
+    import re
+    from hamster.lib import parsing
+    from hamster.lib.fact import Fact
+
+    texts = parsing_corpus() * 100
+    cases = [(text, range_pos) for text in texts for range_pos in ("head", "tail")]
+
+    def legacy_search():
+        # as before: pattern formatted and looked up in the re cache each time
+        for text, range_pos in cases:
+            if range_pos == "head":
+                p = "^{}( {}(?P<rest>.*?) )?$".format(dt.Range.pattern(), parsing.activity_separator)
+            else:
+                p = "^( (?P<rest>.*?){} )? {}$".format(parsing.activity_separator, dt.Range.pattern())
+            re.search(p, text, flags=re.VERBOSE | re.DOTALL)
+
+    def compiled_search():
+        for text, range_pos in cases:
+            dt.Range._compiled(range_pos, parsing.activity_separator).search(text)
+
+    def uncached():
+        for text, range_pos in cases:
+            parsing._parse_fact.cache_clear()
+            Fact.parse(text, range_pos=range_pos)
+
+    def cached():
+        # e.g. the activity entry parses the same text on change,
+        # then for the suggestions and the completion
+        for text, range_pos in cases:
+            for __ in range(3):
+                Fact.parse(text, range_pos=range_pos)
+
+    seconds, __ = timed(legacy_search)
+    report("range pattern, re cache", seconds, len(cases))
+    seconds, __ = timed(compiled_search)
+    report("range pattern, compiled", seconds, len(cases))
+    seconds, __ = timed(uncached)
+    report("Fact.parse, memo cleared", seconds, len(cases))
+    seconds, __ = timed(cached)
+    report("Fact.parse, each text 3 times", seconds, 3 * len(cases))
+
+
+@benchmark
+def factframe():
+    """Totals of 100k facts, python loops vs fact frame (numpy and fallback)."""
+    from hamster.lib import factframe
+
+    facts = synthetic_facts()
+    now = dt.datetime.now()
+
+    def loops():
+        # as the cli list and the overview fact tree do
+        res = {"category": {}, "day": {}}
+        for fact in facts:
+            delta = fact.delta
+            for group_by, key in (("category", fact.category), ("day", fact.date)):
+                totals = res[group_by]
+                totals[key] = totals.get(key, dt.timedelta()) + delta
+        return res
+
+    def frame_totals(use_numpy):
+        frame = factframe.FactFrame.from_facts(facts, now=now, use_numpy=use_numpy)
+        return {group_by: dict(frame.totals(group_by)) for group_by in ("category", "day")}
+
+    seconds, expected = timed(loops)
+    report("python loops", seconds, len(facts))
+    modes = [("fallback", False)]
+    if factframe.np is not None:
+        modes.append(("numpy", True))
+    for label, use_numpy in modes:
+        seconds, frame = timed(factframe.FactFrame.from_facts, facts, now=now,
+                               use_numpy=use_numpy)
+        report("{}, frame".format(label), seconds, len(facts))
+        seconds, __ = timed(lambda: [frame.totals(group_by) for group_by in factframe.GROUPS])
+        report("{}, all totals of the frame".format(label), seconds, len(facts))
+        seconds, res = timed(frame_totals, use_numpy)
+        report("{}, frame and totals".format(label), seconds, len(facts))
+        assert res == expected
+        seconds, __ = timed(frame.overlaps)
+        report("{}, overlaps".format(label), seconds, len(facts))
+
+
+@benchmark
+def dbus_transport():
+    """Fact (de)serialization, one JSON per fact vs columnar batch."""
+    from hamster.lib import dbus
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = synthetic_storage(tmpdir, n_facts=10000)
+        facts = storage.get_facts(dt.Range(dt.datetime(1970, 1, 1), dt.datetime.now()))
+
+    def json_round_trip():
+        return [dbus.from_dbus_fact_json(dbus.to_dbus_fact_json(fact)) for fact in facts]
+
+    def batch_round_trip():
+        return dbus.from_dbus_facts_batch(dbus.to_dbus_facts_batch(facts))
+
+    seconds, res = timed(lambda: [dbus.to_dbus_fact_json(fact) for fact in facts])
+    report("JSON encoding", seconds, len(facts))
+    seconds, res = timed(json_round_trip)
+    report("JSON round trip", seconds, len(facts))
+    assert res == facts
+    seconds, res = timed(dbus.to_dbus_facts_batch, facts)
+    report("batch encoding", seconds, len(facts))
+    seconds, res = timed(batch_round_trip)
+    report("batch round trip", seconds, len(facts))
+    assert res == facts
+
+
+@benchmark
+def convert_datetime():
+    """sqlite timestamp conversion, strptime vs fast path and cache."""
+    rng = random.Random(0)
+    start = dt.datetime(2010, 1, 1)
+    values = [db.adapt_datetime(start + dt.timedelta(minutes=rng.randrange(5 * 10 ** 6))).encode()
+              for __ in range(100000)]
+
+    def legacy():
+        return [dt.datetime.strptime(value.decode('utf-8')[0:19], db.DATETIME_LOCAL_FMT)
+                for value in values]
+
+    def uncached():
+        res = []
+        for value in values:
+            db.convert_datetime.cache_clear()
+            res.append(db.convert_datetime(value))
+        return res
+
+    def cached():
+        return [db.convert_datetime(value) for value in values]
+
+    seconds, expected = timed(legacy)
+    report("strptime", seconds, len(values))
+    seconds, res = timed(uncached)
+    report("fast path (cache cleared)", seconds, len(values))
+    assert res == expected
+    # typical use: a fact end is the next fact start
+    values = [value for value in values[:len(values) // 2] for __ in range(2)]
+    db.convert_datetime.cache_clear()
+    seconds, res = timed(cached)
+    report("fast path, each value twice", seconds, len(values))
+
+
+@benchmark
+def search():
+    """Full text search, all matches vs the best ones."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = synthetic_storage(tmpdir)
+        everything = dt.Range(dt.datetime(1970, 1, 1), dt.datetime.now())
+        # from every fact down to a handful of them
+        for terms in ("description*", "activity", '"activity 1"', "tag:\"tag 1\"", '"description 12345"'):
+            seconds, facts = timed(storage.get_facts, everything, search_terms=terms)
+            report("{}, all {}".format(terms, len(facts)), seconds)
+            seconds, facts = timed(storage.get_facts, everything, search_terms=terms,
+                                   ranked=True, limit=50)
+            report("{}, best {}".format(terms, len(facts)), seconds)
+
+
+@benchmark
+def tracking():
+    """Write throughput, start/stop tracking cycles."""
+    from hamster.lib.fact import Fact
+
+    # sqlite and python sqlite3 defaults
+    legacy = {"journal_mode": "delete", "synchronous": "full",
+              "cache_size": 2000, "mmap_size": 0, "cached_statements": 128}
+    cycles = 200
+    for label, profile in (("legacy", legacy),
+                           ("default", db.default_connection_profile())):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            storage = synthetic_storage(tmpdir, n_facts=10000)
+            storage.connection.close()
+            storage = db.Storage(unsorted_localized="", database_dir=tmpdir,
+                                 connection_profile=profile)
+            day_start = dt.hday.today().start
+
+            def track():
+                for i in range(cycles):
+                    start = day_start + dt.timedelta(minutes=2 * i)
+                    storage.add_fact(Fact("activity {}".format(i % 20), start_time=start))
+                    storage.stop_tracking(start + dt.timedelta(minutes=1))
+
+            seconds, __ = timed(track, repeat=1)
+            report("{}, {} facts/s".format(label, int(cycles / seconds)), seconds, cycles)
+
+
+@benchmark
+def totals():
+    """Totals of a year and of 100k facts, summing the facts in python vs in SQL vs the daily totals."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = synthetic_storage(tmpdir)
+        today = dt.hday.today()
+        first_day = storage.get_facts(dt.Range(dt.datetime(1970, 1, 1), dt.datetime.now()),
+                                      limit=1)[0].date
+
+        def python_totals(days, group_by):
+            totals = {}
+            for fact in storage.get_facts(*days):
+                for key in (fact.tags if group_by == "tag" else [getattr(fact, group_by)]):
+                    totals[key] = totals.get(key, dt.timedelta()) + fact.delta
+            return totals
+
+        for label, days in (("year", (today - dt.timedelta(days=365), today)),
+                            ("all", (first_day, today))):
+            for group_by in ("activity", "category", "tag"):
+                seconds, expected = timed(python_totals, days, group_by, repeat=1)
+                report("{} by {}, get_facts".format(label, group_by), seconds)
+                # not whole days, the facts are summed up
+                seconds, res = timed(storage.get_totals, days[0].start + dt.timedelta(minutes=1),
+                                     days[1].end, group_by=group_by)
+                report("{} by {}, get_totals, facts".format(label, group_by), seconds)
+                seconds, res = timed(storage.get_totals, *days, group_by=group_by)
+                report("{} by {}, get_totals, rollup".format(label, group_by), seconds)
+                assert dict(res) == expected
+
+
+def run_cli(data_home, *args):
+    """Run hamster-cli.py on the database of data_home, return its duration."""
+    cli = os.path.join(os.path.dirname(__file__), "..", "src", "hamster-cli.py")
+    env = dict(os.environ, XDG_DATA_HOME=data_home)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, cli] + list(args), env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+@contextmanager
+def hamster_service(data_home):
+    """Run a hamster service on the database of data_home, if none is running.
+
+    Yield whether it is running.
+    """
+    import dbus
+    bus = dbus.SessionBus()
+    if bus.name_has_owner("org.gnome.Hamster"):
+        print("    a hamster service is already running (on another database?), skipping D-Bus")
+        yield False
+        return
+    service = os.path.join(os.path.dirname(__file__), "..", "src", "hamster-service.py")
+    process = subprocess.Popen([sys.executable, service],
+                               env=dict(os.environ, XDG_DATA_HOME=data_home),
+                               stdout=subprocess.DEVNULL)
+    try:
+        for __ in range(100):
+            if bus.name_has_owner("org.gnome.Hamster"):
+                break
+            time.sleep(0.1)
+        yield True
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@benchmark
+def direct_mode():
+    """Command line, through the D-Bus service vs reading the database directly."""
+    from hamster import client
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        synthetic_storage(os.path.join(tmpdir, "hamster")).connection.close()
+        year = (dt.hday.today() - dt.timedelta(days=365), dt.hday.today())
+        year_args = [day.strftime("%Y-%m-%d") for day in year]
+        with hamster_service(tmpdir) as service_running:
+            modes = [("direct", ["--direct"])]
+            if service_running:
+                modes.insert(0, ("dbus", []))
+            for mode, options in modes:
+                seconds, __ = timed(run_cli, tmpdir, *options, "current")
+                report("{}, cli current".format(mode), seconds)
+                seconds, __ = timed(run_cli, tmpdir, *options, "list", *year_args)
+                report("{}, cli list of a year".format(mode), seconds)
+
+                storage = client.open_storage(mode, database_dir=os.path.join(tmpdir, "hamster"))
+                # first call, before the client cache kicks in
+                seconds, facts = timed(storage.get_facts, *year, repeat=1)
+                report("{}, get_facts of a year".format(mode), seconds, len(facts))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hamster benchmarks")
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help="benchmarks to run (default: all): {}".format(", ".join(benchmarks)))
+    args = parser.parse_args()
+    for name in args.names or benchmarks:
+        print("{}: {}".format(name, benchmarks[name].__doc__))
+        benchmarks[name]()
@@ -0,0 +1,957 @@
+import sys, os.path
+# a convoluted line to add hamster module to absolute path
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "../src")))
+
+import datetime as pdt
+import random
+import tempfile
+import time
+import unittest
+from unittest import mock
+from hamster import client
+from hamster.lib import datetime as dt
+from hamster.lib.dbus import (
+    from_dbus_fact_json,
+    from_dbus_range,
+    to_dbus_fact_json,
+    to_dbus_facts_batch,
+    )
+from hamster.lib.fact import Fact, FactError
+from hamster.lib.factcache import FactCache
+from hamster.storage import db
+
+
+class StorageTestCase(unittest.TestCase):
+    """Run against a fresh database in a temporary directory."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.storage = db.Storage(unsorted_localized="",
+                                  database_dir=self.tmpdir.name)
+
+    def tearDown(self):
+        self.storage.connection.close()
+        self.tmpdir.cleanup()
+
+
+class TestConversions(unittest.TestCase):
+    def test_datetime_round_trip(self):
+        rng = random.Random(0)
+        start = pdt.datetime(1970, 1, 1)
+        for __ in range(1000):
+            t = start + pdt.timedelta(seconds=rng.randrange(2 ** 32),
+                                      microseconds=rng.randrange(10 ** 6))
+            sql = db.adapt_datetime(t).encode()
+            db.convert_datetime.cache_clear()
+            converted = db.convert_datetime(sql)
+            self.assertEqual(type(converted), dt.datetime)
+            self.assertEqual(converted, dt.datetime.from_pdt(t))
+            # cached
+            self.assertIs(db.convert_datetime(sql), converted)
+            # same as the plain strptime conversion
+            legacy = dt.datetime.strptime(sql.decode()[0:19], db.DATETIME_LOCAL_FMT)
+            self.assertEqual(converted, legacy)
+
+    def test_datetime_fallback(self):
+        self.assertEqual(db.convert_datetime(b"2020-01-05 9:01:00"),
+                         dt.datetime(2020, 1, 5, 9, 1))
+        for s in (b"2020-01-05T09:01:00", b"2020-01-05 09:01", b"2020-13-05 09:01:00"):
+            with self.assertRaises(ValueError):
+                db.convert_datetime(s)
+
+
+class TestConnection(StorageTestCase):
+    def pragma(self, name):
+        return self.storage.connection.execute("PRAGMA {}".format(name)).fetchone()[0]
+
+    def test_profile(self):
+        profile = self.storage.connection_profile
+        self.assertEqual(self.pragma("journal_mode"), profile["journal_mode"])
+        # NORMAL
+        self.assertEqual(self.pragma("synchronous"), 1)
+        self.assertEqual(self.pragma("cache_size"), -profile["cache_size"])
+        self.assertEqual(self.pragma("mmap_size"), profile["mmap_size"] * 2 ** 20)
+        # MEMORY
+        self.assertEqual(self.pragma("temp_store"), 2)
+
+    def test_custom_profile(self):
+        self.storage.connection.close()
+        profile = dict(self.storage.connection_profile,
+                       journal_mode="delete", synchronous="full", mmap_size=0)
+        self.storage = db.Storage(unsorted_localized="",
+                                  database_dir=self.tmpdir.name,
+                                  connection_profile=profile)
+        self.assertEqual(self.pragma("journal_mode"), "delete")
+        # FULL
+        self.assertEqual(self.pragma("synchronous"), 2)
+        self.assertEqual(self.pragma("mmap_size"), 0)
+
+
+class TestCursors(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        start = dt.datetime(2020, 1, 15, 8)
+        facts = [Fact("{} {}".format("bananas" if i % 3 else "apples", i),
+                      start_time=start + dt.timedelta(minutes=10 * i),
+                      end_time=start + dt.timedelta(minutes=10 * i + 5))
+                 for i in range(25)]
+        # same start, ordered by id
+        facts.append(Fact("bananas again", start_time=start, end_time=start))
+        self.storage.add_facts(facts)
+
+    def fetch_all(self, cursor, n):
+        res = []
+        while True:
+            facts = self.storage.fetch_facts(cursor, n)
+            if not facts:
+                return res
+            self.assertLessEqual(len(facts), n)
+            res += facts
+
+    def test_fetch(self):
+        for n in (1, 7, 100):
+            cursor = self.storage.open_facts_cursor(dt.hday(2020, 1, 15))
+            self.assertEqual(self.fetch_all(cursor, n),
+                             self.storage.get_facts(dt.hday(2020, 1, 15)))
+            # closed at the end
+            with self.assertRaises(ValueError):
+                self.storage.fetch_facts(cursor, n)
+            self.storage.close_cursor(cursor)
+
+    def test_concurrent_fetch(self):
+        cursor = self.storage.open_facts_cursor(dt.hday(2020, 1, 15))
+        futures = [self.storage.read_async(lambda: self.storage.fetch_facts(cursor, 3))
+                   for __ in range(10)]
+        # 26 facts: 9 batches, then the empty one closing the cursor
+        facts = [fact for future in futures for fact in future.result(timeout=10)]
+        # each batch once
+        self.assertEqual(sorted(fact.id for fact in facts),
+                         sorted(fact.id for fact in self.storage.get_facts(dt.hday(2020, 1, 15))))
+
+    def test_search(self):
+        cursor = self.storage.open_facts_cursor(dt.hday(2020, 1, 15), search_terms="bananas")
+        facts = self.fetch_all(cursor, 4)
+        self.assertEqual(len(facts), 17)
+        self.assertEqual(facts, self.storage.get_facts(dt.hday(2020, 1, 15),
+                                                       search_terms="bananas"))
+
+    def test_expire(self):
+        cursor = self.storage.open_facts_cursor(dt.hday(2020, 1, 15))
+        self.storage.fetch_facts(cursor, 2)
+        self.storage.cursor_timeout = -1
+        with self.assertRaises(ValueError):
+            self.storage.fetch_facts(cursor, 2)
+
+
+class TestFactCache(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fetched = []
+        day = dt.hday(2020, 1, 10)
+        # spanning several days, early morning, on-going
+        fact_strs = ["2020-01-09 10:00 - 2020-01-09 12:00 before",
+                     "2020-01-10 23:00 - 2020-01-11 02:00 late",
+                     "2020-01-11 03:00 - 2020-01-14 03:00 long",
+                     "2020-01-14 04:00 - 2020-01-14 09:00 crossing day start",
+                     "2020-01-15 10:00 - 2020-01-15 11:00 bananas",
+                     "2020-01-16 10:00 ongoing"]
+        self.storage.add_facts([Fact.parse(fact_str, default_day=day)
+                                for fact_str in fact_strs])
+        self.cache = FactCache()
+
+    def fetch(self, first_day, last_day):
+        self.fetched.append((first_day, last_day))
+        return self.storage.get_facts(first_day, last_day)
+
+    def test_same_as_storage(self):
+        start = dt.hday(2020, 1, 8)
+        for first in range(12):
+            for length in (0, 1, 3):
+                first_day = start + dt.timedelta(days=first)
+                last_day = first_day + dt.timedelta(days=length)
+                days = dt.Range.from_start_end(first_day, last_day)
+                self.assertEqual(self.cache.get(days, self.fetch),
+                                 self.storage.get_facts(first_day, last_day),
+                                 days)
+
+    def test_hits(self):
+        days = dt.Range.from_start_end(dt.hday(2020, 1, 10), dt.hday(2020, 1, 12))
+        self.cache.get(days, self.fetch)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 3))
+        days = dt.Range.from_start_end(dt.hday(2020, 1, 8), dt.hday(2020, 1, 14))
+        self.cache.get(days, self.fetch)
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 7))
+        # only the missing days
+        self.assertEqual(self.fetched, [(dt.hday(2020, 1, 10), dt.hday(2020, 1, 12)),
+                                        (dt.hday(2020, 1, 8), dt.hday(2020, 1, 9)),
+                                        (dt.hday(2020, 1, 13), dt.hday(2020, 1, 14))])
+        facts = self.cache.get(days, self.fetch)
+        self.assertEqual((self.cache.hits, self.cache.misses), (10, 7))
+        # copies
+        facts[0].activity = "changed"
+        self.assertEqual(self.cache.get(days, self.fetch)[0].activity, "before")
+
+        self.cache.invalidate(dt.hday(2020, 1, 9), dt.hday(2020, 1, 10))
+        self.cache.get(days, self.fetch)
+        self.assertEqual(self.fetched[-1], (dt.hday(2020, 1, 9), dt.hday(2020, 1, 10)))
+        self.cache.invalidate()
+        self.cache.get(days, self.fetch)
+        self.assertEqual(self.fetched[-1], (dt.hday(2020, 1, 8), dt.hday(2020, 1, 14)))
+
+    def test_store(self):
+        days = dt.Range.from_start_end(dt.hday(2020, 1, 10), dt.hday(2020, 1, 12))
+        self.assertIsNone(self.cache.get(days))
+        generation = self.cache.generation
+        facts = self.storage.get_facts(days)
+        self.cache.store(days, facts, generation)
+        self.assertEqual(self.cache.get(days), facts)
+        self.assertEqual(self.cache.get(dt.Range.from_start_end(dt.hday(2020, 1, 11))),
+                         self.storage.get_facts(dt.hday(2020, 1, 11)))
+
+        # outdated by the time they come
+        generation = self.cache.generation
+        self.cache.invalidate(dt.hday(2020, 1, 11))
+        self.cache.store(days, facts, generation)
+        self.assertIsNone(self.cache.get(days))
+        self.assertEqual(self.fetched, [])
+
+    def test_not_whole_days(self):
+        for days in (dt.Range(dt.datetime(2020, 1, 10, 12), dt.datetime(2020, 1, 11, 12)),
+                      dt.Range(dt.hday(2020, 1, 10).start, None)):
+            self.assertIsNone(self.cache.get(days, self.fetch))
+        self.assertEqual(self.fetched, [])
+
+
+class FakeService():
+    """The service methods used below, without D-Bus."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def AddFactJSON(self, dbus_fact):
+        return self.storage.add_fact(from_dbus_fact_json(dbus_fact))
+
+    def GetFactsBatch(self, dbus_range, search_terms):
+        return to_dbus_facts_batch(self.storage.get_facts(from_dbus_range(dbus_range),
+                                                          search_terms=search_terms))
+
+    def OpenFactsCursor(self, dbus_range, search_terms):
+        return self.storage.open_facts_cursor(from_dbus_range(dbus_range),
+                                              search_terms=search_terms)
+
+    def FetchFacts(self, cursor, n):
+        return [to_dbus_fact_json(fact) for fact in self.storage.fetch_facts(cursor, n)]
+
+    def CloseCursor(self, cursor):
+        self.storage.close_cursor(cursor)
+
+
+class FakeAsyncService(FakeService):
+    """Same, replying through the reply_handler and error_handler."""
+
+    def __getattribute__(self, name):
+        method = super().__getattribute__(name)
+        if not name[0].isupper():
+            return method
+
+        def call(*args, reply_handler, error_handler):
+            try:
+                result = method(*args)
+            except Exception as error:
+                error_handler(error)
+            else:
+                reply_handler(*(() if result is None else (result,)))
+        return call
+
+
+class TestClientFactCache(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        with mock.patch("dbus.SessionBus"):
+            self.client = client.Storage()
+        self.client._connection = FakeService(self.storage)
+        self.day = dt.hday(2020, 1, 10)
+        self.client.add_fact(Fact.parse("10:00 - 11:00 first", default_day=self.day))
+
+    def add_and_get(self):
+        self.assertEqual(len(self.client.get_facts(self.day)), 1)
+        self.client.add_fact(Fact.parse("12:00 - 13:00 second", default_day=self.day))
+        self.assertEqual([fact.activity for fact in self.client.get_facts(self.day)],
+                         ["first", "second"])
+
+    def test_own_writes(self):
+        # signals are delivered (as this one), but too late for the next call
+        self.client._on_facts_changed_v2([], 0, 0, 1)
+        self.add_and_get()
+        self.assertEqual(self.client.facts_cache_stats, (0, 2))
+        self.client.get_facts(self.day)
+        self.assertEqual(self.client.facts_cache_stats, (1, 2))
+
+    def test_without_signals(self):
+        # changes from others would go unnoticed
+        self.add_and_get()
+        self.client.get_facts(self.day)
+        self.assertEqual(self.client.facts_cache_stats, (0, 0))
+
+
+class TestFetchFactsBatches(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        with mock.patch("dbus.SessionBus"):
+            self.client = client.AsyncStorage()
+        self.client._connection = FakeAsyncService(self.storage)
+        self.day = dt.hday(2020, 1, 15)
+        self.storage.add_facts([Fact.parse("{:02}:00 - {:02}:30 fact{}".format(hour, hour, hour),
+                                           default_day=self.day)
+                                for hour in range(6, 23)])
+        self.batches = []
+
+    def test_batches(self):
+        done = self.client.fetch_facts_batches(self.day, batch_size=5,
+                                               callback=self.batches.append)
+        self.assertEqual(done.result(), 17)
+        self.assertEqual([len(batch) for batch in self.batches], [5, 5, 5, 2])
+        self.assertEqual([fact.activity for batch in self.batches for fact in batch],
+                         [fact.activity for fact in self.storage.get_facts(self.day)])
+
+    def test_stop(self):
+        def callback(facts):
+            self.batches.append(facts)
+            return len(self.batches) < 2
+        with mock.patch.object(self.storage, "close_cursor",
+                               wraps=self.storage.close_cursor) as close_cursor:
+            done = self.client.fetch_facts_batches(self.day, batch_size=5, callback=callback)
+        self.assertEqual(done.result(), 10)
+        cursor, = close_cursor.call_args[0]
+        with self.assertRaises(ValueError):
+            self.storage.fetch_facts(cursor, 5)
+
+    def test_no_callback(self):
+        with self.assertRaises(TypeError):
+            self.client.fetch_facts_batches(self.day, batch_size=5)
+
+    def test_error(self):
+        def callback(facts):
+            raise KeyError("boom")
+        done = self.client.fetch_facts_batches(self.day, batch_size=5, callback=callback)
+        with self.assertRaises(KeyError):
+            done.result()
+
+
+class TestFactsChanged(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.changes = []
+        self.storage.facts_changed = lambda *args: self.changes.append(args)
+
+    def assertChanged(self, ids, min_day, max_day):
+        *change, revision = self.changes[-1]
+        self.assertEqual(change, [ids, min_day, max_day])
+        # latest revision
+        self.assertEqual(revision, self.storage.get_changes_since(revision - 1)[0])
+        if len(self.changes) > 1:
+            self.assertGreater(revision, self.changes[-2][-1])
+
+    def test_changes(self):
+        day = dt.hday(2020, 1, 10)
+        fact = Fact.parse("10:00 - 12:00 first", default_day=day)
+        first_id = self.storage.add_fact(fact)
+        self.assertChanged([first_id], day, day)
+
+        # truncating the first one
+        second_id = self.storage.add_fact(
+            Fact.parse("11:00 - 2020-01-12 13:00 second", default_day=day))
+        self.assertChanged([first_id, second_id], day, dt.hday(2020, 1, 12))
+
+        # a fact starting right at the day start also ends the previous day
+        start = day.start + dt.timedelta(days=5)
+        third_id = self.storage.add_fact(Fact("third", start_time=start,
+                                              end_time=start + dt.timedelta(hours=1)))
+        self.assertChanged([third_id], dt.hday(2020, 1, 14), dt.hday(2020, 1, 15))
+
+        # moved, both the old and new days
+        fact = self.storage.get_fact(first_id)
+        fact.start_time -= dt.timedelta(days=3)
+        new_id = self.storage.update_fact(first_id, fact)
+        self.assertChanged([first_id, new_id], dt.hday(2020, 1, 7), day)
+
+        self.storage.remove_fact(new_id)
+        self.assertChanged([new_id], dt.hday(2020, 1, 7), day)
+        # nothing changed
+        self.storage.stop_tracking(dt.datetime.now())
+        self.assertEqual(len(self.changes), 5)
+
+    def test_activity_merged(self):
+        # the same activity in two categories
+        first_id = self.storage.add_fact(Fact.parse("2020-01-10 10:00 - 11:00 merged@one"))
+        second_id = self.storage.add_fact(Fact.parse("2020-01-20 10:00 - 11:00 merged@two"))
+        activity = self.storage.get_activity_by_name("merged", self.storage.get_category_id("one"))
+        self.assertTrue(self.storage.change_category(activity["id"],
+                                                     self.storage.get_category_id("two")))
+        # the facts moved to the other activity
+        self.assertChanged([first_id], dt.hday(2020, 1, 10), dt.hday(2020, 1, 10))
+
+        # and are not reported again with the next change
+        third_id = self.storage.add_fact(Fact.parse("2020-01-20 12:00 - 13:00 third"))
+        self.assertChanged([third_id], dt.hday(2020, 1, 20), dt.hday(2020, 1, 20))
+        self.assertNotIn(second_id, self.changes[-1][0])
+
+    def test_on_going(self):
+        start = dt.datetime(2020, 1, 10, 10)
+        fact_id = self.storage.add_fact(Fact("on-going", start_time=start))
+        # on-going facts are part of get_facts up to 30 days later
+        self.assertChanged([fact_id], dt.hday(2020, 1, 10), dt.hday(2020, 2, 9))
+
+
+class TestChangesSince(StorageTestCase):
+    def sync(self, mirror, revision):
+        """Apply the changes since revision to mirror (id: fact)."""
+        revision, facts, removed_ids = self.storage.get_changes_since(revision)
+        for fact in facts:
+            mirror[fact.id] = fact
+        for fact_id in removed_ids:
+            mirror.pop(fact_id, None)
+        return revision, len(facts) + len(removed_ids)
+
+    def assertMirrored(self, mirror):
+        everything = dt.Range(dt.datetime(2000, 1, 1), dt.datetime(2100, 1, 1))
+        self.assertEqual(sorted(mirror.values(), key=lambda fact: fact.id),
+                         sorted(self.storage.get_facts(everything), key=lambda fact: fact.id))
+
+    def test_sync(self):
+        day = dt.hday(2020, 1, 10)
+        self.storage.add_facts([Fact.parse("{}:00 - {}:30 activity {}@category,, #tag"
+                                           .format(hour, hour, hour), default_day=day)
+                                for hour in range(8, 18)])
+        mirror = {}
+        revision, count = self.sync(mirror, 0)
+        self.assertEqual(count, 10)
+        self.assertMirrored(mirror)
+        self.assertEqual(self.sync(mirror, revision), (revision, 0))
+
+        facts = self.storage.get_facts(day)
+        # only what changed since, whatever the history before
+        self.storage.remove_fact(facts[0].id)
+        self.storage.update_fact(facts[1].id, facts[1].copy(description="changed"))
+        revision, count = self.sync(mirror, revision)
+        self.assertEqual(count, 3)  # removed, removed by the update, added
+        self.assertMirrored(mirror)
+
+        # renaming changes the facts too
+        category_id = self.storage.get_category_id("category")
+        self.storage.update_category(category_id, "renamed")
+        activity = self.storage.get_activity_by_name("activity 12", category_id)
+        self.storage.update_activity(activity["id"], "renamed activity", category_id)
+        revision, count = self.sync(mirror, revision)
+        self.assertEqual(count, 9)
+        self.assertMirrored(mirror)
+        self.assertEqual(self.sync(mirror, revision), (revision, 0))
+
+        fact = self.storage.get_fact(facts[2].id)
+        self.storage.execute("INSERT INTO fact_tags (fact_id, tag_id) VALUES (?, ?)",
+                             (fact.id, self.storage.get_tag_ids(["other"])[0]["id"]))
+        revision, count = self.sync(mirror, revision)
+        self.assertEqual(count, 1)
+        self.assertMirrored(mirror)
+
+
+class TestReadOnly(StorageTestCase):
+    def open(self):
+        return db.Storage(unsorted_localized="", database_dir=self.tmpdir.name,
+                          read_only=True)
+
+    def test_read(self):
+        day = dt.hday(2020, 1, 10)
+        self.storage.add_fact(Fact.parse("10:00 - 11:00 activity@category #tag",
+                                         default_day=day))
+        reader = self.open()
+        self.assertEqual(reader.get_facts(day), self.storage.get_facts(day))
+        self.assertEqual([row["name"] for row in reader.get_categories()],
+                         [row["name"] for row in self.storage.get_categories()])
+        # the service (here self.storage) stays the only writer
+        with self.assertRaises(db.sqlite.OperationalError):
+            reader.add_fact(Fact.parse("12:00 - 13:00 other", default_day=day))
+        self.assertEqual(len(self.storage.get_facts(day)), 1)
+
+    def test_not_upgraded(self):
+        self.storage.execute("UPDATE version SET version = version - 1")
+        with self.assertRaises(db.sqlite.DatabaseError):
+            self.open()
+
+    def test_missing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaises(db.sqlite.OperationalError):
+                db.Storage(database_dir=os.path.join(tmpdir, "none"), read_only=True)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, "none")))
+
+
+class TotalsTestCase(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        day = dt.hday(2020, 1, 10)
+        facts = ["09:00 - 10:30 one@work,, #a #b",
+                 "11:00 - 12:00 two@work,, #a",
+                 "13:00 - 15:15 one@home",
+                 # around midnight, then before the default day start (05:30)
+                 "23:00 - 01:00 three",
+                 "2020-01-11 03:00 - 2020-01-11 04:00 two@work",
+                 "2020-01-11 08:00 - 2020-01-11 08:45 other@home,, #b"]
+        self.storage.add_facts([Fact.parse(fact, default_day=day) for fact in facts])
+        self.range = (day, dt.hday(2020, 1, 11))
+
+    def expected(self, group_by, facts):
+        totals = {}
+        for fact in facts:
+            if group_by == "tag":
+                keys = fact.tags
+            elif group_by == "day":
+                keys = [fact.date]
+            else:
+                keys = [getattr(fact, group_by)]
+            for key in keys:
+                totals[key] = totals.get(key, dt.timedelta()) + fact.delta
+        return sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+
+
+class TestTotals(TotalsTestCase):
+    def test_same_as_facts(self):
+        first_day, last_day = self.range
+        # whole days or not
+        for span in (self.range, (first_day.start + dt.timedelta(hours=10), last_day.end)):
+            for search_terms in ("", "work", "not work"):
+                facts = self.storage.get_facts(*span, search_terms=search_terms)
+                for group_by in ("activity", "category", "tag", "day"):
+                    self.assertEqual(self.storage.get_totals(*span, group_by=group_by,
+                                                             search_terms=search_terms),
+                                     self.expected(group_by, facts),
+                                     (span, group_by, search_terms))
+
+    def test_day_start(self):
+        totals = dict(self.storage.get_totals(*self.range, group_by="day"))
+        # 03:00 is before the day start, still on the 10th
+        self.assertEqual(totals, {dt.hday(2020, 1, 10): dt.timedelta(hours=7, minutes=45),
+                                  dt.hday(2020, 1, 11): dt.timedelta(minutes=45)})
+
+    def test_on_going(self):
+        start = dt.datetime.now() - dt.timedelta(minutes=90)
+        self.storage.add_fact(Fact("tracking", start_time=start))
+        (activity, delta), = self.storage.get_totals(start, dt.datetime.now(),
+                                                      group_by="activity")
+        self.assertEqual(activity, "tracking")
+        self.assertAlmostEqual(delta.total_seconds(), 90 * 60, delta=60)
+
+    def test_unknown_group(self):
+        with self.assertRaises(ValueError):
+            self.storage.get_totals(*self.range, group_by="description")
+
+
+class TestDailyTotals(TotalsTestCase):
+    def assertTotals(self):
+        self.assertEqual(self.storage.check_daily_totals(), 0)
+        facts = self.storage.get_facts(*self.range)
+        for group_by in ("activity", "category", "tag", "day"):
+            self.assertEqual(self.storage.get_totals(*self.range, group_by=group_by),
+                             self.expected(group_by, facts),
+                             group_by)
+
+    def test_writes(self):
+        self.assertTotals()
+        day = self.range[0]
+        facts = self.storage.get_facts(day)
+        self.storage.update_fact(facts[0].id, facts[0].copy(start_time=facts[0].start_time
+                                                            - dt.timedelta(minutes=20),
+                                                            tags=["c"]))
+        self.storage.remove_fact(facts[1].id)
+        # overlapping, cutting the others
+        self.storage.add_fact(Fact.parse("14:00 - 23:30 four@work,, #b", default_day=day))
+        self.assertTotals()
+
+        category_id = self.storage.get_category_id("work")
+        activity = self.storage.get_activity_by_name("two", category_id)
+        self.storage.change_category(activity["id"], self.storage.get_category_id("home"))
+        self.storage.remove_category(self.storage.get_category_id("home"))
+        self.storage.update_category(category_id, "job")
+        self.assertTotals()
+
+        self.storage.add_fact(Fact("tracking", start_time=day.end - dt.timedelta(hours=1)))
+        self.assertTotals()
+        self.storage.stop_tracking(day.end)
+        self.assertTotals()
+
+    def test_check(self):
+        self.storage.execute("UPDATE daily_totals SET minutes = minutes + 1 WHERE tag_id != 0")
+        self.storage.execute("DELETE FROM daily_totals WHERE tag_id = 0")
+        wrong = self.storage.check_daily_totals(rebuild=True)
+        self.assertGreater(wrong, 3)
+        self.assertTotals()
+
+    def test_day_start_changed(self):
+        self.storage.execute("UPDATE daily_totals_day_start SET minutes = 0")
+        self.storage.execute("DELETE FROM daily_totals")
+        facts = self.storage.get_facts(*self.range)
+        self.assertEqual(self.storage.get_totals(*self.range, group_by="day"),
+                         self.expected("day", facts))
+        # rebuilt on the next start
+        self.storage.connection.close()
+        self.storage = db.Storage(unsorted_localized="", database_dir=self.tmpdir.name)
+        self.assertGreater(self.storage.fetchone("SELECT count(*) FROM daily_totals")[0], 0)
+        self.assertTotals()
+
+
+class TestReaders(StorageTestCase):
+    def run_main_loop(self, done, timeout=10):
+        """Dispatch the main loop events (if GLib is there) until done()."""
+        if not db.gio:
+            # callbacks are called right away
+            return
+        context = db.glib.MainContext.default()
+        deadline = time.monotonic() + timeout
+        while not done() and time.monotonic() < deadline:
+            if not context.iteration(False):
+                time.sleep(0.001)
+
+    def test_read_async(self):
+        self.storage.add_fact(Fact.parse("2020-01-15 10:00 - 2020-01-15 11:00 bananas@Food"))
+        results = []
+        future = self.storage.read_async("get_facts", dt.hday(2020, 1, 15),
+                                         callback=results.append)
+        expected = self.storage.get_facts(dt.hday(2020, 1, 15))
+        self.assertEqual(future.result(timeout=10), expected)
+        self.run_main_loop(lambda: results)
+        self.assertEqual(results, [expected])
+
+        errors = []
+        future = self.storage.read_async("get_facts", "not a date",
+                                         error_callback=errors.append)
+        with self.assertRaises(Exception):
+            future.result(timeout=10)
+        self.run_main_loop(lambda: errors)
+        self.assertEqual(errors, [future.exception()])
+
+        with self.assertRaises(AssertionError):
+            self.storage.read_async("add_fact", Fact.parse("10:00 bananas"))
+
+        def read():
+            return [fact.activity for fact in self.storage.get_facts(dt.hday(2020, 1, 15))]
+        self.assertEqual(self.storage.read_async(read).result(timeout=10), ["bananas"])
+
+        # the day start is handed over to the worker thread
+        with dt.hday.fixed_start_time(dt.time(0, 0)):
+            future = self.storage.read_async(dt.hday.start_time)
+        self.assertEqual(future.result(timeout=10), dt.time(0, 0))
+
+    def test_concurrent_write(self):
+        """Readers do not wait for the writer."""
+        self.storage.start_transaction()
+        self.storage.add_category("Food")
+        future = self.storage.read_async("get_categories")
+        # uncommitted yet
+        self.assertNotIn("Food", [row["name"] for row in future.result(timeout=10)])
+        self.storage.end_transaction()
+        future = self.storage.read_async("get_categories")
+        self.assertIn("Food", [row["name"] for row in future.result(timeout=10)])
+
+    def test_in_reader(self):
+        self.assertFalse(self.storage.in_reader())
+        with self.storage.reading():
+            self.assertTrue(self.storage.in_reader())
+        self.assertFalse(self.storage.in_reader())
+        self.assertTrue(self.storage.read_async(self.storage.in_reader).result(timeout=10))
+
+    def test_read_only(self):
+        with self.storage.reading() as con:
+            with self.assertRaises(db.sqlite.OperationalError):
+                con.execute("DELETE FROM facts")
+
+
+class TestQueryPlans(StorageTestCase):
+    """Time range lookups must not scan the whole facts table."""
+
+    def setUp(self):
+        super().setUp()
+        self.queries = []
+        fetchall = self.storage.fetchall
+
+        def recording_fetchall(query, params=None):
+            self.queries.append((query, params))
+            return fetchall(query, params)
+        self.storage.fetchall = recording_fetchall
+
+    def query_plan(self, query, params):
+        con = self.storage.connection
+        rows = con.execute("EXPLAIN QUERY PLAN {}".format(query), params or ())
+        return [row[3] for row in rows]
+
+    def assertTimeIndexed(self, fragment):
+        queries = [(query, params) for query, params in self.queries
+                   if fragment in query]
+        self.assertTrue(queries, "no query with '{}'".format(fragment))
+        for query, params in queries:
+            plan = self.query_plan(query, params)
+            scans = [step for step in plan
+                     if step.startswith(("SCAN a", "SCAN facts"))]
+            self.assertEqual(scans, [], "\n".join([query] + plan))
+            self.assertTrue(any("idx_facts_" in step for step in plan),
+                            "\n".join([query] + plan))
+
+    def test_get_facts(self):
+        self.storage.get_facts(dt.hday(2020, 1, 15), dt.hday(2020, 2, 15))
+        self.assertTimeIndexed("a.start_time <= ?")
+
+    def test_search(self):
+        self.storage.get_facts(dt.hday(2020, 1, 15), search_terms="bananas")
+        # no index maintenance at search time
+        self.assertEqual(len(self.queries), 1)
+        # driven by the full text index, then looked up by id
+        plan = self.query_plan(*self.queries[0])
+        self.assertIn("SEARCH a USING INTEGER PRIMARY KEY (rowid=?)", plan)
+
+    def test_squeeze_in(self):
+        fact = Fact.parse("2020-01-15 10:00 bananas")
+        self.storage.add_fact(fact)
+        self.assertTimeIndexed("end_time is null")
+
+    def test_solve_overlaps(self):
+        fact = Fact.parse("2020-01-15 10:00 - 2020-01-15 11:00 bananas")
+        self.storage.add_fact(fact)
+        self.assertTimeIndexed("start_time > ? and start_time < ?")
+
+
+class TestOverlaps(StorageTestCase):
+    def add(self, fact_str):
+        fact = Fact.parse(fact_str, default_day=self.day)
+        return self.storage.add_fact(fact)
+
+    def check_overlaps(self):
+        self.day = dt.hday.today() - dt.timedelta(days=2)
+        self.add("10:00 - 12:00 big")
+        self.add("10:30 - 11:00 split")
+        self.add("11:30 - 12:30 overlap end")
+        self.add("09:30 - 10:15 overlap start")
+        self.add("13:00 ongoing")
+        self.add("13:30 squeezed")
+        facts = self.storage.get_facts(self.day)
+        return [fact.serialized(default_day=self.day) for fact in facts]
+
+    def test_overlaps(self):
+        expected = ["09:30 - 10:15 overlap start",
+                    "10:15 - 10:30 big",
+                    "10:30 - 11:00 split",
+                    "11:00 - 11:30 big",
+                    "11:30 - 12:30 overlap end",
+                    "13:00 - 13:30 ongoing",
+                    "13:30 squeezed"]
+        self.assertEqual(self.check_overlaps(), expected)
+
+        # same, looking up in the database instead of in memory
+        self.tearDown()
+        self.setUp()
+        self.storage.intervals_span = dt.timedelta(0)
+        self.assertEqual(self.check_overlaps(), expected)
+
+    def facts_strs(self):
+        return [fact.serialized(default_day=self.day)
+                for fact in self.storage.get_facts(self.day)]
+
+    def test_rollback(self):
+        self.day = dt.hday.today() - dt.timedelta(days=2)
+        self.add("10:00 - 12:00 big")
+        # fail once big has been split
+        execute = self.storage.execute
+
+        def failing_execute(statement, params=()):
+            if "INSERT INTO facts" in str(statement):
+                raise db.sqlite.OperationalError("disk I/O error")
+            return execute(statement, params)
+
+        self.storage.execute = failing_execute
+        with self.assertRaises(db.sqlite.OperationalError):
+            self.add("10:30 - 11:00 split")
+        self.storage.execute = execute
+        self.assertEqual(self.facts_strs(), ["10:00 - 12:00 big"])
+        # overlaps are solved from the facts in the database
+        self.add("11:30 - 12:30 overlap end")
+        self.assertEqual(self.facts_strs(), ["10:00 - 11:30 big",
+                                             "11:30 - 12:30 overlap end"])
+
+    def test_outside_writer(self):
+        self.day = dt.hday.today() - dt.timedelta(days=2)
+        self.add("10:00 - 11:00 first")
+        other = db.Storage(unsorted_localized="", database_dir=self.tmpdir.name)
+        other.add_fact(Fact.parse("11:00 - 12:00 outside", default_day=self.day))
+        other.connection.close()
+        self.add("11:30 - 12:30 overlap end")
+        self.assertEqual(self.facts_strs(), ["10:00 - 11:00 first",
+                                             "11:00 - 11:30 outside",
+                                             "11:30 - 12:30 overlap end"])
+
+
+    def test_window_moves(self):
+        self.day = dt.hday.today() - dt.timedelta(days=2)
+        self.add("10:00 - 11:00 first")
+        later = dt.datetime.now() + 3 * self.storage.intervals_span
+        self.day = later.hday()
+        with mock.patch.object(dt.datetime, "now", return_value=later), \
+                self.assertLogs("hamster.storage.db", "INFO") as logs:
+            self.add("10:00 - 12:00 big")
+            self.add("10:30 - 11:00 split")
+        self.assertIn("INFO:hamster.storage.db:loaded 0 fact intervals", logs.output)
+        self.assertEqual(self.facts_strs(), ["10:00 - 10:30 big",
+                                             "10:30 - 11:00 split",
+                                             "11:00 - 12:00 big"])
+
+class TestAddFacts(StorageTestCase):
+    # chronological, as add_facts handles overlaps in that order
+    fact_strs = ["2020-01-15 09:30 - 2020-01-15 10:15 overlap start@Work, #b",
+                 "2020-01-15 10:00 - 2020-01-15 12:00 big@work, #a #b",
+                 "2020-01-15 10:30 - 2020-01-15 11:00 split@Home, #c",
+                 "2020-01-16 08:00 - 2020-01-16 09:00 big@Work",
+                 "2020-01-16 09:00 - 2020-01-16 09:30 no category, #a"]
+
+    def get_facts(self):
+        facts = self.storage.get_facts(dt.hday(2020, 1, 15), dt.hday(2020, 1, 16))
+        return [fact.serialized() for fact in facts]
+
+    def test_same_as_add_fact(self):
+        facts = [Fact.parse(fact_str) for fact_str in self.fact_strs]
+        for fact in facts:
+            self.storage.add_fact(fact)
+        expected = self.get_facts()
+
+        self.tearDown()
+        self.setUp()
+        changes = []
+        self.storage.facts_changed = lambda *args: changes.append("facts")
+        self.storage.tags_changed = lambda: changes.append("tags")
+        ids = self.storage.add_facts(facts)
+        self.assertEqual(self.get_facts(), expected)
+        self.assertEqual(changes, ["tags", "facts"])
+        self.assertEqual(len(ids), len(facts))
+        for fact_id, fact in zip(ids, facts):
+            self.assertEqual(self.storage.get_fact(fact_id).activity, fact.activity)
+        categories = [category["name"] for category in self.storage.get_categories()]
+        self.assertEqual(categories.count("Work"), 1)
+
+    def test_tags_sorted(self):
+        fact_id = self.storage.add_fact(Fact.parse("2020-01-15 10:00 tagged, #zz #aa #mm"))
+        expected = ["aa", "mm", "zz"]
+        self.assertEqual(self.storage.get_fact(fact_id).tags, expected)
+        self.assertEqual(self.storage.get_facts(dt.hday(2020, 1, 15))[0].tags, expected)
+        self.assertEqual(self.storage.get_changes_since(0)[1][0].tags, expected)
+
+    def test_invalid(self):
+        facts = [Fact.parse("2020-01-15 10:00 - 2020-01-15 12:00 valid"),
+                 Fact.parse("2020-01-15 10:00 - 2020-01-15 09:00 negative")]
+        with self.assertRaises(FactError):
+            self.storage.add_facts(facts)
+        self.assertEqual(self.get_facts(), [])
+
+
+class TestSearch(StorageTestCase):
+    def add(self, fact_str):
+        return self.storage.add_fact(Fact.parse(fact_str))
+
+    def search(self, terms):
+        facts = self.storage.get_facts(dt.hday(2020, 1, 15), dt.hday(2020, 1, 16),
+                                       search_terms=terms)
+        return [fact.activity for fact in facts]
+
+    def assertIndexIntact(self):
+        # rank 1: also compare with the facts
+        self.storage.execute("""INSERT INTO fact_index (fact_index, rank)
+                                     VALUES ('integrity-check', 1)""")
+
+    def test_search(self):
+        self.add("2020-01-15 10:00 - 2020-01-15 11:00 bananas@Food, peeled e-mail #yellow #ripe")
+        self.add("2020-01-15 11:00 - 2020-01-15 12:00 apples@Food")
+        self.add("2020-01-16 11:00 - 2020-01-16 12:00 work@Office, #yellow")
+        self.assertEqual(self.search("bananas"), ["bananas"])
+        self.assertEqual(self.search("food"), ["bananas", "apples"])
+        self.assertEqual(self.search("yellow"), ["bananas", "work"])
+        self.assertEqual(self.search("yellow food"), ["bananas"])
+        self.assertEqual(self.search("e-mail"), ["bananas"])
+        self.assertEqual(self.search("pee*"), ["bananas"])
+        self.assertEqual(self.search("pee"), [])
+        self.assertEqual(self.search("not food"), ["work"])
+        self.assertEqual(self.search("'\"%_"), [])
+        self.assertIndexIntact()
+
+    def test_syntax(self):
+        self.add("2020-01-15 10:00 - 2020-01-15 11:00 bananas@Food, green bananas #yellow")
+        self.add("2020-01-15 11:00 - 2020-01-15 12:00 yellow bananas@Food, #green")
+        self.add("2020-01-15 12:00 - 2020-01-15 13:00 apples@Food, bananas green #ripe")
+        self.assertEqual(self.search('"green bananas"'), ["bananas"])
+        self.assertEqual(self.search('"green banan"*'), ["bananas"])
+        self.assertEqual(self.search("tag:yellow"), ["bananas"])
+        self.assertEqual(self.search("tag:green"), ["yellow bananas"])
+        self.assertEqual(self.search("activity:bananas"), ["bananas", "yellow bananas"])
+        self.assertEqual(self.search('activity:"yellow bananas"'), ["yellow bananas"])
+        self.assertEqual(self.search("category:food description:green"), ["bananas", "apples"])
+        self.assertEqual(self.search("not tag:green"), ["bananas", "apples"])
+        # not a field
+        self.assertEqual(self.search("10:00"), [])
+
+    def test_ranked(self):
+        self.add("2020-01-15 10:00 - 2020-01-15 11:00 apples@Food, about bananas")
+        self.add("2020-01-15 11:00 - 2020-01-15 12:00 bananas@Food, bananas again")
+        self.add("2020-01-15 12:00 - 2020-01-15 13:00 cherries@Food")
+        self.add("2020-01-15 13:00 - 2020-01-15 14:00 bananas@Food")
+        self.add("2020-01-15 14:00 - 2020-01-15 15:00 bananas split@Food, #bananas")
+
+        def search(terms, **kwargs):
+            facts = self.storage.get_facts(dt.hday(2020, 1, 15), search_terms=terms, **kwargs)
+            return [fact.start_time.hour for fact in facts]
+
+        ranked = search("bananas", ranked=True)
+        self.assertEqual(sorted(ranked), [10, 11, 13, 14])
+        # activity names weigh most, a passing mention least
+        self.assertEqual(ranked[-1], 10)
+        self.assertEqual(search("bananas", ranked=True, limit=2), ranked[:2])
+        self.assertEqual(search("bananas", ranked=True, limit=2, offset=1), ranked[1:3])
+        self.assertEqual(search("bananas", offset=3), [14])
+        self.assertEqual(search("", limit=2), [10, 11])
+        # nothing to rank
+        self.assertEqual(search("not bananas", ranked=True), [12])
+
+    def test_changes(self):
+        """The index follows the changes without any rebuild."""
+        fact_id = self.add("2020-01-15 10:00 - 2020-01-15 11:00 bananas@Food, #yellow")
+        self.add("2020-01-15 11:00 - 2020-01-15 12:00 apples@Food")
+
+        fact = self.storage.get_fact(fact_id)
+        fact.description = "peeled"
+        fact.tags = ["ripe"]
+        fact_id = self.storage.update_fact(fact_id, fact)
+        self.assertEqual(self.search("peeled ripe"), ["bananas"])
+        self.assertEqual(self.search("yellow"), [])
+
+        category_id = self.storage.get_category_id("Food")
+        activity = self.storage.get_activity_by_name("bananas", category_id)
+        self.storage.update_activity(activity["id"], "plantains", category_id)
+        self.assertEqual(self.search("bananas"), [])
+        self.assertEqual(self.search("plantains"), ["plantains"])
+
+        self.storage.update_category(category_id, "Fruit")
+        self.assertEqual(self.search("fruit"), ["plantains", "apples"])
+        self.storage.remove_category(category_id)
+        self.assertEqual(self.search("fruit"), [])
+        self.assertEqual(self.search("apples"), ["apples"])
+
+        self.storage.remove_fact(fact_id)
+        self.assertEqual(self.search("peeled"), [])
+        self.assertIndexIntact()
+
+    def test_optimize(self):
+        self.add("2020-01-15 10:00 - 2020-01-15 11:00 bananas@Food, #yellow")
+        self.storage.optimize_index()
+        self.assertEqual(self.search("yellow"), ["bananas"])
+        # out of sync, e.g. after editing the database by hand
+        self.storage.execute("DELETE FROM fact_index")
+        self.assertEqual(self.search("yellow"), [])
+        self.storage.optimize_index(rebuild=True)
+        self.assertEqual(self.search("yellow"), ["bananas"])
+        self.assertIndexIntact()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,18 +3,28 @@ import sys, os.path
 sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "../src")))
 
 import datetime as pdt
+import random
+import subprocess
+import time
 import unittest
 import re
 from hamster.lib import datetime as dt
 from hamster.lib.dbus import (
+    to_dbus_date,
     to_dbus_fact,
     to_dbus_fact_json,
+    to_dbus_facts_batch,
     to_dbus_range,
+    from_dbus_date,
     from_dbus_fact,
     from_dbus_fact_json,
+    from_dbus_facts_batch,
     from_dbus_range,
     )
+from hamster.lib import factframe
 from hamster.lib.fact import Fact
+from hamster.lib.factframe import FactFrame
+from hamster.lib.intervaltree import IntervalTree
 from hamster.lib.parsing import get_tags_from_description
 
 
@@ -167,6 +177,24 @@ class TestFactParsing(unittest.TestCase):
         self.assertEqual(fact3.description, "changed")
         fact3 = fact1.copy(tags=["changed"])
         self.assertEqual(fact3.tags, ["changed"])
+        # copies are independent
+        fact3 = fact1.copy()
+        fact3.tags.append("other")
+        fact3.range.start += dt.timedelta(minutes=5)
+        self.assertEqual(fact1.tags, fact2.tags)
+        self.assertEqual(fact1.start_time, fact2.start_time)
+        with self.assertRaises(AttributeError):
+            fact1.copy(unknown="value")
+
+    def test_parse_again(self):
+        # results are kept, but relative times must follow ref
+        ref = dt.datetime(2019, 11, 29, 13, 55)
+        fact = Fact.parse("-10 case, #tag", ref=ref)
+        self.assertEqual(fact.start_time, dt.datetime(2019, 11, 29, 13, 45))
+        fact.tags.append("other")
+        fact = Fact.parse("-10 case, #tag", ref=ref + dt.timedelta(minutes=5))
+        self.assertEqual(fact.start_time, dt.datetime(2019, 11, 29, 13, 50))
+        self.assertEqual(fact.tags, ["tag"])
 
     def test_comparison(self):
         fact1 = Fact.parse("12:25-13:25 case@cat, description, #tag #bäg")
@@ -338,6 +366,26 @@ class TestDatetime(unittest.TestCase):
         self.assertEqual(date_time.hday(), expected)
         today = dt.hday.today()
         self.assertEqual(type(today), dt.hday)
+        # explicit day start
+        self.assertEqual(date_time.hday(dt.time(0, 0)), dt.date(2018, 8, 14))
+        self.assertEqual(dt.datetime.from_day_time(expected, dt.time(0, 10), dt.time(0, 0)),
+                         dt.datetime(2018, 8, 13, 0, 10))
+
+    def test_fixed_start_time(self):
+        date_time = dt.datetime(2018, 8, 14, 0, 10)  # 2018-08-14 0:10
+        with dt.hday.fixed_start_time(dt.time(0, 0)):
+            self.assertEqual(date_time.hday(), dt.date(2018, 8, 14))
+        self.assertEqual(date_time.hday(), dt.date(2018, 8, 13))
+
+    def test_hday_from_datetimes(self):
+        datetimes = [dt.datetime(2018, 8, 13, 23, 10),
+                     dt.datetime(2018, 8, 14, 0, 10),
+                     None,
+                     dt.datetime(2018, 8, 14, 12, 0),
+                     dt.datetime(2018, 8, 13, 0, 10)]
+        days = dt.hday.from_datetimes(datetimes)
+        self.assertEqual(days, [t.hday() if t else None for t in datetimes])
+        self.assertEqual(type(days[0]), dt.hday)
 
     def test_parse_date(self):
         date = dt.date.parse("2020-01-05")
@@ -489,6 +537,21 @@ class TestDatetime(unittest.TestCase):
         _sub = delta - delta
         self.assertEqual(_sub, dt.timedelta())
         self.assertEqual(type(_sub), dt.timedelta)
+        _sum = sum([delta, delta, pdt.timedelta(minutes=1)], dt.timedelta())
+        self.assertEqual(_sum, dt.timedelta(minutes=21))
+        self.assertEqual(type(_sum), dt.timedelta)
+        # still rounded with a delta that is not made of whole minutes
+        _sum = dt1 + dt.timedelta(seconds=90)
+        self.assertEqual(_sum, dt.datetime(2020, 1, 10, hour=13, minute=31))
+        self.assertEqual(type(_sum), dt.datetime)
+        _sub = dt1 - dt.timedelta(seconds=30)
+        self.assertEqual(_sub, dt.datetime(2020, 1, 10, hour=13, minute=29))
+        self.assertEqual(type(_sub), dt.datetime)
+
+        day = dt.hday(2020, 1, 10)
+        self.assertEqual(type(day + dt.timedelta(days=1)), dt.hday)
+        self.assertEqual(type(day - dt.timedelta(days=1)), dt.hday)
+        self.assertEqual(type(day - dt.hday(2020, 1, 1)), dt.timedelta)
 
     def test_timedelta(self):
         delta = dt.timedelta(seconds=90)
@@ -520,6 +583,171 @@ class TestDBus(unittest.TestCase):
         return_range = from_dbus_range(dbus_range)
         self.assertEqual(return_range, range)
 
+        for date in (dt.date(2020, 1, 19), dt.date(1969, 12, 31)):
+            self.assertEqual(from_dbus_date(to_dbus_date(date)), date)
+        self.assertIsNone(from_dbus_date(to_dbus_date(None)))
+
+    @unittest.skipUnless(hasattr(time, "tzset"), "needs time.tzset")
+    def test_date_timezones(self):
+        # dates are UTC midnights on D-Bus, whatever the local timezone
+        # (from_dbus_date used to decode them in local time, one day off west of UTC)
+        previous_tz = os.environ.get("TZ")
+        try:
+            for tz in ("UTC", "HST+10", "EST+5", "CET-1", "JST-9", "LINT-14"):
+                os.environ["TZ"] = tz
+                time.tzset()
+                for date in (dt.date(2020, 1, 19), dt.date(2020, 7, 1), dt.date(1969, 12, 31)):
+                    self.assertEqual(from_dbus_date(to_dbus_date(date)), date, tz)
+                self.assertEqual(to_dbus_date(dt.date(1970, 1, 2)), 86400, tz)
+        finally:
+            if previous_tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = previous_tz
+            time.tzset()
+
+    def test_batch_round_trip(self):
+        facts = [Fact.parse("2020-01-19 11:00 - 2020-01-19 12:00 activity@category, description #and #tags"),
+                 Fact.parse("2020-01-19 12:00 - 2020-01-20 01:00 activity@category, #tags #more"),
+                 Fact.parse("1969-12-31 23:59 - 2020-01-19 12:00 other@, with comma, ütf-8"),
+                 Fact.parse("2020-01-20 11:00 ongoing")]
+        for i, fact in enumerate(facts):
+            fact.id = i + 1
+            fact.activity_id = 10 + i
+        batch = to_dbus_facts_batch(facts)
+        # interned
+        self.assertEqual(list(batch[4]), ["activity", "other", "ongoing"])
+        self.assertEqual(list(batch[8]), ["and", "tags", "more"])
+        return_facts = from_dbus_facts_batch(batch)
+        self.assertEqual(return_facts, facts)
+        self.assertEqual([fact.id for fact in return_facts], [1, 2, 3, 4])
+        self.assertEqual([fact.activity_id for fact in return_facts], [10, 11, 12, 13])
+        self.assertEqual(type(return_facts[0].start_time), dt.datetime)
+        self.assertEqual(from_dbus_facts_batch(to_dbus_facts_batch([])), [])
+
+
+class TestFactFrame(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        self.now = dt.datetime(2020, 3, 1, 12, 0)
+        start = dt.datetime(2020, 1, 1, 0, 10)
+        self.facts = []
+        for i in range(300):
+            start += dt.timedelta(minutes=rng.randrange(-60, 300))
+            end = start + dt.timedelta(minutes=rng.randrange(0, 200))
+            tags = rng.sample(["a", "b", "c"], rng.randrange(3))
+            self.facts.append(Fact(activity="activity {}".format(rng.randrange(5)),
+                                   category=rng.choice(["", "work", "home"]),
+                                   tags=tags, start=start, end=end))
+        # on-going
+        self.facts.append(Fact(activity="current", start=start))
+        self.modes = [False]
+        if factframe.np is not None:
+            self.modes.append(True)
+
+    def expected_totals(self, key):
+        totals = {}
+        for fact in self.facts:
+            delta = (fact.range.end or self.now) - fact.range.start
+            for value in key(fact):
+                totals[value] = totals.get(value, dt.timedelta()) + delta
+        return sorted(totals.items(), key=lambda total: (-total[1], total[0]))
+
+    def test_totals(self):
+        expected = {"activity": self.expected_totals(lambda fact: [fact.activity]),
+                    "category": self.expected_totals(lambda fact: [fact.category]),
+                    "tag": self.expected_totals(lambda fact: fact.tags),
+                    "day": self.expected_totals(lambda fact: [fact.date])}
+        for use_numpy in self.modes:
+            frame = FactFrame.from_facts(self.facts, now=self.now, use_numpy=use_numpy)
+            self.assertEqual(len(frame), len(self.facts))
+            self.assertEqual(frame.hdays(), [fact.date for fact in self.facts])
+            for group_by in factframe.GROUPS:
+                self.assertEqual(frame.totals(group_by), expected[group_by])
+
+    def test_overlaps(self):
+        expected = [(i, j)
+                    for i, fact in enumerate(self.facts)
+                    for j, other in enumerate(self.facts)
+                    if i < j and fact.range.start < (other.range.end or self.now)
+                    and other.range.start < (fact.range.end or self.now)]
+        self.assertTrue(expected)
+        for use_numpy in self.modes:
+            frame = FactFrame.from_facts(self.facts, now=self.now, use_numpy=use_numpy)
+            self.assertEqual(frame.overlaps(), expected)
+            # half-open
+            frame = FactFrame([0, 10, 20, 20], [10, 20, 20, 30], [0] * 4, [0] * 4,
+                              [], [], ["a"], [""], [], use_numpy=use_numpy)
+            self.assertEqual(frame.overlaps(), [])
+
+    def test_empty(self):
+        for use_numpy in self.modes:
+            frame = FactFrame.from_facts([], use_numpy=use_numpy)
+            for group_by in factframe.GROUPS:
+                self.assertEqual(frame.totals(group_by), [])
+            self.assertEqual(frame.overlaps(), [])
+
+    def test_minutes(self):
+        t = dt.datetime(2020, 3, 1, 12, 34)
+        self.assertEqual(factframe.from_minutes(factframe.to_minutes(t)), t)
+        self.assertEqual(factframe.to_minutes(dt.datetime(1970, 1, 2)), 24 * 60)
+
+
+class TestIntervalTree(unittest.TestCase):
+    def brute_force(self, intervals, start, end):
+        return sorted((key, s, e) for key, (s, e) in intervals.items()
+                      if (end is None or s < end) and (e is None or e > start))
+
+    def test_overlapping(self):
+        rng = random.Random(42)
+        tree = IntervalTree()
+        intervals = {}
+        for key in range(500):
+            start = rng.randrange(1000)
+            end = None if rng.random() < 0.05 else start + rng.randrange(1, 50)
+            tree.add(key, start, end)
+            intervals[key] = (start, end)
+        for key in rng.sample(range(500), 200):
+            tree.discard(key)
+            del intervals[key]
+        self.assertEqual(len(tree), len(intervals))
+        for __ in range(200):
+            start = rng.randrange(1000)
+            end = None if rng.random() < 0.1 else start + rng.randrange(1, 100)
+            res = tree.overlapping(start, end)
+            self.assertEqual([s for __, s, __ in res], sorted(s for __, s, __ in res))
+            self.assertEqual(sorted(res), self.brute_force(intervals, start, end))
+
+    def test_replace(self):
+        tree = IntervalTree([(1, 10, 20), (2, 30, None)])
+        self.assertEqual(tree.overlapping(15, 35), [(1, 10, 20), (2, 30, None)])
+        tree.add(1, 40, 50)
+        self.assertEqual(len(tree), 2)
+        self.assertEqual(tree.get(1), (40, 50))
+        self.assertEqual(tree.overlapping(15, 35), [(2, 30, None)])
+        # half-open
+        self.assertEqual(tree.overlapping(50, 60), [(2, 30, None)])
+        tree.discard(2)
+        tree.discard(2)
+        self.assertNotIn(2, tree)
+        self.assertEqual(tree.overlapping(0), [(1, 40, 50)])
+
+
+
+class TestImports(unittest.TestCase):
+    def test_client(self):
+        # in a fresh interpreter, nothing imported before
+        # (client, storage.db and the configuration import one another)
+        env = dict(os.environ)
+        src_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), "../src"))
+        env["PYTHONPATH"] = os.pathsep.join([src_dir] + ([env["PYTHONPATH"]]
+                                                         if env.get("PYTHONPATH") else []))
+        for module in ("hamster.client", "hamster.storage.db"):
+            result = subprocess.run([sys.executable, "-c", "import {}".format(module)],
+                                    env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+
 
 if __name__ == '__main__':
     unittest.main()